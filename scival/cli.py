@@ -1,12 +1,17 @@
 """ Commandline Entrypoint """
 
+import sys
+
 import click
 
 from scival.util import setup_logger
 from scival.retrieve_data.espa import espa_orders_api
 from scival.retrieve_data.ee import ee_m2m_api
 from scival.retrieve_data.espa import order_scenes_c1
+from scival.retrieve_data.espa import order_watch
 from scival.validate_data.qa import qa_data
+from scival.validate_data import benchmark
+from scival import pipeline
 
 
 @click.group(context_settings={'help_option_names': ['-h', '--help']})
@@ -28,8 +33,78 @@ def qa():
 @click.option('-x', '--xml_schema', required=False, type=str, help='Full path to XML schema')
 @click.option('--archive/--no-archive', default=False, help='Look for archives or files')
 @click.option('--include-nodata', default=False, is_flag=True, help='Do not mask NoData values')
-def scival(dir_mast, dir_test, dir_out, xml_schema, archive, include_nodata):
-    qa_data(dir_mast, dir_test, dir_out, archive, xml_schema, include_nodata)
+@click.option('--window-size', required=False, type=click.IntRange(min=1),
+              help='Compare rasters in block-aligned windows of at most this many pixels')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of processes to compare files on')
+@click.option('--in-place', default=False, is_flag=True,
+              help='With --archive, read archive members directly instead of extracting them')
+@click.option('--resume/--no-resume', default=True,
+              help='Skip file pairs already compared in a previous run into the same results directory')
+@click.option('--trace', default=False, is_flag=True,
+              help='Write timing spans to trace.json (Chrome trace format) and trace_summary.csv')
+@click.option('--mode', default='report', type=click.Choice(['report', 'gate']),
+              help='report: stats and plots of all differences; gate: pass/fail of rasters against tolerances')
+@click.option('--tolerances', required=False, type=click.Path(exists=True, dir_okay=False),
+              help='Gate mode: JSON file of per-extension, per-file or per-band tolerances')
+@click.option('--abs-tol', default=0.0, type=click.FloatRange(min=0), help='Gate mode: default absolute tolerance')
+@click.option('--rel-tol', default=0.0, type=click.FloatRange(min=0), help='Gate mode: default relative tolerance')
+@click.option('--jpeg-draft', default=False, is_flag=True,
+              help='Compare JPEGs at 1/8 resolution first and fully decode only those that differ')
+@click.option('--xml-tolerances', required=False, type=click.Path(exists=True, dir_okay=False),
+              help='JSON file of numeric tolerances and ignored fields for the XML metadata comparison')
+def scival(dir_mast, dir_test, dir_out, xml_schema, archive, include_nodata, window_size, workers, in_place,
+           resume, trace, mode, tolerances, abs_tol, rel_tol, jpeg_draft, xml_tolerances):
+    passed = qa_data(dir_mast, dir_test, dir_out, archive, xml_schema, include_nodata, window_size, workers,
+                     in_place, resume, trace, mode, tolerances, abs_tol, rel_tol, jpeg_draft, xml_tolerances)
+
+    if passed is False:
+        sys.exit(1)
+
+
+@qa.command('benchmark', help='Benchmark qa compare on generated synthetic data')
+@click.option('-w', '--work_dir', required=False, type=str, help='Working directory, default is a temporary directory')
+@click.option('-r', '--report', required=False, type=str, help='Write the JSON report here instead of stdout')
+@click.option('--scenes', default=2, type=click.IntRange(min=1), help='Number of scenes')
+@click.option('--rows', default=1000, type=click.IntRange(min=1), help='Rows per band')
+@click.option('--cols', default=1000, type=click.IntRange(min=1), help='Columns per band')
+@click.option('--bands', default=3, type=click.IntRange(min=1), help='Bands per scene')
+@click.option('--diff-density', default=0.01, type=click.FloatRange(0, 1), help='Fraction of differing pixels')
+@click.option('--nodata-fraction', default=0.1, type=click.FloatRange(0, 1), help='Fraction of NoData pixels')
+@click.option('--interleave', default='BSQ', type=click.Choice(['BSQ', 'BIL', 'BIP']), help='Interleave of ENVI files')
+@click.option('--window-size', required=False, type=click.IntRange(min=1),
+              help='Compare rasters in block-aligned windows of at most this many pixels')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of processes to compare files on')
+@click.option('--keep', default=False, is_flag=True, help='Keep the generated data')
+def bench(work_dir, report, scenes, rows, cols, bands, diff_density, nodata_fraction, interleave, window_size,
+          workers, keep):
+    benchmark.run_benchmark(work_dir, report, scenes, rows, cols, bands, diff_density, nodata_fraction, interleave,
+                            workers, window_size, keep)
+
+
+@cli.command('pipeline', help='Download master and test orders and compare each scene as soon as both arrive')
+@click.option('-m', '--mast_orders', required=True, type=click.Path(exists=True, dir_okay=False), help='The .txt file containing the Master ESPA orders')
+@click.option('-t', '--test_orders', required=True, type=click.Path(exists=True, dir_okay=False), help='The .txt file containing the Test ESPA orders')
+@click.option('--mast-env', required=True, type=click.Choice(espa_orders_api.api_config.espa_env.keys()), help='ESPA environment of the Master orders')
+@click.option('--test-env', required=True, type=click.Choice(espa_orders_api.api_config.espa_env.keys()), help='ESPA environment of the Test orders')
+@click.option('-w', '--work_dir', required=True, type=str, help='The download directory')
+@click.option('-o', '--dir_out', required=True, type=str, help='The Results directory')
+@click.option('-u', '--username', required=True, type=str, help='ESPA user name', envvar='ESPA_SCIVAL_ESPA_USERNAME')
+@click.option('-x', '--xml_schema', required=False, type=str, help='Full path to XML schema')
+@click.option('--include-nodata', default=False, is_flag=True, help='Do not mask NoData values')
+@click.option('--window-size', required=False, type=click.IntRange(min=1),
+              help='Compare rasters in block-aligned windows of at most this many pixels')
+@click.option('--downloads', default=4, type=click.IntRange(min=1), help='Number of concurrent downloads')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of processes to compare files on')
+@click.option('--resume/--no-resume', default=True,
+              help='Skip file pairs already compared in a previous run into the same results directory')
+@click.option('--keep', default=False, is_flag=True, help='Keep the archives after comparing them')
+@click.option('--interval', default=60, type=click.FloatRange(min=1), help='Seconds between polls of an order that is making progress')
+@click.option('--max-interval', default=1800, type=click.FloatRange(min=1), help='Maximum seconds between polls of an order')
+def run_pipeline(mast_orders, test_orders, mast_env, test_env, work_dir, dir_out, username, xml_schema,
+                 include_nodata, window_size, downloads, workers, resume, keep, interval, max_interval):
+    pipeline.run_pipeline(mast_orders, test_orders, work_dir, dir_out, username, mast_env, test_env, downloads,
+                          workers, xml_schema, include_nodata, window_size, resume, keep, interval,
+                          max(interval, max_interval))
 
 
 @cli.group('ee')
@@ -48,9 +123,10 @@ def espa():
 @click.option('-e', '--ee_env', required=True,
               type=click.Choice(espa_orders_api.api_config.espa_env.keys()),
               help='EE environment', envvar='ESPA_SCIVAL_EE_ENV')
-def download(dir_out, search, username, ee_env):
+@click.option('--workers', default=4, type=click.IntRange(min=1), help='Number of concurrent downloads')
+def download(dir_out, search, username, ee_env, workers):
     """Download a specific JSON search."""
-    ee_m2m_api.download_search(search, dir_out, username, ee_env)
+    ee_m2m_api.download_search(search, dir_out, username, ee_env, workers)
 
 
 @cli.group('espa')
@@ -73,8 +149,22 @@ def order(username, espa_env, dir_out, order):
 @click.option('-o', '--dir_out', required=True, type=str, help='The output directory')
 @click.option('-u', '--username', required=True, type=str, help='ESPA user name', envvar='ESPA_SCIVAL_ESPA_USERNAME')
 @click.option('-e', '--espa_env', required=True, type=click.Choice(espa_orders_api.api_config.espa_env.keys()), help='ESPA environment', envvar='ESPA_SCIVAL_ESPA_ENV')
-def download(txt_in, outdir, username, espa_env):
-    espa_orders_api.get_orders(txt_in, outdir, username, espa_env)
+@click.option('--workers', default=4, type=click.IntRange(min=1), help='Number of concurrent downloads')
+def download(txt_in, dir_out, username, espa_env, workers):
+    espa_orders_api.get_orders(txt_in, dir_out, username, espa_env, workers)
+
+
+@espa.command('watch', help='Poll orders until they finish, downloading items as they complete')
+@click.option('-i', '--txt_in', required=True, type=str, help='The .txt file containing the ESPA orders')
+@click.option('-o', '--dir_out', required=True, type=str, help='The output directory')
+@click.option('-u', '--username', required=True, type=str, help='ESPA user name', envvar='ESPA_SCIVAL_ESPA_USERNAME')
+@click.option('-e', '--espa_env', required=True, type=click.Choice(espa_orders_api.api_config.espa_env.keys()), help='ESPA environment', envvar='ESPA_SCIVAL_ESPA_ENV')
+@click.option('--workers', default=4, type=click.IntRange(min=1), help='Number of concurrent downloads')
+@click.option('--pollers', default=4, type=click.IntRange(min=1), help='Number of concurrent status requests')
+@click.option('--interval', default=60, type=click.FloatRange(min=1), help='Seconds between polls of an order that is making progress')
+@click.option('--max-interval', default=1800, type=click.FloatRange(min=1), help='Maximum seconds between polls of an order')
+def watch(txt_in, dir_out, username, espa_env, workers, pollers, interval, max_interval):
+    order_watch.watch_orders(txt_in, dir_out, username, espa_env, workers, pollers, interval, max(interval, max_interval))
 
 
 @espa.command('cancel', help='Cancel orders not yet processed')
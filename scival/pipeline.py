@@ -0,0 +1,205 @@
+""" Download-to-compare pipeline
+
+Watches the orders of a master and a test ESPA environment at the same time,
+downloading items from both as they complete. Each scene is compared as soon
+as both of its archives are on disk (their members are read in place,
+without extracting them), while the other downloads carry on, and its
+archives are deleted once its results are recorded, so
+only the scenes in flight take up disk space. Scenes recorded as done in an
+earlier run are not downloaded again; a scene whose download or comparison
+fails is recorded as failed without stopping the others.
+"""
+
+import os
+import time
+import queue
+import threading
+from functools import partial
+
+from scival.retrieve_data.downloader import Downloader, MANIFEST
+from scival.retrieve_data.espa import espa_orders_api, order_watch
+from scival.validate_data.file_io import Archive, Checksum
+from scival.validate_data.manifest import Manifest
+from scival.validate_data.parallel import PairPool
+from scival.validate_data.qa import qa_files, write_result
+from scival import logger
+
+
+def _watch(side: str, *args, **kwargs) -> None:
+    """Watch the orders of one side, logging instead of losing an exception raised in the thread"""
+    try:
+        order_watch.watch_orders(*args, **kwargs)
+
+    except Exception:
+        logger.exception("Watching the %s orders failed", side)
+
+
+def _remove(paths: list) -> None:
+    """Delete the archives of a scene whose results are recorded (archive members are left to the archive)"""
+    for path in paths:
+        if Archive.split_vsi(path) is None and os.path.exists(path):
+            logger.info("Remove %s", path)
+
+            os.remove(path)
+
+
+def _scene_done(manifest: Manifest, name: str) -> None:
+    """Record a scene whose pairs are all compared and recorded"""
+    logger.warning("Scene %s done", name)
+
+    manifest.record_scene(name, "done")
+
+
+def run_pipeline(mast_orders: str, test_orders: str, dir_work: str, dir_out: str, username: str, mast_env: str,
+                 test_env: str, workers: int = 4, compare_workers: int = 1, xml_schema: str = None,
+                 incl_nd: bool = False, window_size: int = None, resume: bool = True, keep: bool = False,
+                 interval: float = 60, max_interval: float = 1800) -> None:
+    """
+    Download the orders of two ESPA environments and compare every scene as soon as both of its archives arrive
+    :param mast_orders: Full path to the order file of the master environment
+    :param test_orders: Full path to the order file of the test environment
+    :param dir_work: Full path to the download directory; archives go to master/ and test/ below it
+    :param dir_out: Full path to the QA output directory
+    :param username: ESPA user name
+    :param mast_env: ESPA environment of the master orders
+    :param test_env: ESPA environment of the test orders
+    :param workers: Number of concurrent downloads
+    :param compare_workers: Number of processes to run file pair comparisons on
+    :param xml_schema: Full path to XML files, default is None
+    :param incl_nd: If True, include NoData in comparisons
+    :param window_size: If set, compare rasters in block-aligned windows of at most this many pixels
+    :param resume: If True, skip scenes and file pairs already compared in a previous run
+    :param keep: If True, keep the archives after comparing them
+    :param interval: Seconds between polls of an order that is making progress
+    :param max_interval: Maximum seconds between polls of an order
+    :return:
+    """
+    t0 = time.time()
+
+    if not os.path.exists(dir_out):
+        os.makedirs(dir_out)
+
+    passwd = espa_orders_api.espa_login()
+
+    # hashes computed while downloading are kept with the results, so comparisons can use them
+    Checksum.use_cache(os.path.join(dir_out, "hashes.sqlite"))
+
+    manifest = Manifest(dir_out, resume)
+
+    manifest.write_stats()
+
+    # read before the watcher threads start, as the manifest's connection belongs to this thread
+    done = manifest.scenes_done()
+
+    if done:
+        logger.warning("%d scenes were compared in a previous run and are not downloaded again", len(done))
+
+    # started before the watcher threads, so no worker is forked holding their locks
+    pool = PairPool(compare_workers, writer=partial(write_result, manifest, dir_out), skip=manifest.is_done)
+
+    if not os.path.exists(dir_work):
+        os.makedirs(dir_work)
+
+    downloader = Downloader(workers=workers, manifest=os.path.join(dir_work, MANIFEST))
+
+    # (side, item name, Future of the DownloadResult) of every finished download
+    ready = queue.Queue()
+
+    queued = list()
+
+    def on_download(side, name, future):
+        queued.append(name)
+
+        future.add_done_callback(lambda f: ready.put((side, name, f)))
+
+    watchers = list()
+
+    for side, orders, env in (("master", mast_orders, mast_env), ("test", test_orders, test_env)):
+        watchers.append(threading.Thread(target=_watch, name=side, args=(side, orders, os.path.join(dir_work, side),
+                                                                         username, env),
+                                         kwargs=dict(interval=interval, max_interval=max_interval, passwd=passwd,
+                                                     downloader=downloader,
+                                                     on_download=partial(on_download, side),
+                                                     skip=done.__contains__)))
+
+    for watcher in watchers:
+        watcher.start()
+
+    arrived = {"master": dict(), "test": dict()}
+
+    received = 0
+
+    while any(watcher.is_alive() for watcher in watchers) or received < len(queued):
+        try:
+            side, name, future = ready.get(timeout=1)
+
+        except queue.Empty:
+            pool.poll()
+
+            continue
+
+        received += 1
+
+        try:
+            result = future.result()
+
+        except Exception:
+            logger.exception("Scene %s will not be compared, its %s download raised", name, side)
+
+            manifest.record_scene(name, "failed")
+
+            continue
+
+        if result.status == "failed":
+            logger.error("Scene %s will not be compared, its %s download failed", name, side)
+
+            manifest.record_scene(name, "failed")
+
+            continue
+
+        arrived[side][name] = result.path
+
+        if name in arrived["master"] and name in arrived["test"]:
+            mast, test = arrived["master"].pop(name), arrived["test"].pop(name)
+
+            logger.warning("Comparing scene %s", name)
+
+            try:
+                test_files, mast_files = Archive.compare_paths(test), Archive.compare_paths(mast)
+
+                qa_files(test_files, mast_files, dir_out, pool, xml_schema, incl_nd, window_size)
+
+            except Exception:
+                logger.exception("Comparing scene %s failed", name)
+
+                manifest.record_scene(name, "failed")
+
+                continue
+
+            pool.then(partial(_scene_done, manifest, name))
+
+            if not keep:
+                pool.then(partial(_remove, [test, mast] + test_files + mast_files))
+
+        pool.poll()
+
+    for side in ("master", "test"):
+        for name, path in arrived[side].items():
+            logger.error("Scene %s only arrived from the %s orders: %s", name, side, path)
+
+    downloader.close()
+
+    pool.close()
+
+    # rebuild stats.csv, dropping rows of pairs that were compared again
+    manifest.write_stats()
+
+    manifest.close()
+
+    m, s = divmod(time.time() - t0, 60)
+
+    h, m = divmod(m, 60)
+
+    logger.warning("Total runtime: {0}h, {1}m, {2}s.".format(h, round(m, 3), round(s, 3)))
+
+    return None
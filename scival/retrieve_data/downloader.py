@@ -0,0 +1,638 @@
+"""Concurrent downloads over one pooled HTTP session.
+
+Transfers run on a thread pool; connections are kept alive and reused
+through a shared requests.Session, and a per-host semaphore bounds how many
+connections (requests, and every segment of a segmented download) are open
+to the same server at once.
+
+Data is written to `<outfile>.part` and only renamed to `<outfile>` once
+its size (and digest, when given) is verified. An interrupted transfer
+leaves the `.part` file behind and the next attempt resumes it with an
+HTTP Range request. A complete file with the wrong size or digest is kept
+as `.part` and downloaded again from the start.
+
+A file with an expected digest (e.g. from the checksum file ESPA publishes
+next to a product) is downloaded over one connection and its bytes are
+hashed in order as they are written, with the digest's algorithm and with
+the hash used by Checksum, which is cached for the finished file so
+comparisons never read it to hash it again. Large files without a digest,
+served with byte ranges, are fetched as parallel segments over several
+connections and verified by their size; the progress of every segment is
+saved to `<outfile>.part.json` every few seconds or megabytes, so segments
+resume individually. Corrupt and incomplete files are retried; every
+verified file is appended to a JSON-lines manifest when one is given.
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as TransferError
+
+from scival.validate_data.file_io import Checksum
+from scival import logger
+
+
+# outcome of one transfer; status is "downloaded", "exists" or "failed"
+DownloadResult = namedtuple('DownloadResult', ['url', 'path', 'status', 'bytes', 'seconds'])
+
+# bytes read from the response per write
+CHUNK_SIZE = 1024 * 1024
+
+# files are split into segments of at least this many bytes
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# the progress of a segmented download is saved after this many bytes or seconds
+STATE_BYTES = 16 * CHUNK_SIZE
+STATE_SECONDS = 2.0
+
+# file name of the manifest of verified downloads, in a download directory
+MANIFEST = 'verified.jsonl'
+
+# hashlib algorithm of a hex digest, by its length
+DIGESTS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+# every byte with its bits in reverse order, for bytes.translate
+_REVERSED = bytes(int('{0:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def _content_size(resp) -> int:
+    """Total size of the resource behind a response, None if not known"""
+    content_range = resp.headers.get('Content-Range', '')
+
+    if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+        return int(content_range.rsplit('/', 1)[1])
+
+    length = resp.headers.get('Content-Length', '')
+
+    if resp.status_code == 200 and length.isdigit():
+        return int(length)
+
+    return None
+
+
+class Cksum:
+    """
+    The CRC of POSIX cksum, with the update/hexdigest interface of a hashlib object (the digest is the
+    decimal number cksum prints).
+
+    cksum feeds the bits of each byte most significant first, zlib's CRC-32 (same polynomial) least
+    significant first, so zlib runs on bit-reversed bytes and its register is reversed back at the end.
+    """
+
+    name = 'cksum'
+
+    def __init__(self):
+        # zlib's running value for a register starting at 0
+        self.value = 0xFFFFFFFF
+        self.size = 0
+
+    def update(self, data: bytes) -> None:
+        self.value = zlib.crc32(bytes(data).translate(_REVERSED), self.value)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        # the length follows the data, least significant byte first, in as few bytes as it needs
+        length = bytearray()
+
+        n = self.size
+
+        while n:
+            length.append(n & 0xFF)
+            n >>= 8
+
+        value = zlib.crc32(bytes(length).translate(_REVERSED), self.value)
+
+        register = int('{0:032b}'.format(~value & 0xFFFFFFFF)[::-1], 2)
+
+        return str(~register & 0xFFFFFFFF)
+
+
+def _new_hasher(algorithm: str):
+    """New hash object of a digest's algorithm: a hashlib name or 'cksum'"""
+    return Cksum() if algorithm == Cksum.name else hashlib.new(algorithm)
+
+
+def parse_cksum(text: str) -> tuple:
+    """
+    Read a published checksum: a hex digest ("<md5> <file>", the algorithm is told by its length), or the
+    output of POSIX cksum ("<crc> <size> <file>")
+    :param text: Contents of the checksum file
+    :return: size (or None), (algorithm, digest) (or None)
+    """
+    tokens = text.split()
+
+    if len(tokens) >= 2 and tokens[0].isdigit() and tokens[1].isdigit():
+        return int(tokens[1]), (Cksum.name, str(int(tokens[0])))
+
+    if tokens and len(tokens[0]) in DIGESTS:
+        try:
+            int(tokens[0], 16)
+
+            return None, (DIGESTS[len(tokens[0])], tokens[0].lower())
+
+        except ValueError:
+            pass
+
+    logger.warning("Unknown checksum format: %s", text[:200])
+
+    return None, None
+
+
+def _hash_into(hashers: dict, path: str) -> None:
+    """Feed the contents of a file to every hash object"""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            for h in hashers.values():
+                h.update(chunk)
+
+
+class Downloader:
+    """Download many URLs concurrently, over at most `per_host` connections at a time to each host."""
+
+    def __init__(self, workers: int = 4, per_host: int = 4, auth=None, verify: bool = True,
+                 timeout=(10, 120), segments: int = 4, segment_size: int = SEGMENT_SIZE, retries: int = 2,
+                 manifest: str = None):
+        """
+        :param workers: Number of concurrent transfers
+        :param per_host: Maximum number of concurrent connections to one host, segments included
+        :param auth: requests auth for every request, e.g. (username, password)
+        :param verify: Verify TLS certificates
+        :param timeout: requests (connect, read) timeout in seconds
+        :param segments: Maximum number of connections used for one file
+        :param segment_size: Minimum number of bytes per segment
+        :param retries: Number of times a failed, incomplete or corrupt download is tried again
+        :param manifest: Full path to a JSON-lines file every verified download is appended to
+        """
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        self.timeout = timeout
+        self.segments = max(1, segments)
+        self.segment_size = max(CHUNK_SIZE, segment_size)
+        self.retries = max(0, retries)
+        self.manifest = manifest
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = verify
+
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers * self.segments)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = list()
+
+        self._hosts = dict()
+        self._lock = threading.Lock()
+        self._t0 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        """Semaphore limiting concurrent connections to the host of a URL"""
+        host = urlparse(url).netloc
+
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+
+            return self._hosts[host]
+
+    def submit(self, url: str, outfile: str, size: int = None, digest: tuple = None, cksum_url: str = None):
+        """
+        Queue a download
+        :param url: URL to download
+        :param outfile: Full path of the file to write
+        :param size: Expected size in bytes, default is the size reported by the server
+        :param digest: Expected (hashlib algorithm or 'cksum', digest), e.g. ("md5", "d41d8c...")
+        :param cksum_url: URL of a published checksum of the file, used for the size and digest not given
+        :return: Future of the DownloadResult
+        """
+        if self._t0 is None:
+            self._t0 = time.time()
+
+        future = self.executor.submit(self.fetch, url, outfile, size, digest, cksum_url)
+
+        self.futures.append(future)
+
+        return future
+
+    def _probe(self, url: str) -> tuple:
+        """
+        Ask the server for the size of a URL and whether it serves byte ranges
+        :param url: URL to download
+        :return: size (None if not known), ranges supported
+        """
+        try:
+            resp = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            resp.raise_for_status()
+
+        except requests.RequestException as exc:
+            logger.debug("HEAD %s failed: %s", url, exc)
+
+            return None, False
+
+        return _content_size(resp), resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+    def fetch_cksum(self, cksum_url: str) -> tuple:
+        """
+        Get a published checksum
+        :param cksum_url: URL of the checksum file
+        :return: size (or None), (hashlib algorithm or 'cksum', digest) (or None)
+        """
+        try:
+            with self._host_slot(cksum_url):
+                resp = self.session.get(cksum_url, timeout=self.timeout)
+                resp.raise_for_status()
+
+        except requests.RequestException as exc:
+            logger.warning("Could not get checksum %s: %s", cksum_url, exc)
+
+            return None, None
+
+        return parse_cksum(resp.text)
+
+    def _stream(self, url: str, part: str, size: int, ranges: bool, hashers: dict) -> tuple:
+        """
+        Download over one connection, appending to a partial file if the server serves byte ranges
+        :param url: URL to download
+        :param part: Full path of the partial file
+        :param size: Expected size, None if not known
+        :param ranges: The server serves byte ranges
+        :param hashers: Hash objects fed every byte of the file, in order
+        :return: bytes transferred, size of the file (None if not known)
+        """
+        offset = os.path.getsize(part) if ranges and os.path.exists(part) else 0
+
+        if size is not None and offset >= size:
+            if offset == size:
+                _hash_into(hashers, part)
+
+                return 0, size
+
+            offset = 0
+
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+
+        nbytes = 0
+
+        with self.session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+
+            if offset and resp.status_code != 206:
+                logger.warning("Server ignored the range request, restarting %s", url)
+                offset = 0
+
+            elif offset:
+                logger.info("Resume %s at byte %d", url, offset)
+
+                # only the part already on disk is read back
+                _hash_into(hashers, part)
+
+            if size is None:
+                size = _content_size(resp)
+
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in resp.raw.stream(CHUNK_SIZE, decode_content=False):
+                    f.write(chunk)
+                    nbytes += len(chunk)
+
+                    for h in hashers.values():
+                        h.update(chunk)
+
+        return nbytes, size
+
+    def _segmented(self, url: str, part: str, size: int, count: int) -> int:
+        """
+        Download byte-range segments of a file in parallel into a partial file
+        :param url: URL to download
+        :param part: Full path of the partial file
+        :param size: Size of the file
+        :param count: Number of segments
+        :return: bytes transferred
+        """
+        state_path = part + '.json'
+
+        segments = None
+
+        if os.path.exists(part) and os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+
+                if state['size'] == size and os.path.getsize(part) == size:
+                    segments = state['segments']
+
+            except (OSError, ValueError, KeyError):
+                segments = None
+
+        if segments is None:
+            step = -(-size // count)
+            segments = [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+            with open(part, 'wb') as f:
+                f.truncate(size)
+
+        else:
+            logger.info("Resume %s at %d of %d bytes", url, sum(seg[2] for seg in segments), size)
+
+        lock = threading.Lock()
+
+        # bytes written since the state was last saved, and when it was saved
+        unsaved = {'bytes': 0, 'time': time.time()}
+
+        def save():
+            with open(state_path + '.tmp', 'w') as f:
+                json.dump({'size': size, 'segments': segments}, f)
+
+            os.replace(state_path + '.tmp', state_path)
+
+            unsaved.update(bytes=0, time=time.time())
+
+        def advance(seg, nbytes):
+            # the state never counts bytes that are not written yet, so saving it late only costs a re-download
+            with lock:
+                seg[2] += nbytes
+
+                unsaved['bytes'] += nbytes
+
+                if unsaved['bytes'] >= STATE_BYTES or time.time() - unsaved['time'] >= STATE_SECONDS:
+                    save()
+
+        def run(seg):
+            start, end = seg[0], seg[1]
+
+            if start + seg[2] > end:
+                return 0
+
+            nbytes = 0
+
+            # every segment is a connection of its own, counted against the host's limit
+            with self._host_slot(url):
+                headers = {'Range': 'bytes={0}-{1}'.format(start + seg[2], end)}
+
+                with self.session.get(url, headers=headers, stream=True, allow_redirects=True,
+                                      timeout=self.timeout) as resp:
+                    resp.raise_for_status()
+
+                    if resp.status_code != 206:
+                        raise requests.HTTPError("Server ignored the range request", response=resp)
+
+                    for chunk in resp.raw.stream(CHUNK_SIZE, decode_content=False):
+                        chunk = chunk[:end + 1 - start - seg[2]]
+
+                        os.pwrite(fd, chunk, start + seg[2])
+
+                        nbytes += len(chunk)
+
+                        advance(seg, len(chunk))
+
+            return nbytes
+
+        save()
+
+        fd = os.open(part, os.O_WRONLY)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [executor.submit(run, seg) for seg in segments]
+
+            # every segment has finished; raise the first failure
+            return sum(future.result() for future in futures)
+
+        finally:
+            os.close(fd)
+
+            save()
+
+    def _attempt(self, url: str, part: str, size: int, digest: tuple, restart: bool = False) -> tuple:
+        """
+        Download a URL into a partial file once, resuming what is already there
+        :param url: URL to download
+        :param part: Full path of the partial file
+        :param size: Expected size, None to use the size reported by the server
+        :param digest: Expected (hashlib algorithm or 'cksum', digest), or None
+        :param restart: Discard the partial file (one that failed verification) and start from the beginning
+        :return: bytes transferred, size of the file (None if not known), algorithm -> hex digest of the file
+                 (empty for a segmented download)
+        """
+        if restart:
+            self._discard(part)
+
+        with self._host_slot(url):
+            reported, ranges = self._probe(url)
+
+        size = size if size is not None else reported
+
+        hashers = {Checksum.algorithm(): Checksum.hasher()}
+
+        if digest:
+            hashers[digest[0]] = _new_hasher(digest[0])
+
+        # segments arrive out of order and could only be hashed by reading the file again, so a file with a
+        # digest to check is streamed in order
+        count = min(self.segments, size // self.segment_size) if ranges and size and not digest else 1
+
+        if count > 1:
+            nbytes = self._segmented(url, part, size, count)
+
+            # checked by its size only, and hashed when a comparison first needs it
+            return nbytes, size, dict()
+
+        else:
+            # a single stream cannot resume a segmented partial file
+            if os.path.exists(part + '.json'):
+                self._discard(part)
+
+            with self._host_slot(url):
+                nbytes, size = self._stream(url, part, size, ranges, hashers)
+
+        return nbytes, size, dict((name, h.hexdigest()) for name, h in hashers.items())
+
+    @staticmethod
+    def _verify(part: str, size: int, digest: tuple, digests: dict) -> bool:
+        """
+        Check the size and digest of a partial file. A failing file is left in place: an incomplete one to be
+        resumed, a wrong one to be looked at (it is downloaded again from the start)
+        :param part: Full path of the partial file
+        :param size: Expected size, None if not known
+        :param digest: Expected (hashlib algorithm or 'cksum', digest), or None
+        :param digests: algorithm -> hex digest of the partial file
+        :return:
+        """
+        actual = os.path.getsize(part)
+
+        if size is not None and actual < size:
+            logger.error("Incomplete: %s has %d of %d bytes, kept to resume", part, actual, size)
+
+            return False
+
+        if size is not None and actual > size:
+            logger.error("Size mismatch: %s has %d bytes, expected %d", part, actual, size)
+
+            return False
+
+        if digest and digests[digest[0]] != digest[1].lower():
+            logger.error("%s mismatch: %s", digest[0], part)
+
+            return False
+
+        return True
+
+    @staticmethod
+    def _discard(part: str) -> None:
+        """Remove a partial file and its segment state"""
+        for path in (part, part + '.json'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _record(self, url: str, outfile: str, size: int, digest: tuple, digests: dict) -> None:
+        """Append a verified download to the manifest"""
+        if self.manifest is None:
+            return
+
+        st = os.stat(outfile)
+
+        # what the file was checked against: the expected digest's algorithm, else its size
+        verified = digest[0] if digest else 'size' if size is not None else None
+
+        entry = {'path': os.path.abspath(outfile), 'url': url, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                 'verified': verified}
+
+        entry.update(digests)
+
+        with self._lock:
+            with open(self.manifest, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def fetch(self, url: str, outfile: str, size: int = None, digest: tuple = None,
+              cksum_url: str = None) -> DownloadResult:
+        """
+        Download one URL to a file, in the calling thread
+        :param url: URL to download
+        :param outfile: Full path of the file to write
+        :param size: Expected size in bytes, default is the size reported by the server
+        :param digest: Expected (hashlib algorithm or 'cksum', digest), e.g. ("md5", "d41d8c...")
+        :param cksum_url: URL of a published checksum of the file, used for the size and digest not given
+        :return:
+        """
+        if os.path.exists(outfile):
+            logger.warning("File already exists: %s", outfile)
+
+            return DownloadResult(url, outfile, 'exists', 0, 0.0)
+
+        outdir = os.path.dirname(outfile)
+        if outdir and not os.path.exists(outdir):
+            logger.warning("Create directory %s", outdir)
+            os.makedirs(outdir, exist_ok=True)
+
+        if cksum_url:
+            cksum_size, cksum_digest = self.fetch_cksum(cksum_url)
+
+            size = size if size is not None else cksum_size
+            digest = digest or cksum_digest
+
+        part = outfile + '.part'
+
+        start = time.time()
+        logger.info('Download %s', url)
+
+        nbytes = 0
+
+        restart = False
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 60))
+
+                logger.warning("Retry %d of %d: %s", attempt, self.retries, url)
+
+            try:
+                got, expected, digests = self._attempt(url, part, size, digest, restart)
+
+                nbytes += got
+
+            # raw reads raise urllib3's errors for connections dropped mid-transfer
+            except (requests.RequestException, TransferError, OSError) as exc:
+                logger.error("Could not download %s, Response: %s", url, exc)
+
+                continue
+
+            if self._verify(part, expected, digest, digests):
+                if expected is None and not digest:
+                    logger.warning("Not verified: no size or checksum known for %s", url)
+
+                break
+
+            # all of it arrived but it is wrong, so it cannot be resumed
+            restart = expected is None or os.path.getsize(part) >= expected
+
+        else:
+            return DownloadResult(url, outfile, 'failed', nbytes, time.time() - start)
+
+        os.replace(part, outfile)
+
+        if os.path.exists(part + '.json'):
+            os.remove(part + '.json')
+
+        # comparisons of this file can use the hash computed while it was written
+        if Checksum.algorithm() in digests:
+            Checksum.seed(outfile, digests[Checksum.algorithm()])
+
+        self._record(url, outfile, expected, digest, digests)
+
+        secs = time.time() - start
+
+        logger.info('%s (%3.2f (MB) %3.2f (MB/s))', outfile, nbytes / 1e6, nbytes / 1e6 / max(secs, 1e-9))
+
+        return DownloadResult(url, outfile, 'downloaded', nbytes, secs)
+
+    def wait(self) -> list:
+        """
+        Wait for every queued download and log the aggregate throughput
+        :return: DownloadResult of every download queued so far, in order
+        """
+        results = [future.result() for future in self.futures]
+
+        self.futures = list()
+
+        if results:
+            secs = time.time() - self._t0
+            nbytes = sum(r.bytes for r in results)
+            counts = dict((s, sum(r.status == s for r in results)) for s in ('downloaded', 'exists', 'failed'))
+
+            logger.warning("Downloaded %3.2f MB in %3.1f s (%3.2f MB/s): %s", nbytes / 1e6, secs,
+                           nbytes / 1e6 / max(secs, 1e-9), counts)
+
+            for r in results:
+                if r.status == 'failed':
+                    logger.error("Failed: %s", r.url)
+
+        self._t0 = None
+
+        return results
+
+    def close(self) -> list:
+        """
+        Wait for every queued download and release the threads and connections
+        :return: DownloadResult of the downloads not yet waited for
+        """
+        results = self.wait()
+
+        self.executor.shutdown()
+        self.session.close()
+
+        return results
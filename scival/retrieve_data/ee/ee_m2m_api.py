@@ -8,7 +8,8 @@ from functools import reduce
 
 import requests
 
-from scival import __location__, util, logger
+from scival import __location__, logger
+from scival.retrieve_data.downloader import Downloader, MANIFEST
 
 
 def fmt_body(data=None):
@@ -79,7 +80,7 @@ def create_urls(url, token, dataset, entities):
     ]
 
 
-def download_search(search_name, dir_out, username, ee_env='ops'):
+def download_search(search_name, dir_out, username, ee_env='ops', workers=4):
     """Search and download via machine-to-machine inventory interface.
 
     Args:
@@ -87,6 +88,7 @@ def download_search(search_name, dir_out, username, ee_env='ops'):
         outdir (str): path to store downloaded data
         username (str): earthexplorer username, with download approval
         ee_env (str): environment to work from (i.e. ops, tst, dev)
+        workers (int): number of concurrent downloads
 
     """
     body = read_search(search_name)
@@ -94,7 +96,8 @@ def download_search(search_name, dir_out, username, ee_env='ops'):
     token = login(url=host, username=username,
                   password=getpass.getpass('EE password (%s@%s): '
                                            % (username, host)))
-    for url in create_urls(host, token, body['datasetName'],
-                           search(host, token, body)):
-        util.download(url, os.path.join(dir_out, os.path.basename(url)
-                                        .split('?')[0]))
+    with Downloader(workers=workers, manifest=os.path.join(dir_out, MANIFEST)) as downloader:
+        for url in create_urls(host, token, body['datasetName'],
+                               search(host, token, body)):
+            downloader.submit(url, os.path.join(dir_out, os.path.basename(url)
+                                                .split('?')[0]))
@@ -7,7 +7,6 @@ then by order note."""
 import os
 import ast
 import getpass
-import time
 import datetime
 import json
 from typing import Union
@@ -16,6 +15,7 @@ from pprint import pprint
 import requests
 
 from scival.retrieve_data.espa import api_config
+from scival.retrieve_data.downloader import Downloader, MANIFEST
 from scival import logger
 
 
@@ -45,97 +45,102 @@ def get_espa_env(env_in: str) -> str:
     return api_config.espa_env[env_in]
 
 
-def check_order_status(product_id: str, base_url: str, username: str, password: str) -> Union[bool, str]:
+def check_order_status(product_id: str, base_url: str, username: str, password: str,
+                       session: requests.Session = None) -> Union[bool, str]:
     """
     Get information regarding whether or not an order is complete, return False if the order is incomplete
     :param product_id: The product ID
     :param base_url: ESPA URL for a specific environment
     :param username: ESPA username
     :param password: ESPA password
+    :param session: Session to send the request on, default is a new connection
     :return:
     """
-    r = requests.get(url=base_url + api_config.api_urls["status"] + product_id,
-                     auth=(username, password))
+    r = (session or requests).get(url=base_url + api_config.api_urls["status"] + product_id,
+                                  auth=(username, password))
 
-    if "msg" in r.json():
+    r_json = r.json()
+
+    if "msg" in r_json:
         print("Error: order not found.")
 
-        print("Return info: {}".format(r.json()))
+        print("Return info: {}".format(r_json))
 
         return False
 
     else:
-        r_info = r.json()[product_id]
-
-        prod_stat = list()
-
-        for oid in range(len(r_info)):
-            prod_stat.append(str(r.json()[product_id][oid]["status"]))
+        prod_stat = [str(item["status"]) for item in r_json[product_id]]
 
         if all(status == "complete" for status in prod_stat):
             print("Orders complete and ready to download.")
 
-            return r.json()
+            return r_json
 
         else:
             print("An error has occurred or orders have not yet finished.")
 
             pprint(prod_stat)
 
-            pprint(r.json())
+            pprint(r_json)
 
             return False
 
 
-def retrieve_order(outdir: str, order_url: str):
+def order_subdir(scene_ids: list) -> str:
     """
-    Download the order
-    :param outdir: Full path to the order download folder
-    :param order_url: Order download URL
+    Name of the sub-directory an order is downloaded to, from the scene/product IDs in the order
+    :param scene_ids: Names of the items in the order
     :return:
     """
-    order_id = order_url.split("/")[-1]
+    if len(scene_ids) > 2:
+        return "multiple_" + scene_ids[0]
 
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
+    elif len(scene_ids) > 1:
+        sid_sort = sorted(scene_ids)
 
-    outfile = outdir + os.sep + order_id
+        return sid_sort[0] + "_" + sid_sort[1]
 
-    print("Initiating download...")
+    return scene_ids[0]
 
-    t = time.time()
 
-    resp = requests.get(order_url, stream=True)
+def retrieve_order(outdir: str, order_url: str, downloader: Downloader = None, cksum_url: str = None):
+    """
+    Download the order
+    :param outdir: Full path to the order download folder
+    :param order_url: Order download URL
+    :param downloader: Queue the download here instead of downloading it now
+    :param cksum_url: URL of the published checksum the download is verified against
+    :return:
+    """
+    order_id = order_url.split("/")[-1]
 
-    print(resp.status_code)
+    outfile = outdir + os.sep + order_id
 
-    if resp.status_code == "ordered" or resp.status_code == 200:
-        print("Starting download...")
+    if downloader is not None:
+        downloader.submit(order_url, outfile, cksum_url=cksum_url)
 
-        with open(outfile, "wb") as f:
-            for chunk in resp.iter_content(chunk_size=2048):
-                f.write(chunk)
+        return None
 
-            if os.path.exists(outfile):
-                print(os.path.getsize(outfile) / 1024 / (time.time() - t) / 1024)
+    with Downloader(workers=1, manifest=os.path.join(outdir, MANIFEST)) as downloader:
+        result = downloader.fetch(order_url, outfile, cksum_url=cksum_url)
 
-    else:
+    if result.status == 'failed':
         print("Could not download {}".format(order_url))
 
-        print("Error {}".format(str(resp.status_code)))
-
-    print("Download of {} complete.".format(order_id))
+    else:
+        print("Download of {} complete.".format(order_id))
 
     return None
 
 
-def get_orders(txt_in: str, outdir: str, username: str, espa_env: str):
+def get_orders(txt_in: str, outdir: str, username: str, espa_env: str, workers: int = 4):
     """
 
     :param txt_in: The full path and filename of the input txt file containing the ESPA orders
     :param outdir: The full path to the output directory where orders will download to
     :param username: ESPA user name
     :param espa_env: ESPA environment
+    :param workers: Number of concurrent downloads
     :return:
     """
     if not os.path.exists(outdir):
@@ -159,6 +164,8 @@ def get_orders(txt_in: str, outdir: str, username: str, espa_env: str):
 
     espa_url = get_espa_env(espa_env)
 
+    downloader = Downloader(workers=workers, manifest=os.path.join(outdir, MANIFEST))
+
     for order in order_list:
 
         if order["status"] == "failed" or order["status"] == 400:
@@ -178,6 +185,7 @@ def get_orders(txt_in: str, outdir: str, username: str, espa_env: str):
 
                 scene_id = list()
                 dl_url = list()
+                cksum_url = list()
 
                 order_info = requests.get(espa_url + api_config.api_urls["order"] + order[u"orderid"],
                                           auth=(username, passwd))
@@ -191,21 +199,14 @@ def get_orders(txt_in: str, outdir: str, username: str, espa_env: str):
 
                     dl_url.append(j["product_dload_url"])
 
-                if len(scene_id) > 2:
-                    ord_sid = "multiple_" + scene_id[0]
+                    cksum_url.append(j.get("cksum_download_url") or None)
 
-                elif len(scene_id) > 1:
-                    sid_sort = sorted(scene_id)
+                ord_sid = order_subdir(scene_id)
 
-                    ord_sid = sid_sort[0] + "_" + sid_sort[1]
-
-                else:
-                    ord_sid = scene_id[0]
-
-                for url in dl_url:
+                for url, cksum in zip(dl_url, cksum_url):
                     output_dir = outdir + os.sep + ord_sid + os.sep + note
 
-                    retrieve_order(output_dir, url)
+                    retrieve_order(output_dir, url, downloader, cksum)
 
             else:
                 print("Could not retrieve order {}.".format(order[u"orderid"]))
@@ -224,6 +225,9 @@ def get_orders(txt_in: str, outdir: str, username: str, espa_env: str):
             except KeyError:
                 pass
 
+    # finish the downloads still in flight
+    downloader.close()
+
     print("Error orders (400): {}".format(failed_list))
     print("Why orders failed: {}".format(failed_msg_list))
 
@@ -0,0 +1,263 @@
+"""Watch ESPA orders until they finish, downloading each item as soon as it is complete.
+
+Every order in an order file is polled on a small thread pool over one shared session.
+An order that made no progress since its last poll waits twice as long before the
+next one (up to a maximum), so long-running orders cost few requests while finished
+items are still picked up quickly. Completed items are queued on a Downloader, so
+downloads overlap with the processing still running on the ESPA side.
+"""
+
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from scival.retrieve_data.espa import api_config, espa_orders_api
+from scival.retrieve_data.downloader import Downloader, MANIFEST
+from scival import logger
+
+
+# item statuses after which ESPA does no more work on an item
+FINAL_STATUS = ("complete", "error", "unavailable", "cancelled", "purged")
+
+# requests (connect, read) timeout in seconds of a status request
+POLL_TIMEOUT = (10, 60)
+
+
+class OrderState:
+    """Polling state of one order"""
+
+    def __init__(self, order_id: str, interval: float):
+        self.order_id = order_id
+        self.delay = interval
+        self.due = 0.0
+        self.items = dict()
+        self.queued = set()
+        self.note = None
+        self.done = False
+
+
+def poll_order(session: requests.Session, espa_url: str, order_id: str, note: str = None,
+               timeout=POLL_TIMEOUT) -> tuple:
+    """
+    Get the items of an order, and the order note the first time
+    :param session: Authenticated session
+    :param espa_url: ESPA URL for a specific environment
+    :param order_id: The order ID
+    :param note: Order note, if already known
+    :param timeout: requests (connect, read) timeout in seconds of each request
+    :return: list of items, order note
+    """
+    r = session.get(espa_url + api_config.api_urls["status"] + order_id, timeout=timeout)
+
+    r.raise_for_status()
+
+    r_json = r.json()
+
+    if order_id not in r_json:
+        raise ValueError("Order {0} not found: {1}".format(order_id, r_json))
+
+    if note is None:
+        r = session.get(espa_url + api_config.api_urls["order"] + order_id, timeout=timeout)
+
+        r.raise_for_status()
+
+        note = str(r.json()["product_opts"]["note"]).capitalize()
+
+    return r_json[order_id], note
+
+
+def _update(state: OrderState, items: list, note: str, outdir: str, downloader: Downloader,
+            interval: float, max_interval: float, on_download=None, skip=None) -> None:
+    """
+    Record a poll of an order, queue newly completed items and schedule the next poll
+    :param state: Polling state of the order
+    :param items: Items returned by the item-status request
+    :param note: Order note
+    :param outdir: Full path to the output directory
+    :param downloader: Downloader the completed items are queued on
+    :param interval: Seconds between polls of an order that is making progress
+    :param max_interval: Maximum seconds between polls
+    :param on_download: Callable receiving (item name, Future of the DownloadResult) of each queued item
+    :param skip: Callable receiving an item name, True if the item need not be downloaded
+    :return:
+    """
+    state.note = note
+
+    if not items:
+        # nothing will ever be processed or downloaded for an order without items
+        logger.error("Order %s has no items", state.order_id)
+
+        state.done = True
+
+        return
+
+    output_dir = os.path.join(outdir, espa_orders_api.order_subdir([item["name"] for item in items]), note)
+
+    progress = False
+
+    for item in items:
+        status = str(item["status"])
+
+        if state.items.get(item["name"]) != status:
+            logger.info("Order %s: %s is %s", state.order_id, item["name"], status)
+            progress = True
+
+        state.items[item["name"]] = status
+
+        url = item.get("product_dload_url")
+
+        if status == "complete" and url and url not in state.queued:
+            state.queued.add(url)
+
+            if skip is not None and skip(item["name"]):
+                logger.info("Order %s: %s is already done, not downloaded", state.order_id, item["name"])
+
+                continue
+
+            future = downloader.submit(url, os.path.join(output_dir, url.split("/")[-1]),
+                                       cksum_url=item.get("cksum_download_url") or None)
+
+            if on_download is not None:
+                on_download(item["name"], future)
+
+    state.done = all(status in FINAL_STATUS for status in state.items.values())
+
+    if state.done:
+        logger.warning("Order %s finished: %d of %d items complete", state.order_id,
+                       sum(status == "complete" for status in state.items.values()), len(state.items))
+
+    _backoff(state, progress, interval, max_interval)
+
+
+def _retryable(exc: Exception) -> bool:
+    """
+    Check whether a failed status request is worth repeating: timeouts, connection errors, 429 and 5xx
+    responses are; an unknown order, another 4xx response or a malformed order are not
+    :param exc: Exception raised by poll_order
+    :return:
+    """
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        code = exc.response.status_code
+
+        return code == 429 or code >= 500
+
+    return isinstance(exc, requests.RequestException)
+
+
+def _backoff(state: OrderState, progress: bool, interval: float, max_interval: float) -> None:
+    """Poll again after the base interval if the order moved, otherwise double the delay"""
+    state.delay = interval if progress else min(state.delay * 2, max_interval)
+
+    state.due = time.time() + state.delay
+
+
+def watch_orders(txt_in: str, outdir: str, username: str, espa_env: str, workers: int = 4, pollers: int = 4,
+                 interval: float = 60, max_interval: float = 1800, passwd: str = None,
+                 downloader: Downloader = None, on_download=None, timeout=POLL_TIMEOUT, skip=None) -> dict:
+    """
+    Poll every order in an order file until all of its items are finished, downloading items as they complete
+    :param txt_in: The full path and filename of the input txt file containing the ESPA orders
+    :param outdir: The full path to the output directory where orders will download to
+    :param username: ESPA user name
+    :param espa_env: ESPA environment
+    :param workers: Number of concurrent downloads
+    :param pollers: Number of concurrent status requests
+    :param interval: Seconds between polls of an order that is making progress
+    :param max_interval: Maximum seconds between polls of an order
+    :param passwd: ESPA password, default is to ask for it
+    :param downloader: Queue downloads here (and leave them running) instead of on a Downloader of our own
+    :param on_download: Callable receiving (item name, Future of the DownloadResult) of each queued item
+    :param timeout: requests (connect, read) timeout in seconds of a status request
+    :param skip: Callable receiving an item name, True if the item need not be downloaded
+    :return: order ID -> {item name: status}
+    """
+    with open(txt_in) as f:
+        order_list = json.load(f)
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    espa_url = espa_orders_api.get_espa_env(espa_env)
+
+    states = dict()
+
+    for order in order_list:
+        if order.get("status") in ("ordered", 200) and "orderid" in order:
+            states[order["orderid"]] = OrderState(order["orderid"], interval)
+
+        else:
+            logger.error("Skip order that was not placed: %s", order)
+
+    session = requests.Session()
+    session.auth = (username, passwd or espa_orders_api.espa_login())
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pollers))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    t0 = espa_orders_api.get_time()
+
+    logger.warning("Watching %d orders", len(states))
+
+    pending = dict()
+
+    own_downloader = downloader is None
+
+    if own_downloader:
+        downloader = Downloader(workers=workers, manifest=os.path.join(outdir, MANIFEST))
+
+    with ThreadPoolExecutor(max_workers=max(1, pollers)) as executor:
+        while not all(state.done for state in states.values()):
+            now = time.time()
+
+            for state in states.values():
+                if not state.done and state not in pending.values() and state.due <= now:
+                    pending[executor.submit(poll_order, session, espa_url, state.order_id, state.note,
+                                            timeout)] = state
+
+            if pending:
+                next_due = min([state.due for state in states.values()
+                                if not state.done and state not in pending.values()] or [now + max_interval])
+
+                finished, _ = wait(list(pending), timeout=max(0.0, next_due - time.time()),
+                                   return_when=FIRST_COMPLETED)
+
+            else:
+                time.sleep(max(0.0, min(state.due for state in states.values() if not state.done) - time.time()))
+
+                finished = list()
+
+            for future in finished:
+                state = pending.pop(future)
+
+                try:
+                    items, note = future.result()
+
+                except (requests.RequestException, ValueError, KeyError) as exc:
+                    if not _retryable(exc):
+                        logger.error("Giving up on order %s: %s", state.order_id, exc)
+
+                        state.done = True
+
+                        continue
+
+                    logger.error("Could not get the status of order %s: %s", state.order_id, exc)
+
+                    _backoff(state, False, interval, max_interval)
+
+                    continue
+
+                _update(state, items, note, outdir, downloader, interval, max_interval, on_download, skip)
+
+    if own_downloader:
+        downloader.close()
+
+    session.close()
+
+    logger.warning("Processing time: {}".format(espa_orders_api.get_time() - t0))
+
+    return dict((order_id, state.items) for order_id, state in states.items())
@@ -0,0 +1,218 @@
+""" Timing spans for profiling a QA run
+
+Spans are nested, timed sections of work (a stage, a file pair, a band)
+that may carry the bytes read and pixels processed. When tracing is
+enabled, every process appends its finished spans to its own fragment
+file; `finish` merges the fragments into a Chrome trace-event file
+(open it in chrome://tracing or https://ui.perfetto.dev) and a per-stage
+summary table. When tracing is disabled `span` returns a shared no-op
+object, so instrumented code pays only for one function call.
+"""
+
+import os
+import csv
+import json
+import glob
+import time
+import threading
+
+# tracing is enabled in this process and in every process started after
+# `enable` while this variable names the fragment directory
+ENV = 'ESPA_SCIVAL_TRACE_DIR'
+
+# finished spans are flushed once this many are buffered, or whenever a
+# thread leaves its outermost span
+FLUSH_EVERY = 1000
+
+_dir = os.environ.get(ENV)
+_events = list()
+_events_pid = [os.getpid()]
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NoSpan:
+    """Stand-in returned while tracing is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, nbytes=0, pixels=0, **args):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    """A timed section of work, recorded as a Chrome "complete" event"""
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.nbytes = 0
+        self.pixels = 0
+
+    def add(self, nbytes=0, pixels=0, **args):
+        """Count bytes and pixels handled in this span, and attach extra arguments"""
+        self.nbytes += nbytes
+        self.pixels += pixels
+        self.args.update(args)
+
+    def __enter__(self):
+        # a forked worker also starts inside its parent's open spans
+        if getattr(_local, 'pid', None) != os.getpid():
+            _local.pid = os.getpid()
+            _local.depth = 0
+
+        _local.depth += 1
+
+        self.t0 = time.time()
+
+        return self
+
+    def __exit__(self, *exc):
+        t1 = time.time()
+
+        _local.depth -= 1
+
+        args = dict(self.args, bytes=self.nbytes, pixels=self.pixels)
+
+        if exc[0] is not None:
+            args['error'] = repr(exc[1])
+
+        event = {'name': self.name, 'cat': self.cat, 'ph': 'X',
+                 'ts': int(self.t0 * 1e6), 'dur': int((t1 - self.t0) * 1e6),
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+
+        with _lock:
+            # a forked worker starts with a copy of its parent's buffer
+            if _events_pid[0] != event['pid']:
+                del _events[:]
+                _events_pid[0] = event['pid']
+
+            _events.append(event)
+
+            if _local.depth == 0 or len(_events) >= FLUSH_EVERY:
+                _flush()
+
+        return False
+
+
+def enabled():
+    return _dir is not None
+
+
+def span(name, cat='stage', **args):
+    """Time a section of work
+
+    :param name: Name of the span, e.g. the stage ("read", "diff")
+    :param cat: Category, e.g. "stage", "pair" or "band"
+    :param args: Extra values recorded with the span (e.g. file names)
+    :return: Context manager; call .add(nbytes=, pixels=) on it to count work
+    """
+    if _dir is None:
+        return _NO_SPAN
+
+    return Span(name, cat, args)
+
+
+def enable(dir_out):
+    """Turn tracing on for this process and the processes it starts
+
+    :param dir_out: Directory the trace is written to
+    :return:
+    """
+    global _dir
+
+    _dir = os.path.join(dir_out, 'trace_fragments')
+
+    if not os.path.exists(_dir):
+        os.makedirs(_dir)
+
+    for fn in glob.glob(os.path.join(_dir, '*.jsonl')):
+        os.remove(fn)
+
+    os.environ[ENV] = _dir
+
+
+def _flush():
+    """Append the buffered spans to this process' fragment (caller holds the lock)"""
+    if not _events:
+        return
+
+    with open(os.path.join(_dir, 'trace_{0}.jsonl'.format(os.getpid())), 'a') as f:
+        for event in _events:
+            f.write(json.dumps(event) + '\n')
+
+    del _events[:]
+
+
+def summarize(events):
+    """Total time, bytes and pixels per span name
+
+    :param events: Chrome trace events
+    :return: Rows of name, category, count, seconds, mean ms, max ms, MB, MB/s, pixels, pixels/s
+    """
+    totals = dict()
+
+    for event in events:
+        key = (event['name'], event['cat'])
+        count, dur, dur_max, nbytes, pixels = totals.get(key, (0, 0, 0, 0, 0))
+
+        totals[key] = (count + 1, dur + event['dur'], max(dur_max, event['dur']),
+                       nbytes + event['args'].get('bytes', 0), pixels + event['args'].get('pixels', 0))
+
+    rows = list()
+
+    for (name, cat), (count, dur, dur_max, nbytes, pixels) in sorted(totals.items(), key=lambda t: -t[1][1]):
+        secs = dur / 1e6
+
+        rows.append([name, cat, count, round(secs, 6), round(dur / 1e3 / count, 3), round(dur_max / 1e3, 3),
+                     round(nbytes / 1e6, 3), round(nbytes / 1e6 / secs, 3) if secs else '',
+                     pixels, round(pixels / secs, 1) if secs else ''])
+
+    return rows
+
+
+def finish(dir_out):
+    """Merge the fragments of every process into trace.json and trace_summary.csv, and turn tracing off
+
+    :param dir_out: Directory given to `enable`
+    :return:
+    """
+    global _dir
+
+    if _dir is None:
+        return
+
+    with _lock:
+        _flush()
+
+    events = list()
+
+    for fn in sorted(glob.glob(os.path.join(_dir, '*.jsonl'))):
+        with open(fn) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+
+        os.remove(fn)
+
+    os.rmdir(_dir)
+
+    events.sort(key=lambda e: (e['ts'], -e['dur']))
+
+    with open(os.path.join(dir_out, 'trace.json'), 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    with open(os.path.join(dir_out, 'trace_summary.csv'), 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['name', 'category', 'count', 'seconds', 'mean_ms', 'max_ms', 'mb', 'mb_per_s',
+                         'pixels', 'pixels_per_s'])
+        writer.writerows(summarize(events))
+
+    _dir = None
+    os.environ.pop(ENV, None)
@@ -1,13 +1,11 @@
 """ Utilities for host system interaction """
 
 import os
-import time
 import sys
 import logging
 import datetime
 
 import urllib3
-import requests
 
 from . import logger
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -35,39 +33,16 @@ def setup_logger(verbosity, stream='stderr'):
 
 
 def download(url: str, outfile: str):
-    """Download the order.
+    """Download a single file; see retrieve_data.downloader.Downloader for
+    downloading many files concurrently over one session.
 
-    :param order_url: Order download URL
-    :param outdir: Full path to the order download folder
-    :return:
+    :param url: Download URL
+    :param outfile: Full path of the file to write
+    :return: DownloadResult
     """
+    from scival.retrieve_data.downloader import Downloader, MANIFEST
 
-    if os.path.exists(outfile):
-        logger.warning("File already exists: %s", outfile)
-        return
+    manifest = os.path.join(os.path.dirname(os.path.abspath(outfile)), MANIFEST)
 
-    outdir = os.path.dirname(outfile)
-    if not os.path.exists(outdir):
-        logger.warning("Create directory %s", outdir)
-        os.makedirs(outdir)
-
-    start = time.time()
-    logger.info('Download %s', url)
-    resp = requests.get(url, timeout=3,
-                        stream=True, verify=False,
-                        allow_redirects=True)
-
-    try:
-        bytes_in_mb = 1024*1024
-        with open(outfile, "wb") as f:
-            for chunk in resp.iter_content(chunk_size=bytes_in_mb):
-                if chunk:
-                    f.write(chunk)
-        if os.path.exists(outfile):
-            ns = time.time() - start
-            mb = os.path.getsize(outfile)/float(bytes_in_mb)
-            logger.info('%s (%3.2f (MB) %3.2f (MB/s))',
-                        outfile, mb, mb/ns)
-        logger.info("Download of %s complete.", outfile)
-    except Exception as exc:
-        logger.error("Could not download %s, Response: %s", url, exc)
+    with Downloader(workers=1, manifest=manifest) as downloader:
+        return downloader.fetch(url, outfile)
@@ -0,0 +1,559 @@
+"""benchmark.py
+
+Purpose: generate synthetic master/test trees with GDAL and measure the
+         throughput of the qa compare pipeline, end to end and stage by
+         stage (extract, open, read, diff, stats, plot). Results are
+         reported as JSON with MB/s, pixels/s and peak memory: the most
+         allocated at once by each stage (tracemalloc), and the peak RSS of
+         each complete run, made in a fresh process.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    import gdal
+    import osr
+
+from scival.validate_data.file_io import Extract, Find, ImWrite
+from scival.validate_data.image_io import RasterIO
+from scival.validate_data.qa_images import do_diff
+from scival.validate_data.qa import qa_data
+from scival.validate_data import stats
+from scival import logger
+
+
+NODATA = -9999
+
+# ESPA XML namespace
+ESPA_NS = "http://espa.cr.usgs.gov/v2"
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process or of the largest of its (finished) children, in MB. The peak never
+    goes down, so it only describes a run made in a fresh process.
+    :return:
+    """
+    scale = 1.0 if sys.platform == "darwin" else 1024.0
+
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    return rss * scale / (1024.0 * 1024.0)
+
+
+def synthetic_bands(rows: int, cols: int, bands: int, diff_density: float, nodata_frac: float, seed: int) -> tuple:
+    """
+    Make master and test int16 bands; the test differs from the master in a fraction of the valid pixels
+    :param rows: Number of rows
+    :param cols: Number of columns
+    :param bands: Number of bands
+    :param diff_density: Fraction of pixels that differ between master and test
+    :param nodata_frac: Fraction of pixels set to NoData (same pixels in both)
+    :param seed: Random seed
+    :return: (master, test) arrays of shape (bands, rows, cols)
+    """
+    rng = np.random.RandomState(seed)
+
+    mast = rng.randint(0, 10000, size=(bands, rows, cols)).astype(np.int16)
+
+    mast[rng.random_sample(mast.shape) < nodata_frac] = NODATA
+
+    test = mast.copy()
+
+    changed = (rng.random_sample(test.shape) < diff_density) & (test != NODATA)
+
+    test[changed] += rng.randint(-50, 51, size=int(changed.sum())).astype(np.int16)
+
+    return mast, test
+
+
+def _georeference(ds, rows: int) -> None:
+    """Give a synthetic dataset a UTM grid"""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32613)
+
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform((500000.0, 30.0, 0.0, 4000000.0 + rows * 30.0, 0.0, -30.0))
+
+
+def write_gtiff(path: str, data: np.ndarray) -> None:
+    """
+    Write a single-band GeoTIFF
+    :param path: Output file
+    :param data: 2-d array
+    :return:
+    """
+    rows, cols = data.shape
+
+    ds = gdal.GetDriverByName("GTiff").Create(path, cols, rows, 1, gdal.GDT_Int16, ["TILED=YES"])
+    _georeference(ds, rows)
+
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(data)
+
+    ds = None
+
+
+def write_envi(path: str, data: np.ndarray, interleave: str = "BSQ") -> None:
+    """
+    Write a multi-band ENVI .img (with its .hdr)
+    :param path: Output .img file
+    :param data: 3-d array (bands, rows, cols)
+    :param interleave: BSQ, BIL or BIP
+    :return:
+    """
+    bands, rows, cols = data.shape
+
+    ds = gdal.GetDriverByName("ENVI").Create(path, cols, rows, bands, gdal.GDT_Int16,
+                                             ["INTERLEAVE={0}".format(interleave)])
+    _georeference(ds, rows)
+
+    for ii in range(bands):
+        band = ds.GetRasterBand(ii + 1)
+        band.SetNoDataValue(NODATA)
+        band.WriteArray(data[ii])
+
+    ds = None
+
+
+def write_sds(path: str, data: np.ndarray) -> bool:
+    """
+    Write a NetCDF container with one subdataset per band. Needs GDAL's multidimensional API (GDAL >= 3.1).
+    :param path: Output .nc file
+    :param data: 3-d array (bands, rows, cols)
+    :return: False if NetCDF containers cannot be written with this GDAL
+    """
+    drv = gdal.GetDriverByName("netCDF")
+
+    if drv is None or not hasattr(drv, "CreateMultiDimensional"):
+        logger.warning("GDAL cannot write multidimensional NetCDF; skipping SDS containers.")
+
+        return False
+
+    bands, rows, cols = data.shape
+
+    ds = drv.CreateMultiDimensional(path)
+    root = ds.GetRootGroup()
+
+    dim_y = root.CreateDimension("y", None, None, rows)
+    dim_x = root.CreateDimension("x", None, None, cols)
+
+    for ii in range(bands):
+        arr = root.CreateMDArray("sds_{0}".format(ii), [dim_y, dim_x],
+                                 gdal.ExtendedDataType.Create(gdal.GDT_Int16))
+        arr.SetNoDataValueDouble(NODATA)
+        arr.Write(data[ii])
+
+    ds = None
+
+    return True
+
+
+def write_jpeg(path: str, data: np.ndarray) -> None:
+    """
+    Write an 8-bit RGB JPEG preview of a band
+    :param path: Output file
+    :param data: 2-d array
+    :return:
+    """
+    rows, cols = data.shape
+
+    preview = (np.clip(data, 0, 10000) // 40).astype(np.uint8)
+
+    mem = gdal.GetDriverByName("MEM").Create("", cols, rows, 3, gdal.GDT_Byte)
+
+    for ii in range(3):
+        mem.GetRasterBand(ii + 1).WriteArray(preview)
+
+    gdal.GetDriverByName("JPEG").CreateCopy(path, mem, 0, ["QUALITY=90"])
+
+    mem = None
+
+
+def write_xml(path: str, scene: str, band_files: list, production_date: str) -> None:
+    """
+    Write ESPA-style XML metadata
+    :param path: Output file
+    :param scene: Scene name
+    :param band_files: File names of the bands
+    :param production_date: Production date written to every band
+    :return:
+    """
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<espa_metadata version="2.0" xmlns="{0}">'.format(ESPA_NS),
+             '    <global_metadata>',
+             '        <data_provider>USGS/EROS</data_provider>',
+             '        <satellite>LANDSAT_8</satellite>',
+             '        <instrument>OLI/TIRS_Combined</instrument>',
+             '        <scene_id>{0}</scene_id>'.format(scene),
+             '        <bounding_coordinates>',
+             '            <west>-105.000000</west>',
+             '            <east>-104.500000</east>',
+             '            <north>36.500000</north>',
+             '            <south>36.000000</south>',
+             '        </bounding_coordinates>',
+             '    </global_metadata>',
+             '    <bands>']
+
+    for ii, fn in enumerate(band_files):
+        lines += ['        <band product="sr_refl" source="toa_refl" name="{0}" category="image" '
+                  'data_type="INT16" fill_value="{1}" scale_factor="0.000100" add_offset="0.000000">'
+                  .format(os.path.splitext(fn)[0], NODATA),
+                  '            <short_name>LC08SR</short_name>',
+                  '            <long_name>band {0} surface reflectance</long_name>'.format(ii + 1),
+                  '            <file_name>{0}</file_name>'.format(fn),
+                  '            <pixel_size x="30" y="30" units="meters"/>',
+                  '            <data_units>reflectance</data_units>',
+                  '            <valid_range min="-2000.000000" max="16000.000000"/>',
+                  '            <app_version>LaSRC_1.4.0</app_version>',
+                  '            <production_date>{0}</production_date>'.format(production_date),
+                  '        </band>']
+
+    lines += ['    </bands>', '</espa_metadata>', '']
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def write_mtl(path: str, scene: str, production_date: str) -> None:
+    """
+    Write a Landsat MTL-style text file
+    :param path: Output file
+    :param scene: Scene name
+    :param production_date: Production date
+    :return:
+    """
+    with open(path, "w") as f:
+        f.write("GROUP = L1_METADATA_FILE\n"
+                "  GROUP = METADATA_FILE_INFO\n"
+                "    LANDSAT_PRODUCT_ID = \"{0}\"\n"
+                "    FILE_DATE = {1}\n"
+                "  END_GROUP = METADATA_FILE_INFO\n"
+                "END_GROUP = L1_METADATA_FILE\n"
+                "END\n".format(scene, production_date))
+
+
+def make_scene(scene_dir: str, scene: str, data: np.ndarray, production_date: str, interleave: str = "BSQ") -> list:
+    """
+    Write one synthetic ESPA-like scene: one GeoTIFF per band, a multi-band ENVI file, a NetCDF SDS
+    container, XML and MTL metadata and a JPEG preview
+    :param scene_dir: Output directory of the scene
+    :param scene: Scene name
+    :param data: 3-d array (bands, rows, cols)
+    :param production_date: Production date written to the metadata
+    :param interleave: Interleave of the ENVI file
+    :return: Names of the files written
+    """
+    if not os.path.exists(scene_dir):
+        os.makedirs(scene_dir)
+
+    files = list()
+
+    for ii in range(data.shape[0]):
+        fn = "{0}_sr_band{1}.tif".format(scene, ii + 1)
+        write_gtiff(os.path.join(scene_dir, fn), data[ii])
+        files.append(fn)
+
+    write_envi(os.path.join(scene_dir, scene + "_sr.img"), data, interleave)
+    files += [scene + "_sr.img", scene + "_sr.hdr"]
+
+    if write_sds(os.path.join(scene_dir, scene + "_sr.nc"), data):
+        files.append(scene + "_sr.nc")
+
+    write_xml(os.path.join(scene_dir, scene + ".xml"), scene, files[:data.shape[0]], production_date)
+    write_mtl(os.path.join(scene_dir, scene + "_MTL.txt"), scene, production_date)
+    write_jpeg(os.path.join(scene_dir, scene + "_preview.jpg"), data[0])
+
+    files += [scene + ".xml", scene + "_MTL.txt", scene + "_preview.jpg"]
+
+    return files
+
+
+def make_tree(root: str, scenes: int = 2, rows: int = 1000, cols: int = 1000, bands: int = 3,
+              diff_density: float = 0.01, nodata_frac: float = 0.1, interleave: str = "BSQ") -> dict:
+    """
+    Generate master and test trees of loose files, and the same scenes as .tar.gz and as uncompressed .tar archives
+    :param root: Working directory
+    :param scenes: Number of scenes
+    :param rows: Number of rows per band
+    :param cols: Number of columns per band
+    :param bands: Number of bands per scene
+    :param diff_density: Fraction of pixels that differ between master and test
+    :param nodata_frac: Fraction of pixels set to NoData
+    :param interleave: Interleave of the ENVI files
+    :return: Paths of the "files", "archives" (.tar.gz) and "tars" (.tar) master/test roots
+    """
+    tree = {"files": (os.path.join(root, "files", "master"), os.path.join(root, "files", "test")),
+            "archives": (os.path.join(root, "archives", "master"), os.path.join(root, "archives", "test")),
+            "tars": (os.path.join(root, "tars", "master"), os.path.join(root, "tars", "test"))}
+
+    for ii in range(scenes):
+        scene = "LC08_L1TP_{0:03d}034_20150815_20170226_01_T1".format(ii)
+
+        mast, test = synthetic_bands(rows, cols, bands, diff_density, nodata_frac, seed=ii)
+
+        for side, data, date in ((0, mast, "2017-02-26T00:00:00Z"), (1, test, "2018-06-01T00:00:00Z")):
+            scene_dir = os.path.join(tree["files"][side], scene)
+
+            files = make_scene(scene_dir, scene, data, date, interleave)
+
+            for kind, suffix, mode in (("archives", ".tar.gz", "w:gz"), ("tars", ".tar", "w")):
+                arc_dir = os.path.join(tree[kind][side], scene)
+                if not os.path.exists(arc_dir):
+                    os.makedirs(arc_dir)
+
+                with tarfile.open(os.path.join(arc_dir, scene + suffix), mode) as tar:
+                    for fn in files:
+                        tar.add(os.path.join(scene_dir, fn), arcname=fn)
+
+    return tree
+
+
+class Stage:
+    """Accumulate time, bytes, pixels and peak allocated memory of one pipeline stage"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes = 0
+        self.pixels = 0
+        self.count = 0
+        self.peak = 0
+
+    @staticmethod
+    def start() -> float:
+        """Trace the allocations of one call of the stage, from nothing allocated"""
+        tracemalloc.stop()
+        tracemalloc.start()
+
+        return time.time()
+
+    def add(self, t0: float, nbytes: int = 0, pixels: int = 0) -> None:
+        self.seconds += time.time() - t0
+        self.bytes += nbytes
+        self.pixels += pixels
+        self.count += 1
+
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+
+        tracemalloc.stop()
+
+    def report(self) -> dict:
+        secs = max(self.seconds, 1e-9)
+
+        return {"stage": self.name,
+                "calls": self.count,
+                "seconds": round(self.seconds, 6),
+                "mb": round(self.bytes / 1e6, 3),
+                "mb_per_s": round(self.bytes / 1e6 / secs, 3),
+                "pixels": self.pixels,
+                "pixels_per_s": round(self.pixels / secs, 1),
+                "peak_alloc_mb": round(self.peak / 1e6, 1)}
+
+
+def bench_stages(tree: dict, dir_out: str) -> list:
+    """
+    Time each stage of a comparison separately, over every raster pair of the trees
+    :param tree: Roots returned by make_tree
+    :param dir_out: Directory for plots
+    :return: One report per stage
+    """
+    stages = [Stage(name) for name in ("extract", "open", "read", "diff", "stats", "plot")]
+    extract, open_, read, diff, stat, plot = stages
+
+    # extract every archive next to itself, then remove the extracted files again
+    for arc_root in tree["archives"]:
+        for archive in Find.find_files(arc_root, ".tar.gz"):
+            t0 = extract.start()
+            files = Extract._extract(archive)
+            extract.add(t0, sum(os.path.getsize(f) for f in files))
+
+            for f in files:
+                os.remove(f)
+
+    dir_mast, dir_test = tree["files"]
+
+    for ext in (".tif", ".img", ".nc"):
+        for mast in Find.find_files(dir_mast, ext):
+            test = mast.replace(dir_mast, dir_test, 1)
+
+            t0 = open_.start()
+            ds_mast = RasterIO.open_raster(mast)
+            ds_test = RasterIO.open_raster(test)
+            open_.add(t0, os.path.getsize(mast) + os.path.getsize(test))
+
+            if ext == ".nc":
+                pairs = [(RasterIO.open_raster(t[0]), RasterIO.open_raster(m[0]))
+                         for t, m in zip(RasterIO.get_sds(ds_test), RasterIO.get_sds(ds_mast))]
+                bands = [(t, m, 1) for t, m in pairs]
+
+            else:
+                bands = [(ds_test, ds_mast, ii + 1) for ii in range(ds_mast.RasterCount)]
+
+            for ii, (t_ds, m_ds, band_no) in enumerate(bands):
+                t0 = read.start()
+                t_arr = t_ds.GetRasterBand(band_no).ReadAsArray()
+                m_arr = m_ds.GetRasterBand(band_no).ReadAsArray()
+                read.add(t0, t_arr.nbytes + m_arr.nbytes, t_arr.size + m_arr.size)
+
+                t0 = diff.start()
+                d_arr = do_diff(t_arr, m_arr, nodata=NODATA)
+                diff.add(t0, t_arr.nbytes + m_arr.nbytes, t_arr.size)
+
+                t0 = stat.start()
+                acc = stats.DiffStats()
+                acc.update(d_arr)
+                acc.row()
+                stat.add(t0, d_arr.nbytes, d_arr.size)
+
+                if acc.count:
+                    t0 = plot.start()
+                    ImWrite.plot_diff_images(test, mast, d_arr, os.path.basename(test), ii, dir_out)
+                    plot.add(t0, d_arr.nbytes, d_arr.size)
+
+    return [stage.report() for stage in stages]
+
+
+def _run_qa(conn, dir_mast: str, dir_test: str, dir_out: str, archive: bool, in_place: bool, workers: int,
+            window_size: int) -> None:
+    """Run qa_data in a fresh process and send back its runtime and peak RSS"""
+    t0 = time.time()
+    qa_data(dir_mast, dir_test, dir_out, archive=archive, window_size=window_size, workers=workers,
+            in_place=in_place, resume=False)
+    secs = time.time() - t0
+
+    conn.send((secs, peak_rss_mb()))
+    conn.close()
+
+
+def bench_end_to_end(tree: dict, work_dir: str, workers: int = 1, window_size: int = None) -> list:
+    """
+    Time complete qa_data runs over the loose files, the .tar.gz archives (extracted) and the .tar and .tar.gz
+    archives (in place). Each run is made in a new process, so its peak RSS is its own.
+    :param tree: Roots returned by make_tree
+    :param work_dir: Working directory for results
+    :param workers: Number of processes for qa_data
+    :param window_size: Window size for qa_data
+    :return: One report per mode
+    """
+    raster_bytes = sum(os.path.getsize(f) for root in tree["files"] for ext in (".tif", ".img", ".nc")
+                       for f in Find.find_files(root, ext))
+
+    raster_pixels = 0
+    for ext in (".tif", ".img"):
+        for f in Find.find_files(tree["files"][0], ext):
+            ds = RasterIO.open_raster(f)
+            raster_pixels += 2 * ds.RasterXSize * ds.RasterYSize * ds.RasterCount
+
+    ctx = multiprocessing.get_context("spawn")
+
+    reports = list()
+
+    for mode, (dir_mast, dir_test), archive, in_place in (("files", tree["files"], False, False),
+                                                          ("archive", tree["archives"], True, False),
+                                                          ("in_place", tree["tars"], True, True),
+                                                          ("in_place_gz", tree["archives"], True, True)):
+        dir_out = os.path.join(work_dir, "results_" + mode)
+
+        recv, send = ctx.Pipe(duplex=False)
+
+        proc = ctx.Process(target=_run_qa, args=(send, dir_mast, dir_test, dir_out, archive, in_place, workers,
+                                                 window_size))
+        proc.start()
+        send.close()
+
+        try:
+            secs, rss = recv.recv()
+
+        except EOFError:
+            proc.join()
+
+            raise RuntimeError("qa_data failed in mode {0} (exit code {1})".format(mode, proc.exitcode))
+
+        proc.join()
+
+        secs = max(secs, 1e-9)
+
+        reports.append({"mode": mode,
+                        "seconds": round(secs, 6),
+                        "mb_per_s": round(raster_bytes / 1e6 / secs, 3),
+                        "pixels_per_s": round(raster_pixels / secs, 1),
+                        "peak_rss_mb": round(rss, 1)})
+
+    return reports
+
+
+def run_benchmark(work_dir: str = None, report: str = None, scenes: int = 2, rows: int = 1000, cols: int = 1000,
+                  bands: int = 3, diff_density: float = 0.01, nodata_frac: float = 0.1, interleave: str = "BSQ",
+                  workers: int = 1, window_size: int = None, keep: bool = False) -> dict:
+    """
+    Generate synthetic data and benchmark the qa compare pipeline
+    :param work_dir: Working directory, default is a new temporary directory
+    :param report: Path of the JSON report, default is None (stdout)
+    :param scenes: Number of scenes
+    :param rows: Number of rows per band
+    :param cols: Number of columns per band
+    :param bands: Number of bands per scene
+    :param diff_density: Fraction of pixels that differ between master and test
+    :param nodata_frac: Fraction of pixels set to NoData
+    :param interleave: Interleave of the ENVI files
+    :param workers: Number of processes for the end to end runs
+    :param window_size: Window size for the end to end runs
+    :param keep: If True, keep the generated data
+    :return: The report
+    """
+    tmp = work_dir is None
+    if tmp:
+        work_dir = tempfile.mkdtemp(prefix="scival_bench_")
+
+    elif not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    config = {"scenes": scenes, "rows": rows, "cols": cols, "bands": bands, "diff_density": diff_density,
+              "nodata_fraction": nodata_frac, "interleave": interleave, "workers": workers,
+              "window_size": window_size, "gdal": gdal.__version__}
+
+    logger.warning("Generating synthetic data in {0}: {1}".format(work_dir, config))
+
+    try:
+        tree = make_tree(os.path.join(work_dir, "data"), scenes, rows, cols, bands, diff_density, nodata_frac,
+                         interleave)
+
+        plots = os.path.join(work_dir, "stage_plots")
+        if not os.path.exists(plots):
+            os.makedirs(plots)
+
+        result = {"config": config,
+                  "stages": bench_stages(tree, plots),
+                  "end_to_end": bench_end_to_end(tree, work_dir, workers, window_size)}
+
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir if tmp else os.path.join(work_dir, "data"), ignore_errors=True)
+
+    out = json.dumps(result, indent=2)
+
+    if report:
+        with open(report, "w") as f:
+            f.write(out + "\n")
+
+        logger.warning("Benchmark report written to {0}".format(report))
+
+    else:
+        print(out)
+
+    return result
@@ -1,70 +1,704 @@
 """Various methods for interacting with files"""
 
+import io
+import re
 import sys
 import os
 import tarfile
-import time
 import fnmatch
 import shutil
+import sqlite3
+import hashlib
 import itertools
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-from scival import logger
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from scival import logger, trace
+
+
+# read size used when streaming files through a hash
+HASH_CHUNK = 4 * 1024 * 1024
+
+# (path, size, mtime_ns) -> digest, for the current process
+_hash_cache = dict()
+
+# (pid, connection) of the persistent hash cache
+_hash_db = [None, None]
+
+# path of the persistent hash cache set by Checksum.use_cache, e.g. in the QA output directory
+_hash_db_path = [None]
+
+_HASH_TABLE = ("CREATE TABLE IF NOT EXISTS hashes (path TEXT, size INTEGER, mtime INTEGER, "
+               "algorithm TEXT, digest TEXT, PRIMARY KEY (path, size, mtime, algorithm))")
+
+# longest side, in pixels, that difference images are decimated to before
+# plotting (about the image area of a default figure at 250 dpi)
+PLOT_PIXELS = 1200
+
+# reusable Agg figures, by purpose, for the current process
+_figures = dict()
+
+# GDAL virtual file system prefix for files inside tar archives
+VSI_TAR = "/vsitar/"
+
+# splits "/vsitar/<archive>/<member>" into archive and member
+_vsi_tar_re = re.compile(r"^/vsitar/(.+?\.(?:tar|tar\.gz|tgz))/(.+)$")
+
+# archive -> {member name: (size, mtime, offset of its data)} from one pass
+# over the tar headers, for the current process
+_tar_index = dict()
+
+# size, mtime (ns) and extension of a regular file, as found by DirIndex
+FileStat = namedtuple('FileStat', ['size', 'mtime', 'ext'])
+
+# full path -> FileStat of every file indexed by a DirIndex of the current
+# process, so Archive.stat (and with it the manifest and the hash cache) does
+# not stat the files again
+_file_stat = dict()
+
+# members of compressed archives kept in memory by the pass that indexes them
+# (text, XML and JPEG files up to STREAM_LIMIT bytes), so they are read
+# without decompressing the archive again
+STREAM_EXT = (".txt", ".xml", ".gtf", ".hdr", ".stats", ".jpg")
+STREAM_LIMIT = 64 * 1024 * 1024
+
+# compressed archive -> {member name: bytes}, for the STREAM_ARCHIVES most
+# recently indexed archives of the current process
+_member_data = OrderedDict()
+STREAM_ARCHIVES = 8
 
 
 class Extract:
     @staticmethod
-    def unzip_files(tests: list, masts: list) -> None:
+    def _preflight(archive: str) -> int:
         """
-        Extract files from archives in sorted order
-        :param tests: List of paths to the test .tar archives
-        :param masts: List of paths to the master .tar archives
+        Check an archive can be read and count the bytes it extracts to: the sizes of the members are summed
+        from the tar headers, streamed through the decompressor for a .tar.gz (the gzip trailer only holds the
+        size modulo 4 GiB, of the last member of the stream)
+        :param archive: Full path to the .tar/.tar.gz archive
+        :return: Number of bytes the archive extracts to
+        """
+        size = os.path.getsize(archive)
+
+        logger.info("{0} is {1} MB...\n".format(archive, size * 0.000001))
+
+        if size == 0:
+            raise IOError("Archive {0} is of zero size!".format(archive))
+
+        if not archive.endswith('gz'):
+            return sum(member[0] for member in Archive.index(archive).values())
+
+        with trace.span("preflight", cat="archive", archive=archive), tarfile.open(archive, 'r|gz') as tar:
+            return sum(member.size for member in tar if member.isfile())
+
+    @staticmethod
+    def _extract(archive: str) -> list:
+        """
+        Extract an archive next to itself
+        :param archive: Full path to the .tar/.tar.gz archive
+        :return: Paths of the extracted files
+        """
+        mode = 'r:gz' if archive.endswith('gz') else 'r'
+
+        path = os.path.dirname(archive)
+
+        with trace.span("extract", archive=archive) as sp, tarfile.open(archive, mode) as tar:
+            members = tar.getmembers()
+
+            tar.extractall(path=path, members=members)
+
+            sp.add(nbytes=sum(member.size for member in members if member.isfile()))
+
+        return sorted(os.path.join(path, member.name) for member in members if member.isfile())
+
+    @staticmethod
+    def check_space(archives: list, workers: int = 2) -> None:
+        """
+        Make sure every file system has room for the archives extracted onto it, before any bytes are written
+        :param archives: List of paths to the .tar archives
+        :param workers: Number of archives to read headers from concurrently
         :return:
         """
-        print('Warning: decompressing files. Make sure you have the necessary '
-              'disk space to complete this operation...\n')
+        needed = dict()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sizes = executor.map(Extract._preflight, archives)
+
+            try:
+                for archive, size in zip(archives, sizes):
+                    path = os.path.dirname(os.path.abspath(archive))
+
+                    dev = os.stat(path).st_dev
 
-        time.sleep(5)
+                    needed[dev] = (path, needed.get(dev, (path, 0))[1] + size)
 
+            except Exception as exc:
+                logger.critical("Problem with archive file(s): %s", str(exc))
+
+                sys.exit(1)
+
+        for path, size in needed.values():
+            free = shutil.disk_usage(path).free
+
+            logger.info("Extracting {0} MB onto {1} ({2} MB free)".format(size * 0.000001, path, free * 0.000001))
+
+            if size > free:
+                logger.critical("Not enough disk space to extract archives onto {0}: need {1} MB, {2} MB free"
+                                .format(path, size * 0.000001, free * 0.000001))
+
+                sys.exit(1)
+
+        return None
+
+    @staticmethod
+    def unzip_files(tests: list, masts: list, workers: int = 2, on_extracted=None) -> None:
+        """
+        Extract files from archives in sorted order. Master and test archives are extracted concurrently on a
+        bounded pool, after checking there is enough free disk space for all of them.
+        :param tests: List of paths to the test .tar archives
+        :param masts: List of paths to the master .tar archives
+        :param workers: Number of archives to extract concurrently
+        :param on_extracted: Called as on_extracted(test_files, mast_files) in this thread as soon as both
+                             archives of a pair are extracted, while later archives are still decompressing
+        :return:
+        """
         # Make sure the lists are sorted
         masts.sort()
 
         tests.sort()
 
-        for mast, test in zip(masts, tests):
+        Extract.check_space(masts + tests, workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pairs = [(mast, test, executor.submit(Extract._extract, mast), executor.submit(Extract._extract, test))
+                     for mast, test in zip(masts, tests)]
+
+            for mast, test, fut_mast, fut_test in pairs:
+                try:
+                    mast_files = fut_mast.result()
+
+                    test_files = fut_test.result()
+
+                except Exception as exc:
+                    logger.critical("Problem extracting contents from archive files:"
+                                     "%s and %s. %s", mast, test, str(exc))
+
+                    continue
+
+                logger.info("Extracted {0} and {1}".format(mast, test))
+
+                if on_extracted is not None:
+                    on_extracted(test_files, mast_files)
+
+        return None
+
+
+class _MemberReader(io.BufferedReader):
+    """Stream of a single archive member that also closes its archive (a member of a compressed archive that
+    was too large to keep in memory)"""
+
+    def __init__(self, tar, member):
+        super().__init__(tar.extractfile(member))
+
+        self._tar = tar
+
+    def close(self):
+        try:
+            super().close()
+
+        finally:
+            self._tar.close()
+
+
+class _MemberSlice(io.RawIOBase):
+    """Stream of a member of an uncompressed tar, read directly from its offset in the archive"""
+
+    def __init__(self, archive, offset, size):
+        super().__init__()
+
+        self._f = open(archive, "rb")
+        self._f.seek(offset)
+        self._left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._left <= 0:
+            return 0
+
+        n = self._f.readinto(memoryview(b)[:self._left])
+
+        self._left -= n
+
+        return n
+
+    def close(self):
+        try:
+            self._f.close()
+
+        finally:
+            super().close()
+
+
+class Archive:
+    @staticmethod
+    def compressed(archive: str) -> bool:
+        """
+        Check whether an archive is compressed; a member of a compressed archive cannot be read without
+        decompressing the archive from its start
+        :param archive: Full path to the .tar/.tar.gz archive
+        :return:
+        """
+        return not archive.endswith(".tar")
+
+    @staticmethod
+    def index(archive: str) -> dict:
+        """
+        Size, mtime and data offset of every regular file in an archive, read once per process. Only the headers
+        of an uncompressed tar are read; a compressed archive is streamed once ("r|*"), keeping its text, XML and
+        JPEG members in memory on the way.
+        :param archive: Full path to the .tar/.tar.gz archive
+        :return: member name -> (size, mtime, offset)
+        """
+        archive = os.path.abspath(archive)
+
+        if archive not in _tar_index:
+            if Archive.compressed(archive):
+                Archive._stream(archive)
+
+            else:
+                with tarfile.open(archive) as tar:
+                    _tar_index[archive] = OrderedDict((member.name, (member.size, int(member.mtime),
+                                                                     member.offset_data))
+                                                      for member in tar if member.isfile())
+
+        return _tar_index[archive]
+
+    @staticmethod
+    def _stream(archive: str) -> None:
+        """
+        Index a compressed archive in one decompressing pass, and keep its small text, XML and JPEG members in
+        memory (evicting those of the least recently streamed archive)
+        :param archive: Full path to the .tar.gz archive
+        :return:
+        """
+        index = OrderedDict()
+
+        data = dict()
+
+        with trace.span("stream", cat="archive", archive=archive), tarfile.open(archive, "r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                index[member.name] = (member.size, int(member.mtime), member.offset_data)
+
+                if member.size <= STREAM_LIMIT and os.path.splitext(member.name)[1].lower() in STREAM_EXT:
+                    data[member.name] = tar.extractfile(member).read()
+
+        _tar_index[archive] = index
+
+        _member_data[archive] = data
+
+        while len(_member_data) > STREAM_ARCHIVES:
+            _member_data.popitem(last=False)
+
+    @staticmethod
+    def vsi_path(archive: str, member: str) -> str:
+        """
+        GDAL virtual file system path of an archive member. /vsitar/ reads
+        both plain and gzip compressed tar archives.
+        :param archive: Full path to the .tar/.tar.gz archive
+        :param member: Name of the member inside the archive
+        :return:
+        """
+        return VSI_TAR + os.path.abspath(archive) + "/" + member
+
+    @staticmethod
+    def split_vsi(path: str):
+        """
+        Split a /vsitar/ path into (archive, member), None for regular files
+        :param path: File path
+        :return:
+        """
+        match = _vsi_tar_re.match(path)
+
+        return match.groups() if match else None
+
+    @staticmethod
+    def compare_paths(archive: str) -> list:
+        """
+        Paths to compare the files of an archive by, in place: rasters are opened through /vsitar/ (GDAL keeps
+        a seek index of a gzip stream), other members are read from their offset in an uncompressed tar, or from
+        memory for a compressed one
+        :param archive: Full path to the .tar/.tar.gz archive
+        :return:
+        """
+        return Archive.list_members(archive)
+
+    @staticmethod
+    def list_members(archive: str) -> list:
+        """
+        List the regular files in an archive, from the tar headers only, as /vsitar/ paths
+        :param archive: Full path to the .tar/.tar.gz archive
+        :return:
+        """
+        out_files = [Archive.vsi_path(archive, name) for name in Archive.index(archive)]
+
+        if len(out_files) == 0:
+            logger.critical("No files found in archive {0}".format(archive))
+
+        return sorted(out_files)
+
+    @staticmethod
+    def stat(path: str) -> tuple:
+        """
+        Get (size, mtime) of a regular file (as found by the DirIndex that listed it, if any) or an archive member
+        :param path: File path or /vsitar/ path
+        :return:
+        """
+        parts = Archive.split_vsi(path)
+
+        if parts is None:
+            known = _file_stat.get(os.path.abspath(path))
+
+            if known is not None:
+                return known.size, known.mtime
+
+            st = os.stat(path)
+
+            return st.st_size, st.st_mtime_ns
+
+        return Archive.index(parts[0])[parts[1]][:2]
+
+    @staticmethod
+    def getsize(path: str) -> int:
+        """
+        Size in bytes of a regular file or an archive member
+        :param path: File path or /vsitar/ path
+        :return:
+        """
+        return Archive.stat(path)[0]
+
+    @staticmethod
+    def open_file(path: str, mode: str = "r"):
+        """
+        Open a regular file, or an archive member without extracting it to disk: from its offset in an
+        uncompressed tar, or from memory for a text, XML or JPEG member of a compressed archive (any other member
+        of a compressed archive is decompressed from the start of the archive)
+        :param path: File path or /vsitar/ path
+        :param mode: "r" (text) or "rb"
+        :return:
+        """
+        parts = Archive.split_vsi(path)
+
+        if parts is None:
+            return open(path, mode)
+
+        if Archive.compressed(parts[0]):
+            archive = os.path.abspath(parts[0])
+
+            # streamed again if another archive evicted its members since it was indexed
+            if archive not in _member_data and os.path.splitext(parts[1])[1].lower() in STREAM_EXT:
+                Archive._stream(archive)
+
+            data = _member_data.get(archive, dict()).get(parts[1])
+
+            if data is not None:
+                stream = io.BytesIO(data)
+
+            else:
+                stream = _MemberReader(tarfile.open(parts[0]), parts[1])
+
+        else:
+            size, _, offset = Archive.index(parts[0])[parts[1]]
+
+            stream = io.BufferedReader(_MemberSlice(parts[0], offset, size))
+
+        if "b" in mode:
+            return stream
+
+        return io.TextIOWrapper(stream)
+
+
+class Checksum:
+    @staticmethod
+    def algorithm() -> str:
+        """
+        Name of the hash used for content comparisons (xxh3 if xxhash is installed, else blake2b)
+        :return:
+        """
+        return "xxh3_128" if xxhash is not None else "blake2b"
+
+    @staticmethod
+    def hasher():
+        """
+        New hash object of the algorithm used for content comparisons
+        :return:
+        """
+        return xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b()
+
+    @staticmethod
+    def use_cache(path: str) -> None:
+        """
+        Keep hashes in a persistent cache at a path (ESPA_SCIVAL_CACHE, if set, takes precedence), for this
+        process and the workers it starts afterwards
+        :param path: Full path to the cache file, e.g. hashes.sqlite in the QA output directory
+        :return:
+        """
+        if _hash_db[0] == os.getpid() and _hash_db[1] is not None:
+            _hash_db[1].close()
+
+        _hash_db_path[0] = path
+
+        _hash_db[0], _hash_db[1] = None, None
+
+    @staticmethod
+    def cache_path():
+        """
+        Path to the persistent hash cache: ESPA_SCIVAL_CACHE, else the one set by use_cache, else None (hashes
+        are only kept in memory)
+        :return:
+        """
+        return os.environ.get("ESPA_SCIVAL_CACHE", _hash_db_path[0])
+
+    @staticmethod
+    def _db():
+        """
+        Open (once per process) the persistent hash cache, None if unavailable or not configured
+        :return:
+        """
+        if _hash_db[0] == os.getpid():
+            return _hash_db[1]
+
+        path = Checksum.cache_path()
+
+        conn = None
+        try:
+            if path is not None:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+                conn = sqlite3.connect(path, timeout=60)
+                conn.execute(_HASH_TABLE)
+                conn.commit()
+
+        except (OSError, sqlite3.Error) as exc:
+            logger.warning("Hash cache not available, hashes will not persist: {0}".format(exc))
+
+            conn = None
+
+        _hash_db[0], _hash_db[1] = os.getpid(), conn
+
+        return conn
+
+    @staticmethod
+    def _key(path: str) -> tuple:
+        """Cache key (path, size, mtime) of a file or archive member"""
+        if Archive.split_vsi(path) is None:
+            path = os.path.abspath(path)
+
+        return (path,) + Archive.stat(path)
+
+    @staticmethod
+    def cached_hash(path: str):
+        """
+        Get the hash of a file only if it is already cached for its current size and mtime, without reading it
+        :param path: Full path to the file, or a /vsitar/ archive member
+        :return: Digest, or None
+        """
+        key = Checksum._key(path)
+
+        if key in _hash_cache:
+            return _hash_cache[key]
+
+        db = Checksum._db()
+
+        if db is not None:
+            row = db.execute("SELECT digest FROM hashes WHERE path=? AND size=? AND mtime=? AND algorithm=?",
+                             key + (Checksum.algorithm(),)).fetchone()
+            if row is not None:
+                _hash_cache[key] = row[0]
+
+                return row[0]
+
+        return None
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        """
+        Hash a file in streaming chunks. Hashes are cached by (path, size, mtime) in memory and on disk,
+        so unchanged files are not re-read on later runs.
+        :param path: Full path to the file, or a /vsitar/ archive member
+        :return:
+        """
+        digest = Checksum.cached_hash(path)
+
+        if digest is not None:
+            return digest
+
+        key = Checksum._key(path)
+        path = key[0]
+
+        algo = Checksum.algorithm()
+        db = Checksum._db()
+
+        h = Checksum.hasher()
+
+        with Archive.open_file(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                h.update(chunk)
+
+        digest = h.hexdigest()
+        _hash_cache[key] = digest
+
+        if db is not None:
             try:
-                mode = 'r:gz' if mast.endswith('gz') else 'r'
-                tar_mast = tarfile.open(mast, mode)
-                tar_test = tarfile.open(test, mode)
+                db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", key + (algo, digest))
+                db.commit()
 
-                logger.info("{0} is {1} MB...\n".format(mast, os.path.getsize(mast) * 0.000001))
+            except sqlite3.Error as exc:
+                logger.debug("Could not cache hash of {0}: {1}".format(path, exc))
 
-                logger.info("{0} is {1} MB...\n".format(test, os.path.getsize(test) * 0.000001))
+        return digest
 
-                if os.path.getsize(mast) == 0:
-                    logger.critical("Archive {0} is of zero size!".format(mast))
+    @staticmethod
+    def seed(path: str, digest: str) -> None:
+        """
+        Cache the hash of a file computed elsewhere (e.g. while it was downloaded), so it is never read to hash it.
+        Safe to call from any thread: the disk cache is written on a connection of its own.
+        :param path: Full path to the file
+        :param digest: Digest of the file from Checksum.hasher()
+        :return:
+        """
+        key = Checksum._key(path)
 
-                    sys.exit(1)
+        _hash_cache[key] = digest
 
-                elif os.path.getsize(test) == 0:
-                    logger.critical("Archive {0} is of zero size!".format(test))
+        cache = Checksum.cache_path()
 
-                    sys.exit(1)
+        if cache is None:
+            return
 
-            except Exception as exc:
-                logger.critical("Problem with archive file(s): %s and %s. %s",
-                                mast, test, str(exc))
-                sys.exit(1)
+        try:
+            if not os.path.exists(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache), exist_ok=True)
+
+            conn = sqlite3.connect(cache, timeout=60)
 
             try:
-                tar_mast.extractall(path=os.path.dirname(mast))
+                conn.execute(_HASH_TABLE)
+                conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                             key + (Checksum.algorithm(), digest))
+                conn.commit()
 
-                tar_test.extractall(path=os.path.dirname(test))
+            finally:
+                conn.close()
 
-            except Exception as exc:
-                logger.critical("Problem extracting contents from archive files:"
-                                 "%s and %s. %s", mast, test, str(exc))
+        except (OSError, sqlite3.Error) as exc:
+            logger.debug("Could not cache hash of {0}: {1}".format(path, exc))
 
-        return None
+    @staticmethod
+    def identical(test: str, mast: str) -> bool:
+        """
+        Check whether two files are known to be byte-identical. Sizes are compared first; a file is only read to
+        hash it if the other one's hash is already cached (e.g. from its download or an earlier run), so a pair
+        with no cached hash is never read twice.
+        :param test: Full path to the test file
+        :param mast: Full path to the master file
+        :return: True if identical, False if different or not known
+        """
+        if Archive.getsize(test) != Archive.getsize(mast):
+            return False
+
+        test_digest, mast_digest = Checksum.cached_hash(test), Checksum.cached_hash(mast)
+
+        if test_digest is None and mast_digest is None:
+            return False
+
+        with trace.span("hash") as sp:
+            sp.add(nbytes=Archive.getsize(test) * ((test_digest is None) + (mast_digest is None)))
+
+            return (test_digest or Checksum.file_hash(test)) == (mast_digest or Checksum.file_hash(mast))
+
+
+class DirIndex:
+    """Every file below a directory, found in a single os.scandir pass, keyed by its path relative to the root,
+    with the size and mtime the scan found for it. Symlinked directories are not followed, so a link cycle cannot
+    recurse forever."""
+
+    def __init__(self, root: str):
+        """
+        :param root: The full path to the directory to index
+        """
+        self.root = root
+
+        # relative path -> full path
+        self.files = dict()
+
+        # relative path -> FileStat
+        self.stats = dict()
+
+        # relative directory -> relative paths of its files
+        self.by_dir = dict()
+
+        # relative directories without sub-directories (the "deepest" dirs)
+        self.leaves = list()
+
+        stack = [""]
+
+        while stack:
+            rel_dir = stack.pop()
+
+            names = list()
+
+            has_subdirs = False
+
+            for entry in os.scandir(os.path.join(root, rel_dir)):
+                rel = os.path.join(rel_dir, entry.name)
+
+                if entry.is_dir(follow_symlinks=False):
+                    has_subdirs = True
+
+                    stack.append(rel)
+
+                elif entry.is_symlink() and entry.is_dir():
+                    logger.warning("Not following symlinked directory {0}".format(entry.path))
+
+                elif entry.is_file():
+                    st = entry.stat()
+
+                    self.files[rel] = entry.path
+
+                    self.stats[rel] = FileStat(st.st_size, st.st_mtime_ns, os.path.splitext(entry.name)[1])
+
+                    _file_stat[os.path.abspath(entry.path)] = self.stats[rel]
+
+                    names.append(rel)
+
+            self.by_dir[rel_dir] = sorted(names)
+
+            if not has_subdirs:
+                self.leaves.append(rel_dir)
+
+        self.leaves.sort()
+
+        logger.info("Indexed {0} files in {1} directories below {2}".format(len(self.files), len(self.by_dir),
+                                                                           root))
+
+    def files_in(self, rel_dir: str) -> list:
+        """
+        Full paths of the files directly inside a directory
+        :param rel_dir: Directory relative to the root
+        :return:
+        """
+        return [self.files[rel] for rel in self.by_dir.get(rel_dir, [])]
 
 
 class Find:
@@ -87,6 +721,69 @@ class Find:
 
         return sorted(out_files)
 
+    @staticmethod
+    def filter_files(files: list, ext: str) -> list:
+        """
+        Select files by extension from an already listed set of files (same matching as find_files)
+        :param files: File paths, or /vsitar/ archive member paths
+        :param ext: The file type to look for
+        :return:
+        """
+        pattern = "*{}".format(ext)
+
+        return sorted(f for f in files if fnmatch.fnmatch(f.split("/")[-1], pattern))
+
+    @staticmethod
+    def pair_files(test_files: list, mast_files: list, unmatched: list = None) -> OrderedDict:
+        """
+        Pair test and master files by file name in one pass, and group the pairs by extension (.tar archives
+        are ignored, as in get_ext). Files without a counterpart are logged and left out.
+        :param test_files: Test file paths, or /vsitar/ archive member paths
+        :param mast_files: Master file paths, or /vsitar/ archive member paths
+        :param unmatched: If given, the files without a counterpart are appended to it as (test path, master path),
+                          with None for the side the file is missing from
+        :return: extension -> (test paths, master paths), paired by position and sorted by file name
+        """
+        mast_by_name = dict((f.split("/")[-1], f) for f in mast_files)
+
+        groups = dict()
+
+        only_test = list()
+
+        for t in test_files:
+            name = t.split("/")[-1]
+
+            if '.tar' in name:
+                continue
+
+            m = mast_by_name.pop(name, None)
+
+            if m is None:
+                only_test.append(t)
+
+                continue
+
+            groups.setdefault(os.path.splitext(name)[1], list()).append((name, t, m))
+
+        only_mast = sorted(m for name, m in mast_by_name.items() if '.tar' not in name)
+
+        if only_test or only_mast:
+            logger.warning("Files without a match, not compared: {0}".format(sorted(only_test + only_mast)))
+
+        if unmatched is not None:
+            unmatched.extend([(t, None) for t in sorted(only_test)] + [(None, m) for m in only_mast])
+
+        out = OrderedDict()
+
+        for ext in sorted(groups):
+            pairs = sorted(groups[ext])
+
+            out[ext] = ([t for _, t, _ in pairs], [m for _, _, m in pairs])
+
+        logger.info("Unique extensions: {0}".format(list(out)))
+
+        return out
+
     @staticmethod
     def get_ext(*args):
         """Get unique extensions for all extracted files. Ignore .tar files.
@@ -97,7 +794,7 @@ class Find:
 
         exts = []
         for i in args:
-            exts += [os.path.splitext(j)[1] for j in i if '.tar' not in j]
+            exts += [os.path.splitext(j)[1] for j in i if '.tar' not in os.path.basename(j)]
 
         logger.info("All extensions: {0}".format(exts))
         logger.info("Unique extensions: {0}".format(list(set(exts))))
@@ -189,50 +886,250 @@ class Find:
         return d_range
 
 
+def _max_abs_reduce(block, factor):
+    """Reduce an array by an integer factor, keeping the signed value of
+    largest magnitude in each factor x factor cell so isolated differences
+    stay visible.
+
+    Args:
+        block <numpy.ndarray>: 2-d array with both sides a multiple of factor
+        factor <int>: reduction factor
+    """
+    import numpy as np
+
+    rows, cols = block.shape
+
+    cells = block.reshape(rows // factor, factor, cols // factor, factor)
+
+    hi = cells.max(axis=(1, 3))
+    lo = cells.min(axis=(1, 3))
+
+    return np.where(-lo > hi, lo, hi)
+
+
+class Preview:
+    """Build a decimated (max-abs) copy of a difference raster one window at
+    a time, so windowed comparisons can still plot their differences.
+    """
+
+    def __init__(self, rows, cols, max_pixels=None):
+        """
+        Args:
+            rows <int>: number of rows of the full raster
+            cols <int>: number of columns of the full raster
+            max_pixels <int>: longest side of the preview (default=PLOT_PIXELS)
+        """
+        max_pixels = max_pixels or PLOT_PIXELS
+
+        self.factor = max(1, -(-max(rows, cols) // max_pixels))
+        self.shape = (-(-rows // self.factor), -(-cols // self.factor))
+        self.array = None
+
+    def update(self, window, diff):
+        """Fold a window of the difference raster into the preview.
+
+        Args:
+            window <tuple>: (xoff, yoff, xsize, ysize) of the window
+            diff <numpy.ndarray>: difference array of the window
+        """
+        import numpy as np
+
+        xoff, yoff, xsize, ysize = window
+        f = self.factor
+
+        if self.array is None:
+            self.array = np.zeros(self.shape, dtype=diff.dtype)
+
+        if yoff % f or xoff % f:
+            self._fold_padded(xoff, yoff, diff)
+
+            return
+
+        # reduce the cell-aligned part in place, pad only the ragged edges
+        rows, cols = ysize // f * f, xsize // f * f
+
+        if rows and cols:
+            self._fold(yoff // f, xoff // f, _max_abs_reduce(diff[:rows, :cols], f))
+
+        if rows < ysize:
+            self._fold_padded(xoff, yoff + rows, diff[rows:, :])
+
+        if cols < xsize and rows:
+            self._fold_padded(xoff + cols, yoff, diff[:rows, cols:])
+
+    def _fold_padded(self, xoff, yoff, diff):
+        """Pad a piece of the difference raster out to whole cells and fold
+        it into the preview."""
+        import numpy as np
+
+        f = self.factor
+        ysize, xsize = diff.shape
+
+        r0, c0 = yoff // f, xoff // f
+        top, left = yoff - r0 * f, xoff - c0 * f
+
+        block = np.zeros((-(-(top + ysize) // f) * f, -(-(left + xsize) // f) * f),
+                         dtype=diff.dtype)
+        block[top:top + ysize, left:left + xsize] = diff
+
+        self._fold(r0, c0, _max_abs_reduce(block, f))
+
+    def _fold(self, r0, c0, reduced):
+        """Merge reduced cells into the preview, keeping the larger magnitude
+        (cells on window edges are shared with neighbouring windows)."""
+        import numpy as np
+
+        current = self.array[r0:r0 + reduced.shape[0], c0:c0 + reduced.shape[1]]
+        current[...] = np.where(np.abs(reduced) > np.abs(current), reduced, current)
+
+
 class ImWrite:
     @staticmethod
-    def plot_diff_image(test, mast, diff_raster, fn_out, fn_type, dir_out,
-                        do_abs=False):
-        """Take difference array and plot as image.
+    def decimate(diff_raster, max_pixels=None):
+        """Downsample a difference array so its longest side fits the plot
+        pixel budget, using a max-abs reduction.
+
+        Args:
+            diff_raster <numpy.ndarray>: numpy array of values
+            max_pixels <int>: longest side of the output (default=PLOT_PIXELS)
+        """
+        import numpy as np
+
+        diff_raster = np.ma.filled(diff_raster, 0)
+
+        rows, cols = diff_raster.shape[:2]
+
+        factor = -(-max(rows, cols) // (max_pixels or PLOT_PIXELS))
+
+        if factor <= 1 or diff_raster.ndim != 2:
+            return diff_raster
+
+        logger.info("Decimating {0}x{1} difference by {2} for plotting.".format(rows, cols, factor))
+
+        preview = Preview(rows, cols, max_pixels)
+        preview.update((0, 0, cols, rows), diff_raster)
+
+        return preview.array
+
+    @staticmethod
+    def _figure(name):
+        """Get a cleared, reusable Agg figure (one per name and process),
+        instead of creating a new pyplot figure for every plot.
+
+        Args:
+            name <str>: purpose of the figure (e.g. "diff", "hist")
+        """
+        fig = _figures.get(name)
+
+        if fig is None:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+            fig = _figures[name] = Figure()
+            FigureCanvasAgg(fig)
+
+        fig.clf()
+
+        return fig
+
+    @staticmethod
+    def _draw_diff(test, mast, diff_raster, fn_out, im_out, shape,
+                   do_abs=False):
+        """Draw an already decimated difference array to a PNG.
 
         Args:
             test <str>: name of test file
             mast <str>: name of mast file
             diff_raster <numpy.ndarray>: numpy array of values
             fn_out <str>: basename for file
-            fn_type <str>: defines title of plot - "diff" or "pct_diff"
-            dir_out <str>: directory where output data are being stored
+            im_out <str>: path of the PNG
+            shape <tuple>: (rows, cols) of the full resolution array, used to
+                           label the axes in original pixel coordinates
+            do_abs <bool>: plot absolute differences (default=False)
         """
-        import matplotlib.pyplot as plt
         import numpy as np
 
+        fig = ImWrite._figure("diff")
+        ax = fig.add_subplot(111)
+
         # mask pixels that did not differ
         diff_raster = np.ma.masked_where(diff_raster == 0, diff_raster)
 
-        # make output file
-        im_out = dir_out + os.sep + fn_out + "_" + fn_type + ".png"
+        extent = (0, shape[1], shape[0], 0)
 
         # plot diff figure
         if do_abs:
-            plt.imshow(np.abs(diff_raster), cmap='gist_gray')
-            plt.colorbar(label="Abs. Difference")
+            im = ax.imshow(np.abs(diff_raster), cmap='gist_gray',
+                           interpolation='nearest', extent=extent)
+            fig.colorbar(im, ax=ax, label="Abs. Difference")
         else:
-            plt.imshow(diff_raster, cmap='PuOr')
-            plt.colorbar(label="Difference")
+            im = ax.imshow(diff_raster, cmap='PuOr',
+                           interpolation='nearest', extent=extent)
+            fig.colorbar(im, ax=ax, label="Difference")
 
         # annotate plot with file names
-        plt.annotate(str(mast) + "\n" +
-                     str(test) + "\n",
-                     fontsize=5,
-                     xy=(0.01, 0.94),
-                     xycoords='axes fraction')
+        ax.annotate(str(mast) + "\n" +
+                    str(test) + "\n",
+                    fontsize=5,
+                    xy=(0.01, 0.94),
+                    xycoords='axes fraction')
 
-        plt.title(fn_out, y=1.05)
-        plt.savefig(im_out, dpi=250)
-        plt.close()
+        ax.set_title(fn_out, y=1.05)
+        fig.savefig(im_out, dpi=250)
+        fig.clf()
+
+    @staticmethod
+    def plot_diff_image(test, mast, diff_raster, fn_out, fn_type, dir_out,
+                        do_abs=False):
+        """Take difference array and plot as image.
+
+        Args:
+            test <str>: name of test file
+            mast <str>: name of mast file
+            diff_raster <numpy.ndarray>: numpy array of values
+            fn_out <str>: basename for file
+            fn_type <str>: defines title of plot - "diff" or "pct_diff"
+            dir_out <str>: directory where output data are being stored
+        """
+        # make output file
+        im_out = dir_out + os.sep + fn_out + "_" + fn_type + ".png"
+
+        ImWrite._draw_diff(test, mast, ImWrite.decimate(diff_raster), fn_out,
+                           im_out, diff_raster.shape[:2], do_abs=do_abs)
 
         logger.warning("{0} raster written to {1}.".format(fn_type, im_out))
 
+    @staticmethod
+    def plot_diff_images(test, mast, diff_raster, fn_out, rast_num, dir_out,
+                         shape=None):
+        """Plot the difference and absolute difference images of a band from
+        a single decimation of the difference array.
+
+        Args:
+            test <str>: name of test file
+            mast <str>: name of mast file
+            diff_raster <numpy.ndarray>: numpy array of values
+            fn_out <str>: basename for file
+            rast_num <int>: individual number of image
+            dir_out <str>: directory where output data are being stored
+            shape <tuple>: (rows, cols) of the full resolution array if
+                           diff_raster is already decimated (default=None)
+        """
+        if shape is None:
+            shape = diff_raster.shape[:2]
+
+            diff_raster = ImWrite.decimate(diff_raster)
+
+        for fn_type, do_abs in (("diff_", False), ("abs_diff_", True)):
+            fn_type += str(rast_num)
+
+            im_out = dir_out + os.sep + fn_out + "_" + fn_type + ".png"
+
+            ImWrite._draw_diff(test, mast, diff_raster, fn_out, im_out, shape,
+                               do_abs=do_abs)
+
+            logger.warning("{0} raster written to {1}.".format(fn_type, im_out))
+
     @staticmethod
     def plot_hist(test, mast, diff_raster, fn_out, fn_type, dir_out,
                   bins=False):
@@ -247,7 +1144,6 @@ class ImWrite:
             dir_out <str>: directory where output data are being stored
             bins <int>: number of bins for histogram (default=255)
         """
-        import matplotlib.pyplot as plt
         import numpy as np
 
         def bin_size(rast):
@@ -280,9 +1176,12 @@ class ImWrite:
         if not bins:
             bins = bin_size(diff_raster)
 
+        fig = ImWrite._figure("hist")
+        ax = fig.add_subplot(111)
+
         # do histogram
         try:
-            plt.hist(diff_valid, bins)
+            ax.hist(diff_valid, bins)
         except AttributeError:
             logger.warning("Difference values from diff_valid variable could"
                             " not be plotted.")
@@ -293,30 +1192,30 @@ class ImWrite:
         diff_sd = np.std(diff_raster)
         diff_abs_mean = np.mean(np.abs(diff_raster))
         diff_pix = len(diff_valid)
-        diff_pct = (np.float(diff_pix) / np.product(np.shape(diff_raster))) \
+        diff_pct = (float(diff_pix) / np.prod(np.shape(diff_raster))) \
                    * 100.0
 
         # annotate plot with file names
-        plt.annotate(str(mast) + "\n" +
-                     str(test) + "\n",
-                     fontsize=5,
-                     xy=(0.01, 0.94),
-                     xycoords='axes fraction')
+        ax.annotate(str(mast) + "\n" +
+                    str(test) + "\n",
+                    fontsize=5,
+                    xy=(0.01, 0.94),
+                    xycoords='axes fraction')
 
         # annotate plot with basic stats
-        plt.annotate("mean diff: " + str(round(diff_mean, 3)) + "\n" +
-                     "std. dev.: " + str(round(diff_sd, 3)) + "\n" +
-                     "abs. mean diff: " + str(round(diff_abs_mean, 3)) + "\n" +
-                     "# diff pixels: " + str(diff_pix) + "\n" +
-                     "% diff: " + str(round(diff_pct, 3)) + "\n" +
-                     "# bins: " + str(bins) + "\n",
-                     xy=(0.68, 0.72),
-                     xycoords='axes fraction')
+        ax.annotate("mean diff: " + str(round(diff_mean, 3)) + "\n" +
+                    "std. dev.: " + str(round(diff_sd, 3)) + "\n" +
+                    "abs. mean diff: " + str(round(diff_abs_mean, 3)) + "\n" +
+                    "# diff pixels: " + str(diff_pix) + "\n" +
+                    "% diff: " + str(round(diff_pct, 3)) + "\n" +
+                    "# bins: " + str(bins) + "\n",
+                    xy=(0.68, 0.72),
+                    xycoords='axes fraction')
 
         # write figure out to PNG
-        plt.savefig(im_out, bbox_inches="tight", dpi=350)
+        fig.savefig(im_out, bbox_inches="tight", dpi=350)
 
-        plt.close()
+        fig.clf()
 
         logger.warning("Difference histogram written to {0}.".format(im_out))
 
@@ -349,11 +1248,10 @@ class Cleanup:
             :param m_names: master file names
             :return:
             """
-            fn_diffs = sorted(list(set(rm_fn(t_names))
-                                   .difference(set(rm_fn(m_names)))))
+            fn_diffs = set(rm_fn(t_names)).difference(rm_fn(m_names))
 
             if len(fn_diffs) > 0:
-                logger.warning("Files to be removed: {0}".format(fn_diffs))
+                logger.warning("Files to be removed: {0}".format(sorted(fn_diffs)))
 
             if len(fn_diffs) == 0:
                 return t_names
@@ -361,12 +1259,7 @@ class Cleanup:
             # get only file name
             test_fn = rm_fn(t_names)
 
-            rm = []
-            for ii in test_fn:
-                if ii in fn_diffs:
-                    rm.append(False)
-                else:
-                    rm.append(True)
+            rm = [ii not in fn_diffs for ii in test_fn]
 
             logger.debug("remove boolean: {0}".format(rm))
             logger.debug("test_fn: {0}".format(test_fn))
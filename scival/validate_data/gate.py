@@ -0,0 +1,277 @@
+"""gate.py
+
+Purpose: pass/fail gating of test rasters against master rasters. Bands are
+         read in windows and checked against absolute and relative
+         tolerances; a band stops being read at the first window that
+         exceeds them. No stats or plots are made. The verdict is written
+         to verdict.json in the results directory.
+"""
+
+import os
+import json
+import fnmatch
+from collections import namedtuple
+
+import numpy as np
+
+from scival.validate_data.file_io import Checksum, Cleanup, Find
+from scival.validate_data.image_io import RasterIO, RasterCmp, Subdatasets
+from scival.validate_data.parallel import BandResult, PairResult, PairPool
+from scival.validate_data.qa_images import do_diff, WINDOW_SIZE
+from scival import logger, trace
+
+
+# a band passes if |test - master| <= abs + rel * |master| for every pixel
+Tolerance = namedtuple('Tolerance', ['abs', 'rel'])
+
+
+def load_tolerances(path: str = None, abs_tol: float = 0.0, rel_tol: float = 0.0) -> dict:
+    """
+    Read per-extension, per-file and per-band tolerances from a JSON file of the form
+    {"<key>": {"abs": 1, "rel": 0.001}, ...}; keys are an extension (".img"), a file name pattern
+    ("*_sr_band1.tif") or a file name pattern and band index ("*_sr.img#3", 0-based). Values not given
+    default to abs_tol and rel_tol.
+    :param path: Full path to the JSON file, default is None (only the defaults)
+    :param abs_tol: Default absolute tolerance
+    :param rel_tol: Default relative tolerance
+    :return: key -> Tolerance, with the defaults under "default"
+    """
+    tolerances = {"default": Tolerance(abs_tol, rel_tol)}
+
+    if path:
+        with open(path) as f:
+            for key, value in json.load(f).items():
+                tolerances[key] = Tolerance(float(value.get("abs", abs_tol)), float(value.get("rel", rel_tol)))
+
+    return tolerances
+
+
+def tolerance_for(tolerances: dict, path: str, index: int) -> Tolerance:
+    """
+    Find the tolerance of a band: a "<pattern>#<band>" key first, then a file name pattern, then the
+    extension, then the default
+    :param tolerances: Tolerances from load_tolerances
+    :param path: Path of the test file
+    :param index: Index of the band/SDS
+    :return:
+    """
+    name = path.split("/")[-1]
+
+    keys = [k for k in tolerances if "#" in k and k.endswith("#{0}".format(index))
+            and fnmatch.fnmatch(name, k.rsplit("#", 1)[0])]
+
+    keys += [k for k in tolerances if "#" not in k and not k.startswith(".") and k != "default"
+             and fnmatch.fnmatch(name, k)]
+
+    keys += [k for k in tolerances if k == os.path.splitext(name)[1]]
+
+    return tolerances[keys[0]] if keys else tolerances["default"]
+
+
+def within(diff, mast, tol: Tolerance) -> bool:
+    """
+    Check a window of differences against a tolerance
+    :param diff: Differences (NoData already set to 0)
+    :param mast: Master values of the window
+    :param tol: Tolerance
+    :return:
+    """
+    if tol.rel == 0:
+        if tol.abs == 0:
+            return not np.any(diff)
+
+        return np.abs(diff).max() <= tol.abs
+
+    return bool(np.all(np.abs(diff) <= tol.abs + tol.rel * np.abs(np.ma.getdata(mast).astype(np.float64))))
+
+
+def gate_band(ds_test, ds_mast, band_no: int, index: int, tol: Tolerance, include_nd: bool = False,
+              window_size: int = None) -> BandResult:
+    """
+    Check one band window by window, stopping at the first window out of tolerance
+    :param ds_test: Open test raster
+    :param ds_mast: Open master raster
+    :param band_no: GDAL band number
+    :param index: Index of the band/SDS used in outputs
+    :param tol: Tolerance of the band
+    :param include_nd: If True, include NoData in the check
+    :param window_size: Maximum number of pixels per window
+    :return: BandResult whose stats hold the first failing window and its largest difference
+    """
+    t_band = ds_test.GetRasterBand(band_no)
+
+    m_band = ds_mast.GetRasterBand(band_no)
+
+    t_nd = RasterIO.get_nodata(t_band)
+
+    nodata = False
+    if not (t_nd is None or t_nd is False or include_nd):
+        nodata = int(t_nd)
+
+    for window in RasterIO.iter_windows(t_band, window_size or WINDOW_SIZE):
+        m_arr = RasterIO.read_window(m_band, window)
+
+        diff = do_diff(RasterIO.read_window(t_band, window), m_arr, nodata=nodata)
+
+        if diff is False:
+            return BandResult(index, 'error', None)
+
+        if not within(diff, m_arr, tol):
+            max_diff = np.abs(diff).max()
+
+            logger.error("Band {0} exceeds tolerance {1} in window {2}: max |diff| = {3}".format(
+                index, tuple(tol), window, max_diff))
+
+            return BandResult(index, 'fail', {"window": list(window), "max_abs_diff": max_diff.item()})
+
+    return BandResult(index, 'pass', None)
+
+
+def gate_pair(test: str, mast: str, ext: str, tolerances: dict, include_nd: bool = False,
+              window_size: int = None) -> PairResult:
+    """
+    Check a test raster against its master: byte-identical files pass at once, otherwise the georeferencing
+    must match and every band must be within tolerance
+    :param test: Path to the test raster
+    :param mast: Path to the master raster
+    :param ext: File extension
+    :param tolerances: Tolerances from load_tolerances
+    :param include_nd: If True, include NoData in the check
+    :param window_size: Maximum number of pixels per window
+    :return:
+    """
+    if Checksum.identical(test, mast):
+        return PairResult(test, mast, ext, 'pass', [])
+
+    ds_test = RasterIO.open_raster(test)
+
+    ds_mast = RasterIO.open_raster(mast)
+
+    if ds_test is None or ds_mast is None:
+        return PairResult(test, mast, ext, 'error', [])
+
+    if not all((RasterCmp.compare_proj_ref(ds_test, ds_mast), RasterCmp.compare_geo_trans(ds_test, ds_mast),
+                RasterCmp.extent_diff_cols(ds_test, ds_mast), RasterCmp.extent_diff_rows(ds_test, ds_mast))):
+        return PairResult(test, mast, ext, 'fail', [])
+
+    d_range = Find.count(test, ds_test, mast, ds_mast, ext)
+
+    if d_range is None:
+        return PairResult(test, mast, ext, 'fail', [])
+
+    bands = list()
+
+    if d_range > 1 and ext != ".img":
+        with Subdatasets() as sds:
+            sds.list(test, ds_test)
+
+            sds.list(mast, ds_mast)
+
+            for ii in range(d_range):
+                if sds.nodata(test, ii) != sds.nodata(mast, ii):
+                    logger.warning("SDS {0} NoData values differ. Test: {1} | Master: {2}".format(
+                        ii, sds.nodata(test, ii), sds.nodata(mast, ii)))
+
+                bands.append(gate_band(sds.open(test, ii), sds.open(mast, ii), 1, ii,
+                                       tolerance_for(tolerances, test, ii), include_nd, window_size))
+
+    else:
+        for ii in range(d_range):
+            bands.append(gate_band(ds_test, ds_mast, ii + 1, ii, tolerance_for(tolerances, test, ii),
+                                   include_nd, window_size))
+
+    if any(band.status == 'error' for band in bands):
+        status = 'error'
+
+    elif any(band.status == 'fail' for band in bands):
+        status = 'fail'
+
+    else:
+        status = 'pass'
+
+    return PairResult(test, mast, ext, status, bands)
+
+
+def missing_pair(test: str, mast: str, ext: str) -> PairResult:
+    """
+    Result of a raster that exists on one side only, which fails the gate
+    :param test: Path to the test raster, or None if it is missing
+    :param mast: Path to the master raster, or None if it is missing
+    :param ext: File extension
+    :return:
+    """
+    return PairResult(test, mast, ext, 'missing', [])
+
+
+def check_gate(test: list, mast: list, ext: str, tolerances: dict, pool: PairPool, include_nd: bool = False,
+               window_size: int = None) -> None:
+    """
+    Submit every matching pair of rasters with an extension to the gate
+    :param test: Paths to the test rasters
+    :param mast: Paths to the master rasters
+    :param ext: File extension
+    :param tolerances: Tolerances from load_tolerances
+    :param pool: Pool the checks are submitted to
+    :param include_nd: If True, include NoData in the check
+    :param window_size: Maximum number of pixels per window
+    :return:
+    """
+    logger.warning("Gating {0} files...".format(ext))
+
+    test, mast = Cleanup.remove_nonmatching_files(test, mast)
+
+    if not test or not mast:
+        logger.error("No {0} files to check in test and/or mast directories.".format(ext))
+
+        return None
+
+    for i, j in zip(test, mast):
+        pool.submit(gate_pair, i, j, ext, tolerances, include_nd=include_nd, window_size=window_size)
+
+    return None
+
+
+class Verdict:
+    """Collects gate results, as the writer of the comparison pool"""
+
+    def __init__(self):
+        self.results = list()
+
+    def __call__(self, result: PairResult) -> None:
+        with trace.span("verdict", cat="write", test=result.test):
+            if result.status != 'pass':
+                logger.error("Gate {0}: Test {1} | Master {2}".format(result.status.upper(), result.test,
+                                                                      result.mast))
+
+            self.results.append(result)
+
+    def error(self, args, exc) -> None:
+        """Record a gate check that raised as an error, so it cannot pass silently"""
+        self(PairResult(args[0], args[1], args[2], 'error', []))
+
+    def passed(self) -> bool:
+        """A run passes only if it checked at least one raster and every raster passed"""
+        return bool(self.results) and all(result.status == 'pass' for result in self.results)
+
+    def write(self, dir_out: str) -> str:
+        """
+        Write verdict.json
+        :param dir_out: Full path to the QA output directory
+        :return: Path of the file
+        """
+        fn_out = os.path.join(dir_out, "verdict.json")
+
+        counts = dict()
+        for result in self.results:
+            counts[result.status] = counts.get(result.status, 0) + 1
+
+        with open(fn_out, "w") as f:
+            json.dump({"verdict": "pass" if self.passed() else "fail",
+                       "counts": counts,
+                       "pairs": [{"test": r.test, "master": r.mast, "ext": r.ext, "status": r.status,
+                                  "bands": [{"index": b.index, "status": b.status, "detail": b.stats}
+                                            for b in r.bands]}
+                                 for r in self.results]},
+                      f, indent=2)
+
+        return fn_out
@@ -3,13 +3,17 @@
 Purpose: contains functions to read image data and extract metadata.
 """
 
+import os
+import re
+from collections import OrderedDict
+
 import numpy as np
 try:
     from osgeo import gdal
 except ImportError:
     import gdal
 
-from scival import logger
+from scival import logger, trace
 
 
 class RasterIO:
@@ -19,7 +23,8 @@ class RasterIO:
         Args:
             i <str>: path to raster file
         """
-        ds_raster = gdal.Open(i, gdal.GA_ReadOnly)
+        with trace.span("open", path=i):
+            ds_raster = gdal.Open(i, gdal.GA_ReadOnly)
         return ds_raster
 
     @staticmethod
@@ -42,9 +47,26 @@ class RasterIO:
         ds_raster = RasterIO.get_sds(i)
         return ds_raster
 
+    @staticmethod
+    def get_nodata(band):
+        """Get the NoData value of a raster band, False if it cannot be read.
+
+        Args:
+            band <osgeo.gdal.Band>: open raster band
+        """
+        r_nd = False
+        try:
+            r_nd = band.GetNoDataValue()
+        except AttributeError:
+            logger.warning("Variable {0} does not have NoData value.".
+                            format(band))
+
+        return r_nd
+
     @staticmethod
     def read_band_as_array(rast, n_bands=1):
-        """Read gdal object as an array. Mask out nodata.
+        """Read gdal object as an array, along with its nodata value. NoData
+        is left in place; do_diff excludes it without a masked copy.
 
         Args:
            rast <osgeo.gdal.Dataset>: open raster
@@ -52,26 +74,116 @@ class RasterIO:
         """
         # get nodata value
         r_a = rast.GetRasterBand(n_bands)
-        r_nd = False
-        try:
-            r_nd = r_a.GetNoDataValue()
-        except AttributeError:
-            logger.warning("Variable {0} does not have NoData value.".
-                            format(r_a))
+        r_nd = RasterIO.get_nodata(r_a)
 
         # read raster as array
-        rast_arr = np.array(r_a.ReadAsArray())
+        with trace.span("read") as sp:
+            rast_arr = r_a.ReadAsArray()
+            sp.add(nbytes=rast_arr.nbytes, pixels=rast_arr.size)
 
-        # mask nodata value, if it exists
         if r_nd is not False:
-            rast_arr = np.ma.masked_where(rast_arr == r_nd, rast_arr)
             logger.info("NoData value: {0}".format(r_nd))
         else:
-            rast_arr = r_a
             logger.info("NoData value could not be determined.")
 
         return (rast_arr,r_nd)
 
+    @staticmethod
+    def iter_windows(band, window_size):
+        """Walk a band in windows aligned to its native GDAL block size.
+        Windows span whole rows of blocks when the budget allows, so strip
+        and tiled layouts are both read without splitting blocks.
+
+        Args:
+            band <osgeo.gdal.Band>: open raster band
+            window_size <int>: maximum number of pixels per window
+        """
+        x_block, y_block = band.GetBlockSize()
+
+        cols, rows = band.XSize, band.YSize
+
+        if cols * y_block <= window_size:
+            # full-width strips, as many block rows as fit in the budget
+            x_win = cols
+            y_win = max(y_block, (window_size // cols) // y_block * y_block)
+
+        else:
+            # a single block row, as many blocks across as fit in the budget
+            y_win = y_block
+            x_win = max(x_block, (window_size // y_block) // x_block * x_block)
+
+        for yoff in range(0, rows, y_win):
+            for xoff in range(0, cols, x_win):
+                yield (xoff, yoff, min(x_win, cols - xoff),
+                       min(y_win, rows - yoff))
+
+    @staticmethod
+    def read_window(band, window):
+        """Read a single window of a band as an array.
+
+        Args:
+            band <osgeo.gdal.Band>: open raster band
+            window <tuple>: (xoff, yoff, xsize, ysize) in pixels
+        """
+        xoff, yoff, xsize, ysize = window
+
+        with trace.span("read") as sp:
+            arr = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            sp.add(nbytes=arr.nbytes, pixels=arr.size)
+
+        return arr
+
+    @staticmethod
+    def interleave(rast):
+        """Get the interleave of a raster: "PIXEL" (BIP), "LINE" (BIL),
+        "BAND" (BSQ), or None if the driver does not report it.
+
+        Args:
+            rast <osgeo.gdal.Dataset>: open raster
+        """
+        il = rast.GetMetadataItem("INTERLEAVE", "IMAGE_STRUCTURE")
+
+        return il.upper() if il else None
+
+    @staticmethod
+    def iter_row_blocks(rast, window_size=None):
+        """Walk a raster in blocks of whole rows across all of its bands.
+
+        Args:
+            rast <osgeo.gdal.Dataset>: open raster
+            window_size <int>: maximum number of pixels per block, summed
+                               over all bands (default=None, one block)
+        """
+        rows = rast.RasterYSize
+
+        step = rows
+        if window_size:
+            step = max(1, window_size // (rast.RasterXSize * rast.RasterCount))
+
+        for yoff in range(0, rows, step):
+            yield (0, yoff, rast.RasterXSize, min(step, rows - yoff))
+
+    @staticmethod
+    def read_rows(rast, window):
+        """Read a block of rows of every band in a single dataset-level read,
+        so pixel and line interleaved files are scanned once, not once per
+        band.
+
+        Args:
+            rast <osgeo.gdal.Dataset>: open raster
+            window <tuple>: (xoff, yoff, xsize, ysize) in pixels
+
+        Returns:
+            <numpy.ndarray>: array of shape (bands, ysize, xsize)
+        """
+        xoff, yoff, xsize, ysize = window
+
+        with trace.span("read") as sp:
+            arr = rast.ReadAsArray(xoff, yoff, xsize, ysize)
+            sp.add(nbytes=arr.nbytes, pixels=arr.size)
+
+        return arr.reshape((rast.RasterCount, ysize, xsize))
+
     '''
     @staticmethod
     def read_bip_as_array(rast, band_number):
@@ -90,6 +202,255 @@ class RasterIO:
         return rast_arr
     '''
 
+class Subdatasets:
+    """Subdatasets of HDF/NetCDF containers. Each container's subdatasets
+    are listed once; opened subdatasets are kept in a least recently used
+    cache of at most `max_open` handles, keyed by SDS name, so an SDS is
+    opened once for its NoData value, metadata and pixels. Use it as a
+    context manager to close the handles left at the end."""
+
+    def __init__(self, max_open=8):
+        """
+        Args:
+            max_open <int>: maximum number of SDS kept open (default=8)
+        """
+        self.max_open = max_open
+        self._lists = dict()
+        self._handles = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def list(self, path, ds=None):
+        """List the subdatasets of a container as (name, description).
+
+        Args:
+            path <str>: path to the container
+            ds <osgeo.gdal.Dataset>: the container, if already open
+        """
+        if path not in self._lists:
+            if ds is None:
+                ds = RasterIO.open_raster(path)
+
+            self._lists[path] = RasterIO.get_sds(ds)
+
+        return self._lists[path]
+
+    def name(self, path, index):
+        """Short name of a subdataset (e.g. "sr_band1"), from its GDAL name.
+
+        Args:
+            path <str>: path to the container
+            index <int>: index of the SDS
+        """
+        return self.list(path)[index][0].split(":")[-1]
+
+    def open(self, path, index):
+        """Get an open subdataset, opening it only if it is not cached.
+
+        Args:
+            path <str>: path to the container
+            index <int>: index of the SDS
+        """
+        sds_name = self.list(path)[index][0]
+
+        if sds_name in self._handles:
+            self._handles.move_to_end(sds_name)
+
+            return self._handles[sds_name]
+
+        while len(self._handles) >= self.max_open:
+            self.evict()
+
+        ds = RasterIO.open_raster(sds_name)
+
+        self._handles[sds_name] = ds
+
+        return ds
+
+    def nodata(self, path, index):
+        """NoData value of the first band of a subdataset.
+
+        Args:
+            path <str>: path to the container
+            index <int>: index of the SDS
+        """
+        return RasterIO.get_nodata(self.open(path, index).GetRasterBand(1))
+
+    def metadata(self, path, index):
+        """Metadata (default domain) of a subdataset as a dict.
+
+        Args:
+            path <str>: path to the container
+            index <int>: index of the SDS
+        """
+        return self.open(path, index).GetMetadata() or dict()
+
+    def evict(self):
+        """Close the least recently used subdataset."""
+        sds_name, ds = self._handles.popitem(last=False)
+
+        # dropping the last reference closes the dataset
+        del ds
+
+        logger.debug("Closed SDS {0}".format(sds_name))
+
+    def close(self):
+        """Close every cached subdataset."""
+        while self._handles:
+            self.evict()
+
+
+class EnviIO:
+    """Map raw ENVI rasters straight into memory, so bands can be diffed
+    from the page cache without GDAL reads or intermediate copies."""
+
+    # ENVI "data type" codes that map onto numpy types
+    DTYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 6: 'c8', 9: 'c16',
+              12: 'u2', 13: 'u4', 14: 'i8', 15: 'u8'}
+
+    # array axes of the whole file for each interleave, and the axis that
+    # indexes the band
+    LAYOUTS = {'bsq': (('bands', 'lines', 'samples'), 0),
+               'bil': (('lines', 'bands', 'samples'), 1),
+               'bip': (('lines', 'samples', 'bands'), 2)}
+
+    _field = re.compile(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', re.M)
+
+    def __init__(self, path, header):
+        """
+        Args:
+            path <str>: path to the .img file
+            header <dict>: parsed .hdr fields (see read_header)
+        """
+        self.path = path
+
+        self.rows = int(header['lines'])
+        self.cols = int(header['samples'])
+        self.bands = int(header['bands'])
+
+        order = '>' if int(header.get('byte order', 0)) == 1 else '<'
+        self.dtype = np.dtype(order + EnviIO.DTYPES[int(header['data type'])])
+
+        self.interleave = header.get('interleave', 'bsq').lower()
+        self.offset = int(header.get('header offset', 0))
+
+        self.nodata = None
+        if 'data ignore value' in header:
+            self.nodata = float(header['data ignore value'])
+
+        sizes = {'bands': self.bands, 'lines': self.rows, 'samples': self.cols}
+        axes, self.band_axis = EnviIO.LAYOUTS[self.interleave]
+
+        self.axes = axes
+
+        self.array = np.memmap(path, dtype=self.dtype, mode='r',
+                               offset=self.offset,
+                               shape=tuple(sizes[a] for a in axes))
+
+    @staticmethod
+    def read_header(hdr):
+        """Parse an ENVI header into a dict of lower case field names to
+        (string) values; braces around multi-line values are removed.
+
+        Args:
+            hdr <str>: path to the .hdr file
+        """
+        with open(hdr) as f:
+            text = f.read()
+
+        if not text.lstrip().startswith('ENVI'):
+            return None
+
+        return dict((key.strip().lower(), value.strip().strip('{}').strip())
+                    for key, value in EnviIO._field.findall(text))
+
+    @staticmethod
+    def header_path(path):
+        """Find the .hdr next to an ENVI file, None if there is none.
+
+        Args:
+            path <str>: path to the .img file
+        """
+        for hdr in (os.path.splitext(path)[0] + '.hdr', path + '.hdr'):
+            if os.path.isfile(hdr):
+                return hdr
+
+        return None
+
+    @staticmethod
+    def open(path):
+        """Memory-map an ENVI raster. Returns None for anything that cannot
+        be mapped (archive members, compressed or unknown data types and
+        layouts, truncated files), so the caller can fall back to GDAL.
+
+        Args:
+            path <str>: path to the .img file
+        """
+        if path.startswith('/vsi') or not os.path.isfile(path):
+            return None
+
+        hdr = EnviIO.header_path(path)
+        if hdr is None:
+            return None
+
+        with trace.span("open", path=path):
+            try:
+                header = EnviIO.read_header(hdr)
+
+                if (header is None or int(header.get('file compression', 0)) != 0
+                        or int(header['data type']) not in EnviIO.DTYPES
+                        or header.get('interleave', 'bsq').lower() not in EnviIO.LAYOUTS):
+                    logger.debug("Cannot memory-map {0}, reading with GDAL.".format(path))
+
+                    return None
+
+                return EnviIO(path, header)
+
+            except (KeyError, ValueError, OSError) as e:
+                logger.debug("Cannot memory-map {0} ({1}), reading with GDAL.".format(path, e))
+
+                return None
+
+    def band(self, band_no=1):
+        """View of a single band; no data is read until it is used.
+
+        Args:
+            band_no <int>: band number, starting at 1 like GDAL
+        """
+        index = [slice(None)] * 3
+        index[self.band_axis] = band_no - 1
+
+        return self.array[tuple(index)]
+
+    def read_rows(self, window):
+        """Copy a block of rows of every band out of the map in one pass,
+        de-interleaved to one plane per band, like RasterIO.read_rows.
+
+        Args:
+            window <tuple>: (xoff, yoff, xsize, ysize) in pixels
+
+        Returns:
+            <numpy.ndarray>: array of shape (bands, ysize, xsize)
+        """
+        xoff, yoff, xsize, ysize = window
+
+        index = {'bands': slice(None), 'lines': slice(yoff, yoff + ysize),
+                 'samples': slice(xoff, xoff + xsize)}
+
+        block = self.array[tuple(index[a] for a in self.axes)]
+
+        with trace.span("read") as sp:
+            arr = np.ascontiguousarray(block.transpose(
+                [self.axes.index(a) for a in ('bands', 'lines', 'samples')]))
+            sp.add(nbytes=arr.nbytes, pixels=arr.size)
+
+        return arr
+
+
 class RasterCmp:
     @staticmethod
     def compare_proj_ref(test, mast):
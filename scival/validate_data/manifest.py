@@ -0,0 +1,179 @@
+"""manifest.py
+
+Purpose: record the results of every comparison unit (a file pair plus its
+         band/SDS index) in a SQLite database in the QA output directory, so
+         an interrupted or repeated run only compares new or changed pairs
+         and stats.csv can be rebuilt without repeating any work. Whole
+         scenes whose archives are gone once compared (see pipeline.py) are
+         recorded by name.
+"""
+
+import os
+import json
+import sqlite3
+
+from scival.validate_data.file_io import Archive, Checksum
+from scival.validate_data.parallel import BandResult, PairResult
+from scival.validate_data import stats
+from scival import logger
+
+
+def _plain(value):
+    """Convert numpy scalars to plain Python values for JSON"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+# pairs whose differences are only written to the log (text, XML, schema, JPEG); these are compared again on
+# every run so the log of a resumed run still reports them
+LOGGED_EXT = (".txt", ".xml", ".gtf", ".hdr", ".stats", ".jpg", ".xsd")
+
+
+class Manifest:
+    """Results of completed comparisons, keyed by path, size, mtime and content hash of both files."""
+
+    def __init__(self, dir_out: str, resume: bool = True):
+        """
+        :param dir_out: Full path to the QA output directory
+        :param resume: If False, forget all previously recorded results
+        """
+        self.dir_out = dir_out
+        self.path = os.path.join(dir_out, "manifest.sqlite")
+
+        self.conn = sqlite3.connect(self.path)
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pairs (test TEXT, mast TEXT, ext TEXT, "
+                          "test_size INTEGER, test_mtime INTEGER, test_hash TEXT, "
+                          "mast_size INTEGER, mast_mtime INTEGER, mast_hash TEXT, "
+                          "status TEXT, PRIMARY KEY (test, mast))")
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS units (test TEXT, mast TEXT, unit INTEGER, "
+                          "status TEXT, stats TEXT, PRIMARY KEY (test, mast, unit))")
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scenes (name TEXT PRIMARY KEY, status TEXT)")
+
+        if not resume:
+            logger.warning("Discarding previous results in {0}".format(self.path))
+
+            self.conn.execute("DELETE FROM pairs")
+            self.conn.execute("DELETE FROM units")
+            self.conn.execute("DELETE FROM scenes")
+
+        self.conn.commit()
+
+    @staticmethod
+    def _unchanged(path: str, size: int, mtime: int, digest: str) -> bool:
+        """
+        Check a file against its recorded fingerprint. Size and mtime are compared first; the content hash
+        is only needed if the file was touched (e.g. re-extracted) but kept its size.
+        :return:
+        """
+        cur_size, cur_mtime = Archive.stat(path)
+
+        if cur_size != size:
+            return False
+
+        if cur_mtime == mtime:
+            return True
+
+        return digest is not None and Checksum.file_hash(path) == digest
+
+    def is_done(self, test: str, mast: str) -> bool:
+        """
+        Check whether a raster pair was already compared successfully and neither file has changed since
+        :param test: Path to the test file
+        :param mast: Path to the master file
+        :return:
+        """
+        row = self.conn.execute("SELECT test_size, test_mtime, test_hash, mast_size, mast_mtime, mast_hash, status, "
+                                "ext FROM pairs WHERE test=? AND mast=?", (test, mast)).fetchone()
+
+        if row is None or row[6] == 'error' or row[7].lower() in LOGGED_EXT:
+            return False
+
+        try:
+            done = self._unchanged(test, *row[0:3]) and self._unchanged(mast, *row[3:6])
+
+        except (OSError, KeyError):
+            return False
+
+        if done:
+            logger.info("Already compared, skipping: Test {0} | Master {1}".format(test, mast))
+
+        return done
+
+    def record(self, result: PairResult) -> None:
+        """
+        Store the result of a pair comparison, replacing any earlier result for the pair
+        :param result: Result of the comparison
+        :return:
+        """
+        test_size, test_mtime = Archive.stat(result.test)
+        mast_size, mast_mtime = Archive.stat(result.mast)
+
+        with self.conn:
+            self.conn.execute("DELETE FROM pairs WHERE test=? AND mast=?", (result.test, result.mast))
+            self.conn.execute("DELETE FROM units WHERE test=? AND mast=?", (result.test, result.mast))
+
+            self.conn.execute("INSERT INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (result.test, result.mast, result.ext,
+                               test_size, test_mtime, Checksum.cached_hash(result.test),
+                               mast_size, mast_mtime, Checksum.cached_hash(result.mast),
+                               result.status))
+
+            self.conn.executemany("INSERT INTO units VALUES (?, ?, ?, ?, ?)",
+                                  [(result.test, result.mast, band.index, band.status,
+                                    None if band.stats is None else json.dumps([_plain(v) for v in band.stats]))
+                                   for band in result.bands])
+
+        return None
+
+    def record_scene(self, name: str, status: str) -> None:
+        """
+        Store the outcome of a whole scene, replacing any earlier one
+        :param name: Name of the scene (its item name in the orders)
+        :param status: "done" once all of its pairs are recorded, or "failed"
+        :return:
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO scenes VALUES (?, ?)", (name, status))
+
+        return None
+
+    def scenes_done(self) -> set:
+        """
+        Names of the scenes whose pairs were all compared and recorded
+        :return:
+        """
+        return set(row[0] for row in self.conn.execute("SELECT name FROM scenes WHERE status='done'"))
+
+    def results(self):
+        """
+        Iterate over all recorded pair results, in the order they were recorded
+        :return:
+        """
+        for test, mast, ext, status in self.conn.execute("SELECT test, mast, ext, status FROM pairs ORDER BY rowid")\
+                .fetchall():
+            bands = [BandResult(unit, band_status, None if values is None else tuple(json.loads(values)))
+                     for unit, band_status, values in
+                     self.conn.execute("SELECT unit, status, stats FROM units WHERE test=? AND mast=? ORDER BY unit",
+                                       (test, mast))]
+
+            yield PairResult(test, mast, ext, status, bands)
+
+    def write_stats(self) -> None:
+        """
+        Rebuild stats.csv from every recorded result
+        :return:
+        """
+        fn_out = self.dir_out + os.sep + "stats.csv"
+
+        if os.path.isfile(fn_out):
+            os.remove(fn_out)
+
+        for result in self.results():
+            stats.write_result(self.dir_out, result)
+
+        return None
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,166 @@
+"""parallel.py
+
+Purpose: run (test, master) pair comparisons on a pool of worker processes.
+         Workers only compute; every result is handed back to a single
+         writer in the parent process, in submission order, so outputs
+         such as stats.csv are never written concurrently.
+"""
+
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from scival import logger, trace
+
+
+# result of comparing a single band/SDS of a file pair; stats holds the
+# stats.csv values if the band differed
+BandResult = namedtuple('BandResult', ['index', 'status', 'stats'])
+
+# result of comparing a (test, master) file pair
+PairResult = namedtuple('PairResult', ['test', 'mast', 'ext', 'status', 'bands'])
+
+
+def _run(func, *args, **kwargs):
+    """Run one comparison inside a timing span named after the comparison"""
+    with trace.span(func.__name__, cat="pair", test=args[0], mast=args[1]):
+        return func(*args, **kwargs)
+
+
+class PairPool:
+    """Submit pair comparisons and feed their results to one writer.
+
+    With workers <= 1 each comparison runs immediately in the calling
+    process, which keeps the original serial behavior.
+    """
+
+    def __init__(self, workers: int=1, writer=None, skip=None, on_error=None):
+        """
+        :param workers: Number of worker processes
+        :param writer: Callable receiving each result, run in this process
+        :param skip: Callable receiving (test, mast); pairs it returns True for are not compared again
+        :param on_error: Callable receiving (args, exception) of each comparison that raised, run in this process
+        """
+        self.workers = workers or 1
+        self.writer = writer
+        self.skip = skip
+        self.on_error = on_error
+        self.pending = deque()
+        self.executor = None
+
+        if self.workers > 1:
+            logger.info("Starting {0} worker processes.".format(self.workers))
+
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+            # start every worker now, before other threads (e.g. archive
+            # extraction) exist, so no process is forked holding their locks
+            for future in [self.executor.submit(os.getpid) for _ in range(self.workers)]:
+                future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, func, *args, **kwargs) -> None:
+        """
+        Run func(*args, **kwargs), in a worker if a pool is in use
+        :param func: Picklable module-level function or staticmethod, called with the (test, master) paths first
+        :return:
+        """
+        if self.skip is not None and self.skip(*args[:2]):
+            return None
+
+        if self.executor is None:
+            try:
+                result = _run(func, *args, **kwargs)
+
+            except Exception as exc:
+                self._error(func, args, exc)
+
+                return None
+
+            self._write(result)
+
+            return None
+
+        self.pending.append((self.executor.submit(_run, func, *args, **kwargs), func, args))
+
+        # hand over whatever is already finished, without blocking
+        self._drain(block=False)
+
+        return None
+
+    def then(self, callback) -> None:
+        """
+        Call callback() in this process once every comparison submitted so far has been written
+        :param callback: Callable without arguments
+        :return:
+        """
+        if not self.pending:
+            callback()
+
+            return None
+
+        self.pending.append((None, callback, None))
+
+        return None
+
+    def poll(self) -> None:
+        """
+        Write the results that are already finished, without blocking
+        :return:
+        """
+        self._drain(block=False)
+
+        return None
+
+    def close(self) -> None:
+        """
+        Wait for all outstanding comparisons and shut the workers down
+        :return:
+        """
+        self._drain(block=True)
+
+        if self.executor is not None:
+            self.executor.shutdown()
+
+            self.executor = None
+
+        return None
+
+    def _drain(self, block: bool) -> None:
+        """Write finished results, in the order they were submitted"""
+        while self.pending and (block or self.pending[0][0] is None or self.pending[0][0].done()):
+            future, func, args = self.pending.popleft()
+
+            # a callback queued by `then`
+            if future is None:
+                func()
+
+                continue
+
+            try:
+                result = future.result()
+
+            except Exception as exc:
+                self._error(func, args, exc)
+
+                continue
+
+            self._write(result)
+
+    def _error(self, func, args, exc) -> None:
+        """Report a comparison that raised"""
+        logger.error("Comparison {0}{1} failed: {2}".format(func.__name__, args[:2], exc))
+
+        if self.on_error is not None:
+            self.on_error(args, exc)
+
+    def _write(self, result) -> None:
+        """Pass a single result to the writer"""
+        if self.writer is not None and result is not None:
+            with trace.span("write", cat="write", test=result.test):
+                self.writer(result)
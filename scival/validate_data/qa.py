@@ -39,11 +39,16 @@ daniel.zelenak.ctr@usgs.gov
 import sys
 import os
 import time
+from functools import partial
 
-from scival.validate_data.file_io import Extract, Find, Cleanup
+from scival.validate_data.file_io import Archive, Checksum, DirIndex, Extract, Find, Cleanup
+from scival.validate_data.parallel import PairPool
+from scival.validate_data.manifest import Manifest
+from scival.validate_data import stats
 from scival.validate_data.qa_images import GeoImage
-from scival.validate_data.qa_metadata import MetadataQA
-from scival import logger
+from scival.validate_data.qa_metadata import MetadataQA, load_xml_tolerances
+from scival.validate_data.gate import Verdict, check_gate, load_tolerances, missing_pair
+from scival import logger, trace
 
 
 # TODO (med): Enable SDS sorting with NetCDF, HDF files.
@@ -51,8 +56,114 @@ from scival import logger
 
 # TODO (low): Only CleanUp files that pass all matching tests, leave files with differences to allow further testing.
 
+# extensions of the files compared as metadata or plain images rather than as rasters
+META_EXT = (".txt", ".xml", ".gtf", ".hdr", ".stats", ".jpg")
+
+
+def write_result(manifest: Manifest, dir_out: str, result) -> None:
+    """
+    Record a pair result in the manifest and append its stats to stats.csv
+    :param manifest: Manifest of the QA output directory
+    :param dir_out: Full path to the QA output directory
+    :param result: Result of a pair comparison
+    :return:
+    """
+    manifest.record(result)
+
+    stats.write_result(dir_out, result)
+
+    return None
+
+
+def qa_files(test_all: list, mast_all: list, dir_out: str, pool: PairPool, xml_schema: str = None,
+             incl_nd: bool = False, window_size: int = None, tolerances: dict = None,
+             jpeg_draft: bool = False, xml_tolerances: tuple = None) -> None:
+    """
+    Call the appropriate QA module(s) for every file extension in a matching set of test and master files
+    :param test_all: Paths to all test files (regular files or /vsitar/ archive members)
+    :param mast_all: Paths to all master files (regular files or /vsitar/ archive members)
+    :param dir_out: Full path to the QA output directory
+    :param pool: Pool the file pair comparisons are submitted to
+    :param xml_schema: Full path to XML files, default is None
+    :param incl_nd: If True, include NoData in comparisons
+    :param window_size: If set, compare rasters in block-aligned windows of at most this many pixels
+    :param tolerances: Tolerances from gate.load_tolerances; if given, only gate rasters (pass/fail)
+    :param jpeg_draft: If True, compare JPEGs at reduced resolution first and fully decode only those that differ
+    :param xml_tolerances: (tolerances, ignore) from qa_metadata.load_xml_tolerances, default is None (the defaults)
+    :return:
+    """
+    xml_tol, xml_ignore = xml_tolerances or (None, None)
+
+    unmatched = list()
+
+    # Pair test and master files by name, grouped by extension
+    pairs = Find.pair_files(test_all, mast_all, unmatched)
+
+    # in gate mode a raster that exists on one side only fails the verdict
+    if tolerances is not None:
+        for test, mast in unmatched:
+            ext = os.path.splitext((test or mast).split("/")[-1])[1]
+
+            if ext and ext.lower() not in META_EXT:
+                pool.submit(missing_pair, test, mast, ext)
+
+    for ext, (test_f, mast_f) in pairs.items():
+        logger.info("Performing QA on {0} files".format(ext))
+
+        is_meta = ext.lower() in META_EXT
+
+        # gate mode only checks rasters
+        if tolerances is not None and (is_meta or len(ext) == 0):
+            logger.info("Skipping {0} files in gate mode".format(ext))
+
+            continue
+
+        logger.info("Test files: {0}".format(test_f))
+
+        logger.info("Mast files: {0}".format(mast_f))
+
+        # remove any _hdf.img files found with .img files
+        if ext == ".img":
+            test_f = Cleanup.rm_files(test_f, "_hdf.img")
+
+            mast_f = Cleanup.rm_files(mast_f, "_hdf.img")
+
+        # if XML metadata, compare band by band
+        if ext.lower() == ".xml":
+            MetadataQA.check_xml_files(test_f, mast_f, dir_out, pool=pool, tolerances=xml_tol, ignore=xml_ignore)
+
+            if xml_schema:
+                MetadataQA.check_xml_schema(test_f + mast_f, xml_schema, pool=pool)
+
+        # if a text-based file
+        elif (ext.lower() == ".txt" or ext.lower() == ".gtf"
+                or ext.lower() == ".hdr" or ext.lower() == ".stats"):
+
+            MetadataQA.check_text_files(test_f, mast_f, ext, pool=pool)
+
+        # if non-geo image
+        elif ext.lower() == ".jpg":
+            MetadataQA.check_jpeg_files(test_f, mast_f, dir_out, pool=pool, draft=jpeg_draft)
+
+        # if no extension
+        elif len(ext) == 0:
+            continue
+
+        # else, it's probably a geo-based image
+        elif tolerances is not None:
+            check_gate(test_f, mast_f, ext, tolerances, pool, include_nd=incl_nd, window_size=window_size)
+
+        else:
+            GeoImage.check_images(test_f, mast_f, dir_out, ext,
+                                  include_nd=incl_nd, window_size=window_size, pool=pool)
+
+    return None
+
+
 def qa_data(dir_mast: str, dir_test: str, dir_out: str, archive: bool = True, xml_schema: str = None,
-            incl_nd: bool = False) -> None:
+            incl_nd: bool = False, window_size: int = None, workers: int = 1, in_place: bool = False,
+            resume: bool = True, trace_spans: bool = False, mode: str = "report", tolerances: str = None,
+            abs_tol: float = 0.0, rel_tol: float = 0.0, jpeg_draft: bool = False, xml_tolerances: str = None):
     """
     Function to check files and call appropriate QA module(s)
     :param dir_mast: Full path to the master directory
@@ -61,7 +172,18 @@ def qa_data(dir_mast: str, dir_test: str, dir_out: str, archive: bool = True, xm
     :param archive: If True, will clean up existing files and extract from archives
     :param xml_schema: Full path to XML files, default is None
     :param incl_nd: If True, include NoData in comparisons
-    :return:
+    :param window_size: If set, compare rasters in block-aligned windows of at most this many pixels
+    :param workers: Number of processes to run file pair comparisons on
+    :param in_place: If True (with archive), read archive members directly instead of extracting them
+    :param resume: If True, skip file pairs already compared (and unchanged) in a previous run
+    :param trace_spans: If True, write timing spans to trace.json and trace_summary.csv in dir_out
+    :param mode: "report" for stats and plots of every difference, "gate" for a pass/fail verdict of the rasters
+    :param tolerances: In gate mode, full path to a JSON file of per-extension/file/band tolerances
+    :param abs_tol: In gate mode, default absolute tolerance
+    :param rel_tol: In gate mode, default relative tolerance
+    :param jpeg_draft: If True, compare JPEGs at reduced resolution first and fully decode only those that differ
+    :param xml_tolerances: Full path to a JSON file of XML field tolerances and ignored fields
+    :return: In gate mode, True if every raster is within tolerance; otherwise None
     """
     # start timing code
     t0 = time.time()
@@ -70,93 +192,117 @@ def qa_data(dir_mast: str, dir_test: str, dir_out: str, archive: bool = True, xm
     if not os.path.exists(dir_out):
         os.makedirs(dir_out)
 
-    if archive:
-        # do initial cleanup of input directories
-        Cleanup.cleanup_files(dir_mast)
+    # hashes of compared files are kept with the results, for the workers started below as well
+    Checksum.use_cache(os.path.join(dir_out, "hashes.sqlite"))
+
+    if trace_spans:
+        trace.enable(dir_out)
 
-        Cleanup.cleanup_files(dir_test)
+    with trace.span("qa_data", cat="run", dir_mast=dir_mast, dir_test=dir_test):
+        gate = None
 
-        # create output directory if it doesn't exist
-        if not os.path.exists(dir_out):
-            os.makedirs(dir_out)
+        xml_rules = load_xml_tolerances(xml_tolerances)
 
-        # read in .tar.gz files
-        test_files = Find.find_files(dir_test, ".tar*")
+        if mode == "gate":
+            # every raster is checked again; the verdict is written from here
+            gate = load_tolerances(tolerances, abs_tol, rel_tol)
 
-        mast_files = Find.find_files(dir_mast, ".tar*")
+            verdict = Verdict()
 
-        # Extract files from archive
-        Extract.unzip_files(test_files, mast_files)
+            pool = PairPool(workers, writer=verdict, on_error=verdict.error)
 
-    # find only the deepest dirs
-    test_dirs = sorted([r for r, d, f in os.walk(dir_test) if not d])
+        else:
+            # results of earlier runs; stats.csv starts from the pairs already done
+            manifest = Manifest(dir_out, resume)
 
-    mast_dirs = sorted([r for r, d, f in os.walk(dir_mast) if not d])
+            manifest.write_stats()
 
-    if len(test_dirs) != len(mast_dirs):
-        logger.critical("Directory structure of Master differs from Test., MASTER: %s, TEST: %s", mast_dirs, test_dirs)
+            # all comparisons go through one pool; stats.csv is only written from here
+            pool = PairPool(workers, writer=partial(write_result, manifest, dir_out), skip=manifest.is_done)
 
-        sys.exit(1)
+        if archive and in_place:
+            # read in .tar.gz files
+            test_files = Find.find_files(dir_test, ".tar*")
 
-    for i in range(0, len(test_dirs)):
-        # Find extracted files
-        all_test = sorted(Find.find_files(test_dirs[i], ".*"))
+            mast_files = Find.find_files(dir_mast, ".tar*")
 
-        all_mast = sorted(Find.find_files(mast_dirs[i], ".*"))
+            if len(test_files) != len(mast_files):
+                logger.critical("Number of archives in Master differs from Test., MASTER: %s, TEST: %s",
+                                mast_files, test_files)
 
-        # Find unique file extensions
-        exts = Find.get_ext(all_test, all_mast)
+                sys.exit(1)
 
-        for ext in exts:
-            logger.info("Finding {0} files...".format(ext))
+            # compare archive members without extracting anything: rasters through /vsitar/, other members from
+            # their offset in a .tar or from the single streaming pass that indexes a .tar.gz
+            for test_arc, mast_arc in zip(test_files, mast_files):
+                logger.info("Comparing members of archives {0} and {1}".format(test_arc, mast_arc))
 
-            test_f = Find.find_files(test_dirs[i], ext)
+                qa_files(Archive.compare_paths(test_arc), Archive.compare_paths(mast_arc), dir_out, pool,
+                         xml_schema, incl_nd, window_size, gate, jpeg_draft, xml_rules)
 
-            mast_f = Find.find_files(mast_dirs[i], ext)
+        elif archive:
+            # do initial cleanup of input directories
+            Cleanup.cleanup_files(dir_mast)
 
-            logger.info("Performing QA on {0} files located in {1}".format(ext, dir_test))
+            Cleanup.cleanup_files(dir_test)
 
-            logger.info("Test files: {0}".format(test_f))
+            # read in .tar.gz files
+            test_files = Find.find_files(dir_test, ".tar*")
 
-            logger.info("Mast files: {0}".format(mast_f))
+            mast_files = Find.find_files(dir_mast, ".tar*")
 
-            # remove any _hdf.img files found with .img files
-            if ext == ".img":
-                test_f = Cleanup.rm_files(test_f, "_hdf.img")
+            # Extract files from archive, comparing each pair as soon as it is on disk
+            Extract.unzip_files(test_files, mast_files, workers=max(2, workers),
+                                on_extracted=partial(qa_files, dir_out=dir_out, pool=pool, xml_schema=xml_schema,
+                                                     incl_nd=incl_nd, window_size=window_size,
+                                                     tolerances=gate, jpeg_draft=jpeg_draft,
+                                                     xml_tolerances=xml_rules))
 
-                mast_f = Cleanup.rm_files(mast_f, "_hdf.img")
+        else:
+            # walk each tree once
+            test_index = DirIndex(dir_test)
 
-            # if a text-based file
-            if (ext.lower() == ".txt" or ext.lower() == ".xml"
-                    or ext.lower() == ".gtf" or ext.lower() == ".hdr"
-                    or ext.lower() == ".stats"):
+            mast_index = DirIndex(dir_mast)
 
-                MetadataQA.check_text_files(test_f, mast_f, ext)
+            # find only the deepest dirs, paired by their path relative to each root
+            test_dirs = set(test_index.leaves)
 
-                # if text-based file is xml
-                if ext.lower() == ".xml" and xml_schema:
-                    MetadataQA.check_xml_schema(test_f, xml_schema)
+            mast_dirs = set(mast_index.leaves)
 
-                    MetadataQA.check_xml_schema(mast_f, xml_schema)
+            if test_dirs != mast_dirs:
+                logger.critical("Directory structure of Master differs from Test., MASTER only: %s, TEST only: %s",
+                                sorted(mast_dirs - test_dirs), sorted(test_dirs - mast_dirs))
 
-            # if non-geo image
-            elif ext.lower() == ".jpg":
-                MetadataQA.check_jpeg_files(test_f, mast_f, dir_out)
+                sys.exit(1)
 
-            # if no extension
-            elif len(ext) == 0:
-                continue
+            # files of the same leaf share their relative directory, so pairing them by name pairs them by
+            # relative path
+            for rel_dir in sorted(test_dirs):
+                qa_files(test_index.files_in(rel_dir), mast_index.files_in(rel_dir), dir_out, pool,
+                         xml_schema, incl_nd, window_size, gate, jpeg_draft, xml_rules)
 
-            # else, it's probably a geo-based image
-            else:
-                GeoImage.check_images(test_f, mast_f, dir_out, ext,
-                                      include_nd=incl_nd)
+        pool.close()
 
-    if archive:
-        # Clean up files
-        Cleanup.cleanup_files(dir_mast)
+        if gate is None:
+            # rebuild stats.csv, dropping rows of pairs that were compared again
+            manifest.write_stats()
 
-        Cleanup.cleanup_files(dir_test)
+            manifest.close()
+
+        else:
+            if not verdict.results:
+                logger.error("No rasters were checked")
+
+            logger.warning("Gate verdict: {0}, written to {1}".format("PASS" if verdict.passed() else "FAIL",
+                                                                   verdict.write(dir_out)))
+
+        if archive and not in_place:
+            # Clean up files
+            Cleanup.cleanup_files(dir_mast)
+
+            Cleanup.cleanup_files(dir_test)
+
+    trace.finish(dir_out)
 
     # end timing
     t1 = time.time()
@@ -169,4 +315,7 @@ def qa_data(dir_mast: str, dir_test: str, dir_out: str, archive: bool = True, xm
 
     logger.warning("Done.")
 
+    if gate is not None:
+        return verdict.passed()
+
     return None
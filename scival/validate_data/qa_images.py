@@ -1,34 +1,131 @@
 # qa_images.py
 
 import os
+import threading
+from functools import partial
 
 import numpy as np
 
-from scival.validate_data.image_io import RasterIO, RasterCmp
-from scival.validate_data.file_io import Cleanup, Find, ImWrite
+from scival.validate_data.image_io import EnviIO, RasterIO, RasterCmp, Subdatasets
+from scival.validate_data.file_io import Archive, Checksum, Cleanup, Find, ImWrite, Preview
+from scival.validate_data.parallel import BandResult, PairResult, PairPool
 from scival.validate_data import stats
-from scival import logger
+from scival import logger, trace
 
+# default window budget for windowed comparisons, in pixels (~4 MB of int16)
+WINDOW_SIZE = 2 ** 21
 
-def do_diff(test, mast, nodata=False):
+# per-thread output buffers reused by do_diff
+_buffers = threading.local()
+
+# resolution reduction of draft (quick verdict) JPEG decoding: 1, 2, 4 or 8
+JPEG_DRAFT_SCALE = 8
+
+
+def diff_dtype(t_dtype, m_dtype):
+    """Narrowest type that holds the difference of two arrays without
+    overflow: integers are widened to the next signed size (int16 -> int32,
+    uint8 -> int16), floats keep their precision (at least float32).
+
+    Args:
+        t_dtype <numpy.dtype>: data type of test array
+        m_dtype <numpy.dtype>: data type of master array
+    """
+    dt = np.result_type(t_dtype, m_dtype)
+
+    if dt.kind == 'b':
+        return np.dtype(np.int8)
+
+    if dt.kind in 'iu':
+        if dt.itemsize >= 8:
+            return np.dtype(np.float64)
+
+        return np.dtype('i{0}'.format(dt.itemsize * 2))
+
+    if dt.kind == 'f':
+        return np.promote_types(dt, np.float32)
+
+    return dt
+
+
+def _buffer(name, dtype, shape):
+    """Get a reusable array of the given type and shape. Buffers are kept
+    per thread and only grow, so repeated diffs of bands, windows or files
+    do not allocate.
+
+    Args:
+        name <str>: purpose of the buffer (e.g. "diff", "mask")
+        dtype <numpy.dtype>: data type of the buffer
+        shape <tuple>: shape of the array returned
+    """
+    cache = getattr(_buffers, 'cache', None)
+    if cache is None:
+        cache = _buffers.cache = dict()
+
+    size = int(np.prod(shape))
+    key = (name, np.dtype(dtype))
+
+    buf = cache.get(key)
+    if buf is None or buf.size < size:
+        buf = cache[key] = np.empty(size, dtype=dtype)
+
+    return buf[:size].reshape(shape)
+
+
+def do_diff(test, mast, nodata=False, out=None):
     """Do image diff, break if the grids are not the same size.
 
+    The difference is computed in the narrowest safe type (see diff_dtype)
+    into a reused buffer. Pixels where either input is NoData are set to 0,
+    i.e. treated as not different, instead of building masked arrays.
+    Unless `out` is given, the result is only valid until the next call
+    from the same thread.
+
     Args:
         test <numpy.ndarray>: array of test raster
         mast <numpy.ndarray>: array of master raster
+        nodata <int>: no data value to exclude, or False (default=False)
+        out <numpy.ndarray>: array to write the difference to (default=None)
     """
-    # If a NoData value is present, or the "--include-nodata" flag was used:
-    if nodata is not False:
-        test = np.ma.masked_where(test == nodata, test)
-        mast = np.ma.masked_where(mast == nodata, mast)
+    with trace.span("diff") as sp:
+        diff = _diff(test, mast, nodata, out)
+
+        if diff is not False:
+            sp.add(pixels=diff.size)
 
-        logger.info("Making nodata value {0} from diff calc.".format(nodata))
+    return diff
 
+
+def _diff(test, mast, nodata, out):
+    """do_diff without the timing span"""
     try:
         # TODO: Figure out why some bands cannot be compared correctly.
-        diff = test.astype(np.float) - mast.astype(np.float)
+        test = np.ma.getdata(test)
+        mast = np.ma.getdata(mast)
+
+        if test.shape != mast.shape:
+            raise ValueError("Array shapes differ: {0} | {1}".format(test.shape, mast.shape))
+
+        dtype = diff_dtype(test.dtype, mast.dtype)
 
-        return diff
+        if out is None:
+            out = _buffer("diff", dtype, test.shape)
+
+        np.subtract(test, mast, out=out, dtype=out.dtype)
+
+        # If a NoData value is present, and the "--include-nodata" flag was not used:
+        if nodata is not False:
+            logger.debug("Excluding nodata value {0} from diff calc.".format(nodata))
+
+            mask = _buffer("mask", np.bool_, test.shape)
+
+            np.equal(test, nodata, out=mask)
+            np.copyto(out, 0, where=mask)
+
+            np.equal(mast, nodata, out=mask)
+            np.copyto(out, 0, where=mask)
+
+        return out
 
     except (ValueError, AttributeError, TypeError) as e:
         logger.warning("Error: {0}".format(e))
@@ -46,7 +143,9 @@ def call_stats(test, mast, rast_arr, fn_out, dir_out, rast_num=0):
         fn_out <str>: file path of image
         dir_out <str>: path to output directory
         rast_num <int>: individual number of image (default=0)
-        nodata <int>: no data value (default=-9999)
+
+    Returns:
+        <tuple>: stats.csv values if the data differ, otherwise None
     """
     if isinstance(rast_arr, (np.ndarray, np.ma.core.MaskedArray)):
 
@@ -59,20 +158,25 @@ def call_stats(test, mast, rast_arr, fn_out, dir_out, rast_num=0):
             fout = fn_out.split(os.sep)[-1]
 
             # do stats of difference
-            stats.img_stats(test, mast, rast_arr, os.path.dirname(fn_out),
-                            fout, dir_out, rast_num)
+            with trace.span("stats") as sp:
+                acc = stats.DiffStats()
 
-            # plot diff image
-            ImWrite.plot_diff_image(test, mast, rast_arr, fout, "diff_" +
-                                    str(rast_num), dir_out)
+                acc.update(rast_arr)
 
-            # plot abs diff image
-            ImWrite.plot_diff_image(test, mast, rast_arr, fout, "abs_diff_" +
-                                    str(rast_num), dir_out, do_abs=True)
+                row = acc.row()
 
-            # plot diff histograms
-            ImWrite.plot_hist(test, mast, rast_arr, fout, "diff_" +
-                              str(rast_num), dir_out)
+                sp.add(pixels=rast_arr.size)
+
+            with trace.span("plot"):
+                # plot diff and abs diff images
+                ImWrite.plot_diff_images(test, mast, rast_arr, fout, rast_num,
+                                         dir_out)
+
+                # plot diff histograms
+                ImWrite.plot_hist(test, mast, rast_arr, fout, "diff_" +
+                                  str(rast_num), dir_out)
+
+            return row
 
         else:
             logger.info("Binary data match.")
@@ -81,69 +185,346 @@ def call_stats(test, mast, rast_arr, fn_out, dir_out, rast_num=0):
         logger.warning("Target raster is not a valid numpy array or numpy "
                         "masked array. Cannot run statistics!")
 
+    return None
+
 
 class ArrayImage:
     @staticmethod
-    def check_images(test, mast):
+    def read_image(path, draft=False):
+        """Decode a generic (non-geographic) image, like JPEG, with Pillow.
+
+        Args:
+            path <str>: path to image (or /vsitar/ archive member)
+            draft <bool>: decode JPEGs at 1/JPEG_DRAFT_SCALE resolution,
+                          which skips most of the decoding work (default=False)
+        """
+        from PIL import Image
+
+        with trace.span("decode") as sp, Archive.open_file(path, "rb") as im_file:
+            im = Image.open(im_file)
+
+            if draft:
+                im.draft(im.mode, (max(1, im.size[0] // JPEG_DRAFT_SCALE),
+                                   max(1, im.size[1] // JPEG_DRAFT_SCALE)))
+
+            arr = np.asarray(im)
+
+            sp.add(pixels=arr.size)
+
+        return arr
+
+    @staticmethod
+    def check_images(test, mast, draft=False):
         """Read in a generic (non-geographic) image, like JPEG, and do a diff
-        Return diff raster if actually different
+        Return diff raster if actually different. Byte-identical files are
+        not decoded; pixels are diffed in uint8/int16, not float.
 
         Args:
             test <str>: path to test image
             mast <str>: path to master image
+            draft <bool>: compare at reduced resolution for a quick verdict
+                          (default=False)
+
+        Returns:
+            <numpy.ndarray>: the difference if the images differ, None if
+                             they are equal, False if they cannot be compared
         """
-        try:
-            from scipy.misc import imread
+        if Checksum.identical(test, mast):
+            logger.info("Files are byte-identical: {0} and {1}.".format(test, mast))
 
-        except ImportError:
-            from scipy.ndimage import imread
+            return None
 
         # read images
         try:
-            test_im = imread(test)
+            test_im = ArrayImage.read_image(test, draft)
 
-            mast_im = imread(mast)
+            mast_im = ArrayImage.read_image(mast, draft)
 
-        except ImportError:
-            logger.warning("Likely missing Python Image Library (PIL).")
+        except (IOError, OSError, ValueError) as e:
+            logger.error("Not able to decode image {0} or {1}: {2}".format(test, mast, e))
 
-            # try Scikit Image
-            from skimage.io import imread
+            return False
 
-            try:
-                mast_im = imread(mast)
+        if test_im.shape != mast_im.shape:
+            logger.error("Image {0} and {1} are not the same dimensions.".format(test, mast))
 
-                test_im = imread(test)
+            return False
 
-            except (ValueError, TypeError, ImportError):
-                logger.warning("Not able to open image with skimag.io. Likely missing image library.")
+        # check diff
+        diff_im = do_diff(test_im, mast_im, out=np.empty(test_im.shape, diff_dtype(test_im.dtype, mast_im.dtype)))
 
-                return None
+        if diff_im is False:
+            return False
 
-        # check diff
-        try:
-            diff_im = do_diff(test_im, mast_im)
+        if np.any(diff_im):
+            logger.error("Values differ between {0} and {1}.".format(test, mast))
 
-            if len(np.nonzero(diff_im)) > 3:
-                logger.error("Values differ between {0} and {1}.".format(test, mast))
+            return diff_im
 
-                return diff_im
+        logger.info("Values equivalent between {0} and {1}.".format(test, mast))
 
-            else:
-                logger.info("Values equivalent between {0} and {1}.".format(test, mast))
+        return None
 
-                return None
 
-        except ValueError:
-            logger.error("Image {0} and {1} are not the same dimensions.".format(test, mast))
+def compare_windowed(test, mast, t_band, m_band, fn_out, dir_out, rast_num=0,
+                     nodata=False, window_size=WINDOW_SIZE):
+    """Diff two bands one block-aligned window at a time and accumulate the
+    stats, so peak memory is bounded by the window size instead of the
+    raster size.
+
+    Args:
+        test <str>: name of test file
+        mast <str>: name of master file
+        t_band <osgeo.gdal.Band>: test raster band
+        m_band <osgeo.gdal.Band>: master raster band
+        fn_out <str>: file path of image
+        dir_out <str>: path to output directory
+        rast_num <int>: individual number of image (default=0)
+        nodata <int>: no data value to mask, or False (default=False)
+        window_size <int>: maximum number of pixels per window
+
+    Returns:
+        <parallel.BandResult>: status and stats.csv values of the band
+    """
+    acc = stats.DiffStats()
+
+    preview = Preview(t_band.YSize, t_band.XSize)
+
+    for window in RasterIO.iter_windows(t_band, window_size):
+        diff = do_diff(RasterIO.read_window(t_band, window),
+                       RasterIO.read_window(m_band, window), nodata=nodata)
+
+        if diff is False:
+            return BandResult(rast_num, 'error', None)
+
+        with trace.span("stats") as sp:
+            acc.update(diff)
+
+            preview.update(window, diff)
+
+            sp.add(pixels=diff.size)
+
+    if acc.count > 0:
+        logger.warning("Image difference found!")
+
+        logger.warning("Test: {0} | Master: {1}".format(test, mast))
+
+        # plot diff and abs diff images from the decimated preview; the
+        # histogram needs every value and is skipped in windowed mode
+        with trace.span("plot"):
+            ImWrite.plot_diff_images(test, mast, preview.array,
+                                     fn_out.split(os.sep)[-1], rast_num, dir_out,
+                                     shape=(t_band.YSize, t_band.XSize))
+
+        return BandResult(rast_num, 'different', acc.row())
+
+    logger.info("Binary data match.")
+
+    return BandResult(rast_num, 'match', None)
+
+
+def compare_bulk(test, mast, ds_test, ds_mast, dir_out, include_nd=False,
+                 window_size=None, envi=None):
+    """Diff every band of two multi-band rasters from shared row blocks:
+    each block is read across all bands in one dataset-level read (or
+    copied out of the memory maps in one pass), and the bands are compared
+    as slices of it. Pixel and line interleaved files are thus read from
+    disk once instead of once per band. Without a window size the whole
+    raster is one block.
+
+    Args:
+        test <str>: path to test image
+        mast <str>: path to master image
+        ds_test <osgeo.gdal.Dataset>: open test raster
+        ds_mast <osgeo.gdal.Dataset>: open master raster
+        dir_out <str>: path to output directory
+        include_nd <bool>: incl. nodata values in file cmp (default=False)
+        window_size <int>: maximum number of pixels per block, summed over
+                           all bands (default=None, whole raster)
+        envi <tuple>: memory-mapped (test, master) image_io.EnviIO to read
+                      the blocks from instead of GDAL (default=None)
+
+    Returns:
+        <list>: parallel.BandResult of each band
+    """
+    n_bands = ds_test.RasterCount
+
+    if envi is not None:
+        read_test, read_mast = envi[0].read_rows, envi[1].read_rows
+
+    else:
+        read_test, read_mast = partial(RasterIO.read_rows, ds_test), partial(RasterIO.read_rows, ds_mast)
+
+    nodata = list()
+    for ii in range(n_bands):
+        t_nd = RasterIO.get_nodata(ds_test.GetRasterBand(ii + 1))
+
+        if t_nd is None or t_nd is False or include_nd:
+            nodata.append(False)
+        else:
+            nodata.append(int(t_nd))
+
+    blocks = list(RasterIO.iter_row_blocks(ds_test, window_size))
+
+    if len(blocks) == 1:
+        # one read per file; full resolution stats and plots for each band
+        t_arr = read_test(blocks[0])
+
+        m_arr = read_mast(blocks[0])
+
+        results = list()
+
+        for ii in range(n_bands):
+            with trace.span("band", cat="band", test=test, index=ii):
+                diff = do_diff(t_arr[ii], m_arr[ii], nodata=nodata[ii])
+
+                if diff is False:
+                    results.append(BandResult(ii, 'error', None))
+
+                    continue
+
+                values = call_stats(test, mast, diff, test, dir_out, rast_num=ii)
+
+                results.append(BandResult(ii, 'match' if values is None else 'different', values))
+
+        return results
+
+    accs = [stats.DiffStats() for _ in range(n_bands)]
+
+    previews = [Preview(ds_test.RasterYSize, ds_test.RasterXSize) for _ in range(n_bands)]
+
+    failed = set()
+
+    for window in blocks:
+        t_arr = read_test(window)
+
+        m_arr = read_mast(window)
+
+        for ii in range(n_bands):
+            if ii in failed:
+                continue
+
+            diff = do_diff(t_arr[ii], m_arr[ii], nodata=nodata[ii])
+
+            if diff is False:
+                failed.add(ii)
+
+                continue
+
+            with trace.span("stats") as sp:
+                accs[ii].update(diff)
+
+                previews[ii].update(window, diff)
+
+                sp.add(pixels=diff.size)
+
+    results = list()
+
+    for ii in range(n_bands):
+        if ii in failed:
+            results.append(BandResult(ii, 'error', None))
+
+        elif accs[ii].count > 0:
+            logger.warning("Image difference found!")
+
+            logger.warning("Test: {0} | Master: {1}".format(test, mast))
+
+            with trace.span("plot"):
+                ImWrite.plot_diff_images(test, mast, previews[ii].array,
+                                         test.split(os.sep)[-1], ii, dir_out,
+                                         shape=(ds_test.RasterYSize, ds_test.RasterXSize))
+
+            results.append(BandResult(ii, 'different', accs[ii].row()))
+
+        else:
+            logger.info("Binary data match.")
+
+            results.append(BandResult(ii, 'match', None))
+
+    return results
 
 
 class GeoImage:
     @staticmethod
-    def check_images(test, mast, dir_out, ext, include_nd=False):
-        """Compare the test and master images, both for their raw contents and
-        geographic parameters. If differences exist, produce diff plot + CSV
-        stats file.
+    def compare_bands(test, mast, ds_test, ds_mast, dir_out, band_no=1,
+                      rast_num=0, include_nd=False, window_size=None,
+                      envi=None):
+        """Diff one band of the test and master rasters and report results.
+
+        Args:
+            test <str>: path to test image
+            mast <str>: path to master image
+            ds_test <osgeo.gdal.Dataset>: open test raster
+            ds_mast <osgeo.gdal.Dataset>: open master raster
+            dir_out <str>: path to output directory
+            band_no <int>: GDAL band number to compare (default=1)
+            rast_num <int>: index of band/SDS used in outputs (default=0)
+            include_nd <bool>: incl. nodata values in file cmp (default=False)
+            window_size <int>: if set, compare in windows of at most this
+                               many pixels (default=None, whole band)
+            envi <tuple>: memory-mapped (test, master) image_io.EnviIO to
+                          read the band from instead of GDAL (default=None)
+
+        Returns:
+            <parallel.BandResult>: status and stats.csv values of the band
+        """
+        with trace.span("band", cat="band", test=test, index=rast_num):
+            return GeoImage._compare_bands(test, mast, ds_test, ds_mast, dir_out,
+                                           band_no, rast_num, include_nd,
+                                           window_size, envi)
+
+    @staticmethod
+    def _compare_bands(test, mast, ds_test, ds_mast, dir_out, band_no,
+                       rast_num, include_nd, window_size, envi):
+        """compare_bands without the timing span"""
+        if window_size:
+            t_band = ds_test.GetRasterBand(band_no)
+
+            m_band = ds_mast.GetRasterBand(band_no)
+
+            t_nd = RasterIO.get_nodata(t_band)
+
+            nodata = False
+            if not (t_nd is None or t_nd is False or include_nd):
+                nodata = int(t_nd)
+
+            return compare_windowed(test, mast, t_band, m_band, test, dir_out,
+                                    rast_num=rast_num, nodata=nodata,
+                                    window_size=window_size)
+
+        if envi is not None:
+            # views into the mapped files; pages are read as the diff runs
+            ds_tband, t_nd = envi[0].band(band_no), envi[0].nodata
+
+            ds_mband, m_nd = envi[1].band(band_no), envi[1].nodata
+
+        else:
+            # read in bands as array
+            ds_tband, t_nd = RasterIO.read_band_as_array(ds_test, band_no)
+
+            ds_mband, m_nd = RasterIO.read_band_as_array(ds_mast, band_no)
+
+        # do image differencing without masking NoData
+        if isinstance(t_nd, type(None)) or include_nd:
+            diff = do_diff(ds_tband, ds_mband)
+
+        # do image differencing with NoData masked
+        else:
+            diff = do_diff(ds_tband, ds_mband, nodata=int(t_nd))
+
+        if diff is False:
+            return BandResult(rast_num, 'error', None)
+
+        # call stats functions to make plots and get the stats values
+        values = call_stats(test, mast, diff, test, dir_out, rast_num=rast_num)
+
+        return BandResult(rast_num, 'match' if values is None else 'different', values)
+
+    @staticmethod
+    def check_pair(test, mast, dir_out, ext, include_nd=False,
+                   window_size=None):
+        """Compare a single test and master image, both for their raw contents
+        and geographic parameters. Plots are written for differing bands.
 
         Args:
             test <str>: path to test image
@@ -151,98 +532,167 @@ class GeoImage:
             dir_out <str>: path to output directory
             ext <str>: file extension
             include_nd <bool>: incl. nodata values in file cmp (default=False)
+            window_size <int>: if set, compare bands in block-aligned windows
+                               of at most this many pixels (default=None)
+
+        Returns:
+            <parallel.PairResult>: status and per-band results of the pair
         """
-        logger.warning("Checking {0} files...".format(ext))
+        logger.info("Checking Test {0} against Master {1}".format(test, mast))
 
-        # clean up non-matching files
-        test, mast = Cleanup.remove_nonmatching_files(test, mast)
+        # skip the raster comparison entirely for byte-identical files
+        if Checksum.identical(test, mast):
+            logger.info("Files are byte-identical: Test {0} | Master {1}".format(test, mast))
 
-        # make sure there are actually files to check
-        if mast is None or test is None:
-            logger.error("No {0} files to check in test and/or mast directories.".format(ext))
+            return PairResult(test, mast, ext, 'identical', [])
 
-            return False
+        # Open each raster
+        ds_test = RasterIO.open_raster(test)
 
-        # do other comparison checks, return stats + plots if diffs exist
-        for i, j in zip(test, mast):
+        ds_mast = RasterIO.open_raster(mast)
 
-            logger.info("Checking Test {0} against Master {1}".format(i, j))
+        # Compare various raster parameters
+        status = list()
 
-            # Open each raster
-            ds_test = RasterIO.open_raster(i)
+        status.append(RasterCmp.compare_proj_ref(ds_test, ds_mast))
 
-            ds_mast = RasterIO.open_raster(j)
+        status.append(RasterCmp.compare_geo_trans(ds_test, ds_mast))
 
-            # Compare various raster parameters
-            status = list()
+        status.append(RasterCmp.extent_diff_cols(ds_test, ds_mast))
 
-            status.append(RasterCmp.compare_proj_ref(ds_test, ds_mast))
+        status.append(RasterCmp.extent_diff_rows(ds_test, ds_mast))
 
-            status.append(RasterCmp.compare_geo_trans(ds_test, ds_mast))
+        # If any above tests fail, go to next iteration
+        if any(stat is False for stat in status):
+            return PairResult(test, mast, ext, 'error', [])
 
-            status.append(RasterCmp.extent_diff_cols(ds_test, ds_mast))
+        # Count number of sub-bands in the files
+        d_range = Find.count(test, ds_test, mast, ds_mast, ext)
 
-            status.append(RasterCmp.extent_diff_rows(ds_test, ds_mast))
+        if d_range is None:
+            logger.critical("Number of files different; data cannot be tested successfully.")
 
-            # If any above tests fail, go to next iteration
-            if any(stat is False for stat in status):
-                continue
+            return PairResult(test, mast, ext, 'error', [])
 
-            # Count number of sub-bands in the files
-            d_range = Find.count(i, ds_test, j, ds_mast, ext)
+        # raw ENVI files are diffed straight from memory maps where possible
+        envi = None
+        if ext == ".img":
+            envi = (EnviIO.open(test), EnviIO.open(mast))
 
-            if d_range is None:
-                logger.critical("Number of files different; data cannot be tested successfully.")
+            if any(e is None or e.bands != d_range for e in envi):
+                envi = None
 
-                continue
+        if envi is not None:
+            interleaved = envi[0].interleave in ("bip", "bil")
+
+        else:
+            interleaved = RasterIO.interleave(ds_test) in ("PIXEL", "LINE")
+
+        bands = list()
+
+        # pixel and line interleaved bands are read together, one row block
+        # of all bands at a time
+        if d_range > 1 and ext == ".img" and interleaved:
+            logger.info("Reading all {0} bands of {1} together...".format(d_range, test))
+
+            bands = compare_bulk(test, mast, ds_test, ds_mast, dir_out,
+                                 include_nd=include_nd, window_size=window_size,
+                                 envi=envi)
+
+        # if sub-bands exist, read them one-by-one and do diffs + stats
+
+        elif d_range > 1 and ext == ".img":
+            for ii in range(0, d_range):
+                # Get the first band from each raster
+                logger.info("Reading sub-band {0} from .img {1}...".format(ii, test))
+
+                bands.append(GeoImage.compare_bands(test, mast, ds_test, ds_mast, dir_out,
+                                                    band_no=ii + 1, rast_num=ii,
+                                                    include_nd=include_nd,
+                                                    window_size=window_size,
+                                                    envi=envi))
+
+        elif d_range > 1:
+            # list the SDS of each container once; each SDS is opened once
+            with Subdatasets() as sds:
+                sds.list(test, ds_test)
+
+                sds.list(mast, ds_mast)
 
-            # if sub-bands exist, read them one-by-one and do diffs + stats
-            if d_range > 1:
                 for ii in range(0, d_range):
-                    # Get the first band from each raster
-                    if ext == ".img":
-                        logger.info("Reading sub-band {0} from .img {1}...".format(ii, i))
+                    logger.info("Reading .hdf/.nc SDS {0} ({1}) from file {2}...".format(ii, sds.name(test, ii),
+                                                                                       test))
 
-                        ds_tband = RasterIO.read_band_as_array(ds_test, ii)
+                    if sds.name(test, ii) != sds.name(mast, ii):
+                        logger.warning("SDS {0} names differ. Test: {1} | Master: {2}".format(
+                            ii, sds.name(test, ii), sds.name(mast, ii)))
 
-                        ds_mband = RasterIO.read_band_as_array(ds_mast, ii)
+                    if sds.nodata(test, ii) != sds.nodata(mast, ii):
+                        logger.warning("SDS {0} NoData values differ. Test: {1} | Master: {2}".format(
+                            ii, sds.nodata(test, ii), sds.nodata(mast, ii)))
 
-                    else:
-                        logger.info("Reading .hdf/.nc SDS {0} from file {0}...".format(ii, i))
+                    bands.append(GeoImage.compare_bands(test, mast, sds.open(test, ii), sds.open(mast, ii),
+                                                        dir_out, rast_num=ii,
+                                                        include_nd=include_nd,
+                                                        window_size=window_size))
 
-                        sds_tband = RasterIO.open_raster(RasterIO.get_sds(ds_test)[ii][0])
+        else:  # else it's a singleband raster
+            logger.info("Reading {0}...".format(test))
 
-                        sds_mband = RasterIO.open_raster(RasterIO.get_sds(ds_mast)[ii][0])
+            bands.append(GeoImage.compare_bands(test, mast, ds_test, ds_mast, dir_out,
+                                                include_nd=include_nd,
+                                                window_size=window_size,
+                                                envi=envi))
 
-                        ds_tband, t_nd = RasterIO.read_band_as_array(sds_tband)
+        if any(band.status == 'error' for band in bands):
+            status = 'error'
 
-                        ds_mband, m_nd = RasterIO.read_band_as_array(sds_mband)
+        elif any(band.status == 'different' for band in bands):
+            status = 'different'
 
-                    # do image differencing without masking NoData
-                    if isinstance(t_nd, type(None)) or include_nd:
-                        diff = do_diff(ds_tband, ds_mband)
+        else:
+            status = 'match'
 
-                    # do image differencing with NoData masked
-                    else:
-                        diff = do_diff(ds_tband, ds_mband, nodata=int(t_nd))
+        return PairResult(test, mast, ext, status, bands)
 
-                    # call stats functions to write out results/plots/etc.
-                    call_stats(i, j, diff, i, dir_out, rast_num=ii)
+    @staticmethod
+    def check_images(test, mast, dir_out, ext, include_nd=False,
+                     window_size=None, pool=None):
+        """Compare the test and master images, both for their raw contents and
+        geographic parameters. If differences exist, produce diff plot + CSV
+        stats file.
 
-            else:  # else it's a singleband raster
-                logger.info("Reading {0}...".format(i))
+        Args:
+            test <str>: path to test image
+            mast <str>: path to master image
+            dir_out <str>: path to output directory
+            ext <str>: file extension
+            include_nd <bool>: incl. nodata values in file cmp (default=False)
+            window_size <int>: if set, compare bands in block-aligned windows
+                               of at most this many pixels (default=None)
+            pool <parallel.PairPool>: pool to run the pairs on; results go to
+                                      its writer (default=None, run serially
+                                      and write stats.csv directly)
+        """
+        logger.warning("Checking {0} files...".format(ext))
+
+        # clean up non-matching files
+        test, mast = Cleanup.remove_nonmatching_files(test, mast)
 
-                # read in bands as array
-                ds_tband, t_nd = RasterIO.read_band_as_array(ds_test)
+        # make sure there are actually files to check
+        if mast is None or test is None:
+            logger.error("No {0} files to check in test and/or mast directories.".format(ext))
 
-                ds_mband, m_nd = RasterIO.read_band_as_array(ds_mast)
+            return False
 
-                # do diff
-                if isinstance(t_nd, type(None)) or include_nd:
-                    diff = do_diff(ds_tband, ds_mband)
+        local_pool = pool is None
+        if local_pool:
+            pool = PairPool(writer=partial(stats.write_result, dir_out))
 
-                else:
-                    diff = do_diff(ds_tband, ds_mband, nodata=int(t_nd))
+        # do other comparison checks, return stats + plots if diffs exist
+        for i, j in zip(test, mast):
+            pool.submit(GeoImage.check_pair, i, j, dir_out, ext,
+                        include_nd=include_nd, window_size=window_size)
 
-                # call stats functions to write out results/plots/etc.
-                call_stats(i, j, diff, i, dir_out)
+        if local_pool:
+            pool.close()
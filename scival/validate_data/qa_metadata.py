@@ -1,49 +1,513 @@
 """qa_metadata.py"""
 
 import os
+import json
+import difflib
+import itertools
 
 from lxml import etree
 
-from scival.validate_data.file_io import Cleanup, ImWrite
+from scival.validate_data.file_io import Archive, Checksum, Cleanup, ImWrite
 from scival.validate_data.qa_images import ArrayImage
-from scival import logger
+from scival.validate_data.parallel import PairResult, PairPool
+from scival import logger, trace
+
+# lines read from each file per round of the streaming text diff
+TEXT_CHUNK = 10000
+
+# changed lines logged per file pair; the rest are only counted
+MAX_REPORTED = 100
+
+# absolute tolerances of numeric ESPA XML fields, matched against the end of
+# the field path ("valid_range@min", "bounding_coordinates/west", ...)
+XML_TOLERANCES = {
+    "@scale_factor": 1e-6,
+    "@add_offset": 1e-6,
+    "valid_range@min": 1e-6,
+    "valid_range@max": 1e-6,
+    "bounding_coordinates/west": 1e-6,
+    "bounding_coordinates/east": 1e-6,
+    "bounding_coordinates/north": 1e-6,
+    "bounding_coordinates/south": 1e-6,
+    "@latitude": 1e-6,
+    "@longitude": 1e-6,
+    "@zenith": 1e-4,
+    "@azimuth": 1e-4,
+}
+
+# ESPA XML fields that change with every run and are not compared
+XML_IGNORE = ("production_date", "app_version")
+
+# schema path -> (mtime, compiled etree.XMLSchema), for the current process
+_schemas = dict()
+
+
+def diff_lines(test_lines, mast_lines, chunk=TEXT_CHUNK):
+    """Streaming line diff of two files. Lines are read in chunks and
+    aligned with difflib; everything up to the last matching block of a
+    round is reported and the rest is carried into the next round, so
+    memory is bounded by a few chunks instead of the file size.
+
+    Args:
+        test_lines <iterable>: lines of the test file (e.g. an open file)
+        mast_lines <iterable>: lines of the master file
+        chunk <int>: lines read from each file per round
+
+    Yields:
+        <tuple>: ("+", test line number, line) for lines only in the test
+                 file, ("-", master line number, line) for lines only in
+                 the master file
+    """
+    t_iter, m_iter = iter(test_lines), iter(mast_lines)
+    t_buf, m_buf = list(), list()
+    t_base, m_base = 1, 1
+    t_eof, m_eof = False, False
+
+    while True:
+        if not t_eof:
+            new = list(itertools.islice(t_iter, chunk))
+            t_eof = len(new) < chunk
+            t_buf += new
+
+        if not m_eof:
+            new = list(itertools.islice(m_iter, chunk))
+            m_eof = len(new) < chunk
+            m_buf += new
+
+        done = t_eof and m_eof
+
+        sm = difflib.SequenceMatcher(None, m_buf, t_buf, autojunk=False)
+
+        matched = [b for b in sm.get_matching_blocks() if b.size]
+
+        if done or (not matched and len(m_buf) + len(t_buf) > 4 * chunk):
+            # the end of both files, or no common line in a bounded window
+            m_cut, t_cut = len(m_buf), len(t_buf)
+
+        elif matched:
+            m_cut = matched[-1].a + matched[-1].size
+            t_cut = matched[-1].b + matched[-1].size
+
+        else:
+            m_cut, t_cut = 0, 0
+
+        for tag, i1, i2, j1, j2 in sm.get_opcodes():
+            if tag == "equal":
+                continue
+
+            for ii in range(i1, min(i2, m_cut)):
+                yield ("-", m_base + ii, m_buf[ii])
+
+            for jj in range(j1, min(j2, t_cut)):
+                yield ("+", t_base + jj, t_buf[jj])
+
+        t_buf, m_buf = t_buf[t_cut:], m_buf[m_cut:]
+        t_base, m_base = t_base + t_cut, m_base + m_cut
+
+        if done:
+            break
+
+
+def _local(tag):
+    """Tag without its namespace"""
+    return tag.split("}")[-1]
+
+
+def _flatten(elem, prefix="", out=None):
+    """Flatten an element into field path -> value: child elements are
+    joined with "/", attributes with "@", repeated siblings get an index."""
+    if out is None:
+        out = dict()
+
+    for key, value in elem.attrib.items():
+        out[prefix + "@" + _local(key)] = value
+
+    children = [c for c in elem if isinstance(c.tag, str)]
+
+    text = (elem.text or "").strip()
+    if text and not children:
+        out[prefix or "."] = text
+
+    names = [_local(c.tag) for c in children]
+
+    seen = dict()
+    for child, name in zip(children, names):
+        path = prefix + "/" + name if prefix else name
+
+        if names.count(name) > 1:
+            seen[name] = seen.get(name, 0) + 1
+
+            path += "[{0}]".format(seen[name])
+
+        _flatten(child, path, out)
+
+    return out
+
+
+def xml_records(xml_file):
+    """Stream an ESPA XML file into per-band records. Each band is flattened
+    and removed from the tree as soon as it is parsed, so memory does not
+    grow with the number of bands; everything outside the bands is kept
+    under "global".
+
+    Args:
+        xml_file <file>: XML file opened in binary mode
+
+    Returns:
+        <dict>: band name (or "global") -> {field path: value}
+    """
+    records = dict()
+
+    for _, elem in etree.iterparse(xml_file, events=("end",)):
+        parent = elem.getparent()
+
+        if _local(elem.tag) == "band" and parent is not None:
+            name = elem.get("name", "band")
+
+            key, n = name, 1
+            while key in records:
+                n += 1
+                key = "{0}#{1}".format(name, n)
+
+            records[key] = _flatten(elem)
+
+            parent.remove(elem)
+
+        elif parent is None:
+            records["global"] = _flatten(elem)
+
+    return records
+
+
+def load_xml_tolerances(path=None):
+    """Read XML comparison settings from a JSON file of the form
+    {"tolerances": {"<field path suffix>": 0.001, ...}, "ignore": [...]}.
+    Tolerances are added to (or replace) XML_TOLERANCES; "ignore", if
+    given, replaces XML_IGNORE.
+
+    Args:
+        path <str>: path to the JSON file (default=None, the defaults)
+
+    Returns:
+        <tuple>: (tolerances, ignore) for compare_xml_records
+    """
+    tolerances, ignore = dict(XML_TOLERANCES), XML_IGNORE
+
+    if path:
+        with open(path) as f:
+            config = json.load(f)
+
+        tolerances.update((key, float(value)) for key, value in config.get("tolerances", {}).items())
+
+        ignore = tuple(config.get("ignore", ignore))
+
+    return tolerances, ignore
+
+
+def _field_name(path):
+    """Last element or attribute name of a field path"""
+    return path.replace("@", "/").split("/")[-1].split("[")[0]
+
+
+def compare_xml_records(test, mast, tolerances=None, ignore=None):
+    """Compare per-band XML records field by field.
+
+    Args:
+        test <dict>: records of the test file (see xml_records)
+        mast <dict>: records of the master file
+        tolerances <dict>: field path suffix -> absolute tolerance for
+                           numeric fields (default=XML_TOLERANCES)
+        ignore <tuple>: field names not compared (default=XML_IGNORE)
+
+    Returns:
+        <dict>: band -> differences; a band missing from one side maps to
+                {"missing_in": "test"|"master"}, a differing field maps to
+                {"test": value, "master": value}
+    """
+    if tolerances is None:
+        tolerances = XML_TOLERANCES
+
+    if ignore is None:
+        ignore = XML_IGNORE
+
+    report = dict()
+
+    for band in sorted(set(test) | set(mast)):
+        if band not in test or band not in mast:
+            report[band] = {"missing_in": "test" if band not in test else "master"}
+
+            continue
+
+        diffs = dict()
+
+        for field in sorted(set(test[band]) | set(mast[band])):
+            if _field_name(field) in ignore:
+                continue
+
+            t_val, m_val = test[band].get(field), mast[band].get(field)
+
+            if t_val == m_val:
+                continue
+
+            tol = [v for k, v in tolerances.items() if field.endswith(k)]
+
+            if tol and t_val is not None and m_val is not None:
+                try:
+                    if abs(float(t_val) - float(m_val)) <= tol[0]:
+                        continue
+
+                except ValueError:
+                    pass
+
+            diffs[field] = {"test": t_val, "master": m_val}
+
+        if diffs:
+            report[band] = diffs
+
+    return report
 
 
 class MetadataQA:
     @staticmethod
-    def check_xml_schema(test, schema):
-        """Ensure XML matches ESPA schema.
+    def load_schema(schema):
+        """Compile an XML schema, once per process; it is compiled again
+        only if the file changed.
+        :param schema: <str> Path to XML schema file.
+        :return: <etree.XMLSchema>
+        """
+        mtime = os.stat(schema).st_mtime_ns
+
+        cached = _schemas.get(schema)
+
+        if cached is None or cached[0] != mtime:
+            logger.info("Compiling XML schema {0}".format(schema))
+
+            with trace.span("compile_schema"):
+                cached = _schemas[schema] = (mtime, etree.XMLSchema(etree.parse(schema)))
+
+        return cached[1]
+
+    @staticmethod
+    def validate_xml(test, schema):
+        """Validate one XML file, logging every schema error with its line.
         :param test: <str> XML metadata file to compare with schema.
         :param schema: <str> Path to XML schema file.
-        :return: None
+        :return: <parallel.PairResult> for (test, schema): 'match' if valid,
+                 'different' if not, 'error' if the XML cannot be parsed
         """
-        # read schema
-        xmlschema = etree.XMLSchema(etree.parse(schema))
+        xmlschema = MetadataQA.load_schema(schema)
 
         # read XML
-        xmlfile = etree.parse(test)
+        try:
+            with trace.span("validate_xml"), Archive.open_file(test, "rb") as xml_in:
+                xmlfile = etree.parse(xml_in)
+
+                # do validation
+                result = xmlschema.validate(xmlfile)
 
-        # do validation
-        result = xmlschema.validate(xmlfile)
+        except etree.XMLSyntaxError as e:
+            logger.critical('XML file {0} could not be parsed: {1}'.format(test, e))
+
+            return PairResult(test, schema, '.xsd', 'error', [])
 
         if result:
             logger.warning('XML file {0} is valid with XML schema {1}.'
                             .format(test, schema))
 
+            return PairResult(test, schema, '.xsd', 'match', [])
+
+        logger.critical('XML file {0} is NOT valid with XML schema {1}: {2} errors.'
+                         .format(test, schema, len(xmlschema.error_log)))
+
+        for error in xmlschema.error_log:
+            logger.error('{0}:{1}:{2}: {3}'.format(test, error.line, error.column, error.message))
+
+        return PairResult(test, schema, '.xsd', 'different', [])
+
+    @staticmethod
+    def check_xml_schema(test, schema, pool=None):
+        """Ensure XML matches ESPA schema. The schema is compiled once per
+        process and the files are validated on the pool.
+        :param test: <list> XML metadata files (or a single file) to compare with schema.
+        :param schema: <str> Path to XML schema file.
+        :param pool: <parallel.PairPool> pool to validate on (default=None, run serially)
+        :return: None
+        """
+        if isinstance(test, str):
+            test = [test]
+
+        local_pool = pool is None
+        if local_pool:
+            pool = PairPool()
+
+        for xml in test:
+            pool.submit(MetadataQA.validate_xml, xml, schema)
+
+        if local_pool:
+            pool.close()
+
+    @staticmethod
+    def check_text_pair(test, mast, ext):
+        """Check a single master and test text-based file line-by-line for
+        differences. Byte-identical files (same size and hash) are not
+        read line by line; otherwise lines added in the test file and
+        removed from the master file are reported with their line numbers.
+
+        Args:
+            test <str>: path to test text file
+            mast <str>: path to master text file
+            ext <str>: file extension (should be .txt, .xml or .gtf
+
+        Returns:
+            <parallel.PairResult>: status of the pair
+        """
+        # Check file names for name differences.
+        # Print non-matching names in details.
+        # get file names
+        i_fn = test.split(os.sep)[-1]
+        j_fn = mast.split(os.sep)[-1]
+        if i_fn != j_fn:
+            logger.error("{0} file names differ. Master: {1} | Test: {2}".
+                          format(ext, mast, test))
+            return PairResult(test, mast, ext, 'error', [])
         else:
-            logger.critical('XML file {0} is NOT valid with XML schema {1}.'
-                             .format(test, schema))
+            logger.info("{0} file names equivalent. Master: {1} | Test: "
+                         "{2}".format(ext, mast, test))
+
+        if Checksum.identical(test, mast):
+            logger.info("No differences between {0} and {1}.".
+                         format(test, mast))
+
+            return PairResult(test, mast, ext, 'match', [])
+
+        # Check open files line-by-line for changes.
+        # Print non-matching lines in details.
+        counts = {"+": 0, "-": 0}
+
+        with trace.span("text_diff") as sp, Archive.open_file(test) as topen, Archive.open_file(mast) as mopen:
+            sp.add(nbytes=Archive.getsize(test) + Archive.getsize(mast))
+
+            for op, line_no, line in diff_lines(topen, mopen):
+                counts[op] += 1
+
+                if counts["+"] + counts["-"] <= MAX_REPORTED:
+                    if op == "+":
+                        logger.error("{0} line {1} added in Test {2}: {3}".format(ext, line_no, test,
+                                                                                line.rstrip("\n")))
+
+                    else:
+                        logger.error("{0} line {1} removed from Master {2}: {3}".format(ext, line_no, mast,
+                                                                                      line.rstrip("\n")))
+
+        if counts["+"] or counts["-"]:
+            logger.error("{0} changes: {1} lines added, {2} lines removed. Master: {3} | Test: {4}".
+                          format(ext, counts["+"], counts["-"], mast, test))
+
+            return PairResult(test, mast, ext, 'different', [])
+
+        logger.info("No differences between {0} and {1}.".
+                     format(test, mast))
+
+        return PairResult(test, mast, ext, 'match', [])
+
+    @staticmethod
+    def check_xml_pair(test, mast, dir_out, tolerances=None, ignore=None):
+        """Compare a single pair of ESPA XML metadata files band by band,
+        with numeric tolerances and volatile fields ignored. Differences are
+        written to <dir_out>/<test file>_diff.json.
+
+        Args:
+            test <str>: path to test XML file
+            mast <str>: path to master XML file
+            dir_out <str>: path to output directory
+            tolerances <dict>: field path suffix -> absolute tolerance
+                               (default=None, XML_TOLERANCES)
+            ignore <tuple>: field names not compared
+                            (default=None, XML_IGNORE)
+
+        Returns:
+            <parallel.PairResult>: status of the pair
+        """
+        if Checksum.identical(test, mast):
+            logger.info("No differences between {0} and {1}.".format(test, mast))
+
+            return PairResult(test, mast, '.xml', 'match', [])
+
+        try:
+            with trace.span("xml_diff") as sp, Archive.open_file(test, "rb") as t_xml, \
+                    Archive.open_file(mast, "rb") as m_xml:
+                sp.add(nbytes=Archive.getsize(test) + Archive.getsize(mast))
+
+                report = compare_xml_records(xml_records(t_xml), xml_records(m_xml), tolerances, ignore)
+
+        except etree.XMLSyntaxError as e:
+            logger.error("Could not parse XML: {0}. Test: {1} | Master: {2}".format(e, test, mast))
+
+            return PairResult(test, mast, '.xml', 'error', [])
+
+        if not report:
+            logger.info("No differences between {0} and {1}.".format(test, mast))
+
+            return PairResult(test, mast, '.xml', 'match', [])
+
+        for band, diffs in sorted(report.items()):
+            logger.error("XML band {0} differs: {1}".format(band, diffs))
+
+        fn_out = os.path.join(dir_out, test.split(os.sep)[-1] + "_diff.json")
+
+        with open(fn_out, "w") as f:
+            json.dump({"test": test, "master": mast, "bands": report}, f, indent=2, sort_keys=True)
+
+        logger.error("XML differences in {0} bands written to {1}".format(len(report), fn_out))
+
+        return PairResult(test, mast, '.xml', 'different', [])
 
     @staticmethod
-    def check_text_files(test, mast, ext):
+    def check_xml_files(test, mast, dir_out, pool=None, tolerances=None, ignore=None):
+        """Compare master and test ESPA XML metadata files band by band.
+
+        Args:
+            test <list>: paths to test XML files
+            mast <list>: paths to master XML files
+            dir_out <str>: path to output directory
+            pool <parallel.PairPool>: pool to run the pairs on
+                                      (default=None, run serially)
+            tolerances <dict>: field path suffix -> absolute tolerance
+                               (default=None, XML_TOLERANCES)
+            ignore <tuple>: field names not compared
+                            (default=None, XML_IGNORE)
+        """
+        logger.info("Checking .xml files...")
+
+        test, mast = Cleanup.remove_nonmatching_files(test, mast)
+
+        if not mast or not test:
+            logger.warning("No .xml files to check in test and/or mast directories.")
+            return
+
+        local_pool = pool is None
+        if local_pool:
+            pool = PairPool()
+
+        for i, j in zip(test, mast):
+            pool.submit(MetadataQA.check_xml_pair, i, j, dir_out, tolerances, ignore)
+
+        if local_pool:
+            pool.close()
+
+    @staticmethod
+    def check_text_files(test, mast, ext, pool=None):
         """Check master and test text-based files (headers, XML, etc.)
         line-by-line for differences.
-        Sort all the lines to attempt to capture new entries.
+        Lines are diffed in order, streaming, so moved and removed lines are
+        reported too.
 
         Args:
             test <str>: path to test text file
             mast <str>: path to master text file
             ext <str>: file extension (should be .txt, .xml or .gtf
+            pool <parallel.PairPool>: pool to run the pairs on
+                                      (default=None, run serially)
         """
         logger.info("Checking {0} files...".format(ext))
 
@@ -60,50 +524,71 @@ class MetadataQA:
                           " {2}".format(ext, len(mast), len(test)))
             return
 
+        local_pool = pool is None
+        if local_pool:
+            pool = PairPool()
+
         for i, j in zip(test, mast):
-            topen = open(i)
-            mopen = open(j)
-
-            # Read text line-by-line from file
-            file_topen = topen.readlines()
-            file_mopen = mopen.readlines()
-
-            # Close files
-            topen.close()
-            mopen.close()
-
-            # Check file names for name differences.
-            # Print non-matching names in details.
-            # get file names
-            i_fn = i.split(os.sep)[-1]
-            j_fn = j.split(os.sep)[-1]
-            if i_fn != j_fn:
-                logger.error("{0} file names differ. Master: {1} | Test: {2}".
-                              format(ext, j, i))
-                return
-            else:
-                logger.info("{0} file names equivalent. Master: {1} | Test: "
-                             "{2}".format(ext, j, i))
-
-            # Check open files line-by-line (sorted) for changes.
-            # Print non-matching lines in details.
-            txt_diffs = set(file_topen).difference(set(file_mopen))
-            if len(txt_diffs) > 0:
-                for k in txt_diffs:
-                    logger.error("{0} changes: {1}".format(ext, k))
-
-            else:
-                logger.info("No differences between {0} and {1}.".
-                             format(i, j))
+            pool.submit(MetadataQA.check_text_pair, i, j, ext)
+
+        if local_pool:
+            pool.close()
+
+    @staticmethod
+    def check_jpeg_pair(test: str, mast: str, dir_out: str, draft: bool = False):
+        """
+        Check a single pair of JPEG files for diffs in file size or file contents.  Plot difference image if
+        applicable
+        :param test: Path to test jpg file
+        :param mast: Path to master jpg file
+        :param dir_out: Full path to output directory
+        :param draft: If True, compare at reduced resolution first; only pairs that differ there are fully decoded,
+                      so a difference too small to show at that resolution is reported as a match
+        :return: parallel.PairResult
+        """
+        # Compare file sizes
+        if Archive.getsize(test) != Archive.getsize(mast):
+            logger.warning("JPEG file sizes do not match for "
+                            "Master {0} and Test {1}...\n".
+                            format(mast, test))
+            logger.warning("{0} size: {1}".format(
+                test, Archive.getsize(test)))
+            logger.warning("{0} size: {1}".format(
+                mast, Archive.getsize(mast)))
+
+        else:
+            logger.info("JPEG files {0} and {1} are the same "
+                         "size".format(mast, test))
+
+        # quick verdict at reduced resolution; only images that differ there are fully decoded
+        if draft and ArrayImage.check_images(test, mast, draft=True) is None:
+            return PairResult(test, mast, '.jpg', 'match', [])
+
+        # diff images
+        result = ArrayImage.check_images(test, mast)
+
+        if result is False:
+            return PairResult(test, mast, '.jpg', 'error', [])
+
+        if result is not None:
+            with trace.span("plot"):
+                ImWrite.plot_diff_image(test=test, mast=mast, diff_raster=result, fn_out=test.split(os.sep)[-1],
+                                        fn_type="diff_", dir_out=dir_out)
+
+            return PairResult(test, mast, '.jpg', 'different', [])
+
+        return PairResult(test, mast, '.jpg', 'match', [])
 
     @staticmethod
-    def check_jpeg_files(test: list, mast: list, dir_out: str) -> None:
+    def check_jpeg_files(test: list, mast: list, dir_out: str, pool: PairPool = None, draft: bool = False) -> None:
         """
         Check JPEG files (i.e., Gverify or preview images) for diffs in file size or file contents.  Plot difference
         image if applicable
         :param test: List of paths to test jpg files
         :param mast: List of paths to master jpg files
         :param dir_out: Full path to output directory
+        :param pool: Pool to run the pairs on, default is None (run serially)
+        :param draft: If True, compare at reduced resolution first and fully decode only the pairs that differ
         :return:
         """
         test, mast = Cleanup.remove_nonmatching_files(test, mast)
@@ -114,25 +599,12 @@ class MetadataQA:
                           "directories.")
 
         else:
+            local_pool = pool is None
+            if local_pool:
+                pool = PairPool()
+
             for i, j in zip(test, mast):
+                pool.submit(MetadataQA.check_jpeg_pair, i, j, dir_out, draft)
 
-                # Compare file sizes
-                if os.path.getsize(i) != os.path.getsize(j):
-                    logger.warning("JPEG file sizes do not match for "
-                                    "Master {0} and Test {1}...\n".
-                                    format(j, i))
-                    logger.warning("{0} size: {1}".format(
-                        i, os.path.getsize(i)))
-                    logger.warning("{0} size: {1}".format(
-                        j, os.path.getsize(j)))
-
-                else:
-                    logger.info("JPEG files {0} and {1} are the same "
-                                 "size".format(j, i))
-
-                # diff images
-                result = ArrayImage.check_images(i, j)
-
-                if result:
-                    ImWrite.plot_diff_image(test=i, mast=j, diff_raster=result, fn_out=i.split(os.sep)[-1],
-                                            fn_type="diff_", dir_out=dir_out)
+            if local_pool:
+                pool.close()
@@ -39,20 +39,267 @@ def pct_diff_raster(ds_tband: np.ndarray, ds_mband: np.ndarray, diff_rast: np.nd
     return pct_diff_raster
 
 
-def img_stats(test: str, mast: str, diff_img: np.ndarray, dir_in: str, fn_in: str, dir_out: str, sds_ct: int=0) -> None:
+HEADER = ("dir",
+          "test_file",
+          "master_file",
+          "mean",
+          "min",
+          "max",
+          "25_percentile",
+          "75_percentile",
+          "1_percentile",
+          "99_percentile",
+          "std_dev",
+          "median")
+
+# up to this many differing values are kept, so percentiles are exact (as
+# np.percentile) unless a difference image has more differing pixels
+EXACT_LIMIT = 1000000
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with bounded relative error.
+
+    Values are counted in logarithmically sized buckets (as in DDSketch,
+    Masson et al. 2019), so any quantile estimate is within `alpha` of the
+    true value, relative to its magnitude. Sketches built from separate
+    blocks, bands or processes merge exactly by adding bucket counts.
     """
-    Log stats from array
+
+    def __init__(self, alpha: float=0.005):
+        self.alpha = alpha
+        self.gamma = (1.0 + alpha) / (1.0 - alpha)
+        self.log_gamma = np.log(self.gamma)
+        self.pos = dict()
+        self.neg = dict()
+        self.zeros = 0
+        self.count = 0
+
+    def _add(self, store: dict, mags: np.ndarray) -> None:
+        """
+        Count magnitudes into a bucket store
+        :param store: bucket index -> count
+        :param mags: array of positive magnitudes
+        :return:
+        """
+        if mags.size == 0:
+            return None
+
+        idx = np.ceil(np.log(mags) / self.log_gamma).astype(np.int64)
+        lo = idx.min()
+        counts = np.bincount(idx - lo)
+
+        for k in np.flatnonzero(counts):
+            key = int(k + lo)
+            store[key] = store.get(key, 0) + int(counts[k])
+
+        return None
+
+    def update(self, vals: np.ndarray) -> None:
+        """
+        Add a 1-d array of values to the sketch
+        :param vals: values
+        :return:
+        """
+        vals = np.asarray(vals, dtype=np.float64)
+
+        tiny = np.finfo(np.float64).tiny
+        self._add(self.pos, vals[vals > tiny])
+        self._add(self.neg, -vals[vals < -tiny])
+
+        self.zeros += int(np.count_nonzero(np.abs(vals) <= tiny))
+        self.count += vals.size
+
+        return None
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """
+        Merge another sketch, built with the same alpha, into this one
+        :param other: sketch to merge
+        :return:
+        """
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with different accuracy.")
+
+        for store, other_store in ((self.pos, other.pos), (self.neg, other.neg)):
+            for key, ct in other_store.items():
+                store[key] = store.get(key, 0) + ct
+
+        self.zeros += other.zeros
+        self.count += other.count
+
+        return None
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate the q-th quantile (0 <= q <= 1)
+        :param q: quantile
+        :return:
+        """
+        if self.count == 0:
+            return np.nan
+
+        rank = q * (self.count - 1)
+
+        # walk buckets in ascending order of value
+        buckets = [(key, self.neg[key], -1.0) for key in sorted(self.neg, reverse=True)]
+        buckets.append((None, self.zeros, 0.0))
+        buckets += [(key, self.pos[key], 1.0) for key in sorted(self.pos)]
+
+        seen = 0
+        for key, ct, sign in buckets:
+            seen += ct
+            if seen > rank:
+                if key is None:
+                    return 0.0
+                return sign * 2.0 * self.gamma ** key / (self.gamma + 1.0)
+
+        return np.nan
+
+
+class DiffStats:
+    """Single-pass, mergeable statistics of a difference image.
+
+    Only non-zero (i.e. differing) pixels are counted, matching the original
+    img_stats behavior. Count, mean, variance, min and max are combined with
+    Chan et al.'s parallel update and quantiles come from a QuantileSketch,
+    so accumulators from windows, bands, processes or scenes can be merged
+    without holding the whole difference array. While there are at most
+    EXACT_LIMIT differing values they are also kept, and percentiles are
+    exact; past that, sketch estimates of integer differences are rounded
+    to the nearest integer.
+    """
+
+    def __init__(self, alpha: float=0.005):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = QuantileSketch(alpha)
+        self.integer = True
+        self.values = list()
+
+    def update(self, diff: np.ndarray) -> None:
+        """
+        Add the differing pixels of a (possibly masked) difference array
+        :param diff: difference array
+        :return:
+        """
+        vals = np.ma.compressed(diff)
+        vals = vals[vals != 0]
+
+        n = vals.size
+        if n == 0:
+            return None
+
+        mean = vals.mean(dtype=np.float64)
+        m2 = np.square(vals - mean, dtype=np.float64).sum()
+
+        self._combine(n, mean, m2, vals.min(), vals.max())
+
+        self.sketch.update(vals)
+
+        self.integer = self.integer and np.issubdtype(vals.dtype, np.integer)
+
+        self._keep([vals.copy()])
+
+        return None
+
+    def merge(self, other: "DiffStats") -> None:
+        """
+        Merge another accumulator into this one
+        :param other: accumulator to merge
+        :return:
+        """
+        if other.count == 0:
+            return None
+
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+
+        self.sketch.merge(other.sketch)
+
+        self.integer = self.integer and other.integer
+
+        self._keep(other.values)
+
+        return None
+
+    def _keep(self, values) -> None:
+        """Keep differing values for exact percentiles, until there are more than EXACT_LIMIT (count is updated)"""
+        if self.values is None:
+            return
+
+        if values is None or self.count > EXACT_LIMIT:
+            self.values = None
+
+        else:
+            self.values.extend(values)
+
+    def _combine(self, n: int, mean: float, m2: float, vmin, vmax) -> None:
+        """Chan et al. pairwise update of count, mean and sum of squares"""
+        total = self.count + n
+        delta = mean - self.mean
+
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    @property
+    def std(self) -> float:
+        """Population standard deviation (same as np.std)"""
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def percentile(self, p: float) -> float:
+        """
+        Exact percentile, or a sketch estimate clipped to the exact min/max
+        :param p: percentile (0 - 100)
+        :return:
+        """
+        if self.count == 0:
+            return np.nan
+
+        if self.values is not None:
+            return float(np.percentile(np.concatenate(self.values), p))
+
+        estimate = self.sketch.quantile(p / 100.0)
+
+        if self.integer:
+            estimate = np.round(estimate)
+
+        return float(np.clip(estimate, self.min, self.max))
+
+    def row(self) -> tuple:
+        """
+        Values for the stats columns of stats.csv
+        :return:
+        """
+        return (self.mean,
+                self.min,
+                self.max,
+                self.percentile(25),
+                self.percentile(75),
+                self.percentile(1),
+                self.percentile(99),
+                self.std,
+                self.percentile(50))
+
+
+def write_stats(test: str, mast: str, values: tuple, dir_in: str, fn_in: str, dir_out: str, sds_ct: int=0) -> None:
+    """
+    Append a row of stats to the stats.csv in the output directory
     :param test: name of test file
     :param mast: name of master file
-    :param diff_img: image array
+    :param values: stats values, in the order of the stats.csv columns
     :param dir_in: directory where test data exists
     :param fn_in: input filename (to identify csv entry)
     :param dir_out: output directory
     :param sds_ct: index of SDS (default=0)
     :return:
     """
-    diff_img = np.ma.masked_where(diff_img == 0, diff_img)
-
     fn_out = dir_out + os.sep + "stats.csv"
     logger.info("Writing stats for {0} to {1}.".format(fn_in, fn_out))
 
@@ -64,30 +311,46 @@ def img_stats(test: str, mast: str, diff_img: np.ndarray, dir_in: str, fn_in: st
 
         # write header if file didn't already exist
         if not file_exists:
-            writer.writerow(("dir",
-                             "test_file",
-                             "master_file",
-                             "mean",
-                             "min",
-                             "max",
-                             "25_percentile",
-                             "75_percentile",
-                             "1_percentile",
-                             "99_percentile",
-                             "std_dev",
-                             "median"))
+            writer.writerow(HEADER)
 
         writer.writerow((dir_in,
-                        test + "_" + str(sds_ct),
-                        mast + "_" + str(sds_ct),
-                        np.mean(diff_img),
-                        np.amin(diff_img),
-                        np.amax(diff_img),
-                        np.percentile(diff_img.compressed(), 25),
-                        np.percentile(diff_img.compressed(), 75),
-                        np.percentile(diff_img.compressed(), 1),
-                        np.percentile(diff_img.compressed(), 99),
-                        np.std(diff_img),
-                        np.median(diff_img.compressed())))
+                         test + "_" + str(sds_ct),
+                         mast + "_" + str(sds_ct)) + tuple(values))
 
-        return None
+    return None
+
+
+def write_result(dir_out: str, result) -> None:
+    """
+    Write the stats of every differing band of a pair comparison to stats.csv
+    :param dir_out: output directory
+    :param result: parallel.PairResult of a pair comparison
+    :return:
+    """
+    for band in result.bands:
+        if band.stats is not None:
+            write_stats(result.test, result.mast, band.stats, os.path.dirname(result.test),
+                        result.test.split(os.sep)[-1], dir_out, band.index)
+
+    return None
+
+
+def img_stats(test: str, mast: str, diff_img: np.ndarray, dir_in: str, fn_in: str, dir_out: str, sds_ct: int=0) -> None:
+    """
+    Log stats from array
+    :param test: name of test file
+    :param mast: name of master file
+    :param diff_img: image array
+    :param dir_in: directory where test data exists
+    :param fn_in: input filename (to identify csv entry)
+    :param dir_out: output directory
+    :param sds_ct: index of SDS (default=0)
+    :return:
+    """
+    acc = DiffStats()
+
+    acc.update(diff_img)
+
+    write_stats(test, mast, acc.row(), dir_in, fn_in, dir_out, sds_ct)
+
+    return None
@@ -31,7 +31,7 @@ setup(name='espa-science-validation',
           "gdal",
           "requests",
           "lxml",
-          "scikit_image",
+          "Pillow",
           "click",
       ],
       # List additional groups of dependencies here (e.g. development
@@ -49,6 +49,9 @@ setup(name='espa-science-validation',
               'sphinx',
               'sphinx-autobuild',
               'sphinx_rtd_theme'],
+          'fast': [
+              'xxhash',
+          ],
           'dev': [
               'pylint',
               'mypy',
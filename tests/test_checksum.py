@@ -0,0 +1,124 @@
+"""Checksum: byte-identical pairs and the hash cache"""
+
+import os
+
+import pytest
+
+from scival.validate_data import file_io
+from scival.validate_data.file_io import Checksum, DirIndex
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.delenv('ESPA_SCIVAL_CACHE', raising=False)
+    monkeypatch.setattr(file_io, '_hash_cache', dict())
+    monkeypatch.setattr(file_io, '_file_stat', dict())
+
+    Checksum.use_cache(str(tmp_path / 'out' / 'hashes.sqlite'))
+
+    yield str(tmp_path / 'out' / 'hashes.sqlite')
+
+    Checksum.use_cache(None)
+
+
+def write(path, data: bytes) -> str:
+    with open(str(path), 'wb') as f:
+        f.write(data)
+
+    return str(path)
+
+
+def digest(data: bytes) -> str:
+    h = Checksum.hasher()
+    h.update(data)
+
+    return h.hexdigest()
+
+
+def test_no_cached_hash_reads_nothing(tmp_path, monkeypatch):
+    test, mast = write(tmp_path / 't.tif', b'abc' * 100), write(tmp_path / 'm.tif', b'abc' * 100)
+
+    def fail(path):
+        raise AssertionError("read {0}".format(path))
+
+    monkeypatch.setattr(Checksum, 'file_hash', staticmethod(fail))
+
+    # not known to be identical, so the full comparison decides
+    assert Checksum.identical(test, mast) is False
+
+
+def test_one_cached_hash_reads_the_other(tmp_path):
+    data = b'abc' * 100
+
+    test, mast = write(tmp_path / 't.tif', data), write(tmp_path / 'm.tif', data)
+
+    Checksum.seed(mast, digest(data))
+
+    assert Checksum.identical(test, mast) is True
+
+    other = write(tmp_path / 'o.tif', b'abd' * 100)
+
+    assert Checksum.identical(other, mast) is False
+
+
+def test_sizes_differ(tmp_path):
+    test, mast = write(tmp_path / 't.tif', b'a'), write(tmp_path / 'm.tif', b'ab')
+
+    Checksum.seed(mast, digest(b'ab'))
+
+    assert Checksum.identical(test, mast) is False
+
+
+def test_cache_lives_where_it_is_set(tmp_path, cache, monkeypatch):
+    data = b'xyz'
+
+    path = write(tmp_path / 'f.tif', data)
+
+    Checksum.seed(path, digest(data))
+
+    assert os.path.exists(cache)
+
+    # a new process (empty memory cache) finds it on disk
+    monkeypatch.setattr(file_io, '_hash_cache', dict())
+
+    assert Checksum.cached_hash(path) == digest(data)
+
+
+def test_no_cache_by_default(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+
+    Checksum.use_cache(None)
+
+    data = b'xyz'
+
+    Checksum.seed(write(tmp_path / 'f.tif', data), digest(data))
+
+    assert Checksum.cache_path() is None
+    assert not os.path.exists(str(tmp_path / 'home'))
+
+
+def test_stats_from_dir_index(tmp_path, monkeypatch):
+    data = b'abc' * 100
+
+    (tmp_path / 'a').mkdir()
+
+    test, mast = write(tmp_path / 'a' / 't.tif', data), write(tmp_path / 'a' / 'm.tif', data)
+
+    index = DirIndex(str(tmp_path / 'a'))
+
+    assert index.stats['t.tif'] == (len(data), os.stat(test).st_mtime_ns, '.tif')
+
+    Checksum.seed(mast, digest(data))
+
+    stat = os.stat
+
+    def no_stat(path, *args, **kwargs):
+        assert str(path) not in (test, mast)
+
+        return stat(path, *args, **kwargs)
+
+    # sizes and mtimes come from the scan
+    monkeypatch.setattr(os, 'stat', no_stat)
+
+    assert Checksum.cached_hash(mast) == digest(data)
+    assert Checksum.identical(test, mast) is True
@@ -0,0 +1,294 @@
+"""Downloader against a local HTTP server that serves byte ranges"""
+
+import os
+import re
+import json
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from scival.retrieve_data import downloader
+from scival.retrieve_data.downloader import Cksum, Downloader, parse_cksum
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve server.data at any path, with byte ranges if server.ranges is set"""
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, send_body: bool) -> None:
+        server = self.server
+
+        data = server.data
+
+        rng = self.headers.get('Range') if server.ranges else None
+
+        if rng:
+            start, end = re.match(r'bytes=(\d+)-(\d*)', rng).groups()
+            start, end = int(start), int(end) if end else len(data) - 1
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, len(data)))
+
+            body = data[start:end + 1]
+
+        else:
+            self.send_response(200)
+
+            body = data
+
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        with server.lock:
+            server.gets.append(rng)
+
+            drop = server.drop > 0
+            server.drop -= drop
+
+        if drop:
+            # send a third of the body, then cut the connection
+            self.wfile.write(body[:len(body) // 3])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+
+            return
+
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    srv.data = os.urandom(3 * 1024 * 1024 + 123)
+    srv.ranges = True
+    srv.drop = 0
+    srv.gets = list()
+    srv.lock = threading.Lock()
+
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+
+    srv.url = 'http://127.0.0.1:{0}/scene.tar.gz'.format(srv.server_port)
+
+    yield srv
+
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture(autouse=True)
+def isolate(tmp_path, monkeypatch):
+    # keep the hash cache out of the home directory and retries fast
+    monkeypatch.setenv('ESPA_SCIVAL_CACHE', str(tmp_path / 'hashes.sqlite'))
+    monkeypatch.setattr(downloader.time, 'sleep', lambda secs: None)
+
+
+def md5(data: bytes) -> tuple:
+    return 'md5', hashlib.md5(data).hexdigest()
+
+
+def fetch(server, outfile, **kwargs):
+    digest = kwargs.pop('digest', md5(server.data))
+
+    size = kwargs.pop('size', None)
+
+    with Downloader(workers=1, **kwargs) as dl:
+        return dl.fetch(server.url, str(outfile), size=size, digest=digest)
+
+
+def read(path) -> bytes:
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+def test_resume_from_part(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    half = len(server.data) // 2
+
+    with open(str(outfile) + '.part', 'wb') as f:
+        f.write(server.data[:half])
+
+    result = fetch(server, outfile, segments=1)
+
+    assert result.status == 'downloaded'
+    assert result.bytes == len(server.data) - half
+    assert server.gets == ['bytes={0}-'.format(half)]
+    assert read(outfile) == server.data
+    assert not os.path.exists(str(outfile) + '.part')
+
+
+def test_dropped_connection_resumes(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    server.drop = 1
+
+    result = fetch(server, outfile, segments=1, retries=1)
+
+    assert result.status == 'downloaded'
+    assert read(outfile) == server.data
+
+    # the retry asks only for what the dropped transfer did not write
+    assert server.gets[0] is None
+    assert server.gets[1] == 'bytes={0}-'.format(len(server.data) // 3)
+
+
+def test_server_without_ranges_starts_over(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    server.ranges = False
+
+    with open(str(outfile) + '.part', 'wb') as f:
+        f.write(b'x' * 1000)
+
+    result = fetch(server, outfile)
+
+    assert result.status == 'downloaded'
+    assert result.bytes == len(server.data)
+    assert server.gets == [None]
+    assert read(outfile) == server.data
+
+
+def test_segmented_fetch(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    result = fetch(server, outfile, digest=None, segments=3, segment_size=1024 * 1024)
+
+    assert result.status == 'downloaded'
+    assert read(outfile) == server.data
+
+    # three closed ranges that cover the file, written in place
+    ranges = sorted(tuple(int(n) for n in re.match(r'bytes=(\d+)-(\d+)', rng).groups()) for rng in server.gets)
+
+    assert len(ranges) == 3
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(server.data) - 1
+    assert all(a[1] + 1 == b[0] for a, b in zip(ranges, ranges[1:]))
+    assert not os.path.exists(str(outfile) + '.part.json')
+
+
+def test_segmented_resume_from_state(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    size = len(server.data)
+
+    # the first segment is done, the second half done, the third not started
+    step = -(-size // 3)
+    segments = [[0, step - 1, step], [step, 2 * step - 1, step // 2], [2 * step, size - 1, 0]]
+
+    with open(str(outfile) + '.part', 'wb') as f:
+        f.write(server.data[:step + step // 2])
+        f.truncate(size)
+
+    with open(str(outfile) + '.part.json', 'w') as f:
+        json.dump({'size': size, 'segments': segments}, f)
+
+    result = fetch(server, outfile, digest=None, segments=3, segment_size=1024 * 1024)
+
+    assert result.status == 'downloaded'
+    assert result.bytes == size - step - step // 2
+    assert sorted(server.gets) == sorted(['bytes={0}-{1}'.format(step + step // 2, 2 * step - 1),
+                                          'bytes={0}-{1}'.format(2 * step, size - 1)])
+    assert read(outfile) == server.data
+
+
+def test_digest_streams_in_order(server, tmp_path, monkeypatch):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    def no_reread(hashers, path):
+        raise AssertionError("read {0} back".format(path))
+
+    monkeypatch.setattr(downloader, '_hash_into', no_reread)
+
+    result = fetch(server, outfile, segments=3, segment_size=1024 * 1024)
+
+    # one connection, hashed as it is written
+    assert result.status == 'downloaded'
+    assert server.gets == [None]
+    assert read(outfile) == server.data
+
+
+def test_promoted_only_when_complete(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    # the server has fewer bytes than expected
+    result = fetch(server, outfile, size=len(server.data) + 10, segments=1, retries=0)
+
+    assert result.status == 'failed'
+    assert not os.path.exists(str(outfile))
+    assert read(str(outfile) + '.part') == server.data
+
+
+def test_bad_digest_keeps_part(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    result = fetch(server, outfile, digest=md5(b'something else'), retries=1)
+
+    assert result.status == 'failed'
+    assert not os.path.exists(str(outfile))
+    assert read(str(outfile) + '.part') == server.data
+
+    # the wrong file is downloaded again in full, not resumed
+    assert server.gets == [None, None]
+
+
+def test_cksum_url_verifies_digest(server, tmp_path):
+    outfile = tmp_path / 'scene.tar.gz'
+
+    manifest = tmp_path / 'verified.jsonl'
+
+    with Downloader(workers=1, manifest=str(manifest)) as dl:
+        dl.fetch_cksum = lambda url: (len(server.data), md5(server.data))
+
+        result = dl.fetch(server.url, str(outfile), cksum_url=server.url + '.md5')
+
+    assert result.status == 'downloaded'
+
+    entry = json.loads(read(manifest).decode())
+
+    assert entry['verified'] == 'md5'
+    assert entry['md5'] == hashlib.md5(server.data).hexdigest()
+
+
+# values printed by cksum
+@pytest.mark.parametrize('data, crc', [(b'', '4294967295'), (b'123456789', '930766865'),
+                                       (b'x' * 70000, '4215398528')], ids=['empty', 'digits', 'long'])
+def test_cksum_matches_posix(data, crc):
+    cksum = Cksum()
+
+    # fed in pieces, as the download is
+    for i in range(0, len(data), 4096):
+        cksum.update(data[i:i + 4096])
+
+    assert cksum.hexdigest() == crc
+
+
+def test_posix_cksum_verifies_crc(server, tmp_path):
+    crc = Cksum()
+    crc.update(server.data)
+
+    good = '{0} {1} scene.tar.gz\n'.format(crc.hexdigest(), len(server.data))
+    forged = '12345 {0} scene.tar.gz\n'.format(len(server.data))
+
+    for name, text, status in (('good', good, 'downloaded'), ('forged', forged, 'failed')):
+        outfile = tmp_path / name / 'scene.tar.gz'
+
+        with Downloader(workers=1, retries=0) as dl:
+            dl.fetch_cksum = lambda url: parse_cksum(text)
+
+            assert dl.fetch(server.url, str(outfile), cksum_url=server.url + '.cksum').status == status
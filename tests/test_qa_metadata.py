@@ -0,0 +1,142 @@
+"""Streaming text diff and band by band XML comparison"""
+
+import io
+import json
+import difflib
+
+import pytest
+
+# qa_metadata reads JPEGs through qa_images, which needs GDAL
+try:
+    from osgeo import gdal  # noqa: F401
+except ImportError:
+    pytest.importorskip('gdal')
+
+from scival.validate_data.qa_metadata import (XML_IGNORE, XML_TOLERANCES, compare_xml_records, diff_lines,
+                                              load_xml_tolerances, xml_records)
+
+
+def numbered(n, prefix='line'):
+    return ['{0} {1}\n'.format(prefix, i) for i in range(n)]
+
+
+def expected(test, mast):
+    """Lines only in the test ("+") or only in the master ("-"), from a plain difflib pass"""
+    out = set()
+
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, mast, test, autojunk=False).get_opcodes():
+        if tag != 'equal':
+            out.update(('-', ii + 1, mast[ii]) for ii in range(i1, i2))
+            out.update(('+', jj + 1, test[jj]) for jj in range(j1, j2))
+
+    return out
+
+
+def test_identical_files_have_no_diff():
+    lines = numbered(250)
+
+    assert list(diff_lines(iter(lines), iter(lines), chunk=7)) == []
+
+
+@pytest.mark.parametrize('chunk', [3, 10, 1000])
+def test_changes_across_chunks(chunk):
+    mast = numbered(100)
+
+    test = list(mast)
+    test[5] = 'changed 5\n'
+    del test[40:43]
+    test.insert(80, 'added\n')
+    test.append('last\n')
+
+    diffs = list(diff_lines(iter(test), iter(mast), chunk=chunk))
+
+    assert set(diffs) == expected(test, mast)
+    assert len(diffs) == len(set(diffs))
+
+
+def test_moved_lines_are_reported():
+    mast = numbered(30)
+
+    test = mast[10:] + mast[:10]
+
+    diffs = list(diff_lines(iter(test), iter(mast), chunk=8))
+
+    assert {line for _, _, line in diffs} == set(mast[:10])
+    assert {sign for sign, _, _ in diffs} == {'+', '-'}
+
+
+def test_one_side_empty():
+    lines = numbered(12)
+
+    assert list(diff_lines(iter(lines), iter([]), chunk=5)) == [('+', i + 1, line) for i, line in enumerate(lines)]
+    assert list(diff_lines(iter([]), iter(lines), chunk=5)) == [('-', i + 1, line) for i, line in enumerate(lines)]
+
+
+def test_nothing_in_common_is_bounded():
+    mast, test = numbered(60, 'master'), numbered(60, 'test')
+
+    diffs = list(diff_lines(iter(test), iter(mast), chunk=5))
+
+    assert sorted(diffs) == sorted([('-', i + 1, line) for i, line in enumerate(mast)] +
+                                   [('+', i + 1, line) for i, line in enumerate(test)])
+
+
+ESPA = ('<espa_metadata xmlns="http://espa.cr.usgs.gov/v2"><global_metadata>'
+        '<bounding_coordinates><west>{west}</west></bounding_coordinates></global_metadata><bands>'
+        '<band name="sr_band1" scale_factor="{scale}"><production_date>{date}</production_date>'
+        '<valid_range min="-2000" max="16000"/></band>{extra}</bands></espa_metadata>')
+
+
+def records(west='-105.0', scale='0.0001', date='2017-02-26', extra=''):
+    text = ESPA.format(west=west, scale=scale, date=date, extra=extra)
+
+    return xml_records(io.BytesIO(text.encode()))
+
+
+def test_xml_records_by_band():
+    recs = records(extra='<band name="sr_band2" scale_factor="1"/>')
+
+    assert set(recs) == {'global', 'sr_band1', 'sr_band2'}
+    assert recs['sr_band1']['@scale_factor'] == '0.0001'
+    assert recs['sr_band1']['valid_range@min'] == '-2000'
+    assert recs['global']['global_metadata/bounding_coordinates/west'] == '-105.0'
+
+
+def test_xml_within_tolerance_and_ignored_fields():
+    mast = records()
+
+    # a rounding difference and a new production date only
+    test = records(west='-105.0000004', scale='0.00010000001', date='2018-06-01')
+
+    assert compare_xml_records(test, mast) == {}
+
+
+def test_xml_differences():
+    mast = records()
+
+    test = records(west='-104.9', scale='0.0002', extra='<band name="sr_band2"/>')
+
+    report = compare_xml_records(test, mast)
+
+    assert report['sr_band2'] == {'missing_in': 'master'}
+    assert report['sr_band1'] == {'@scale_factor': {'test': '0.0002', 'master': '0.0001'}}
+    assert report['global'] == {'global_metadata/bounding_coordinates/west': {'test': '-104.9',
+                                                                              'master': '-105.0'}}
+
+
+def test_xml_tolerances_from_json(tmp_path):
+    path = tmp_path / 'xml_tol.json'
+
+    path.write_text(json.dumps({'tolerances': {'@scale_factor': 0.001}, 'ignore': []}))
+
+    tolerances, ignore = load_xml_tolerances(str(path))
+
+    assert tolerances['@scale_factor'] == 0.001
+    assert tolerances['bounding_coordinates/west'] == XML_TOLERANCES['bounding_coordinates/west']
+    assert ignore == ()
+
+    report = compare_xml_records(records(scale='0.0002', date='2018-06-01'), records(), tolerances, ignore)
+
+    assert list(report['sr_band1']) == ['production_date']
+
+    assert load_xml_tolerances(None) == (XML_TOLERANCES, XML_IGNORE)
@@ -0,0 +1,141 @@
+"""DiffStats and QuantileSketch against numpy"""
+
+import numpy as np
+import pytest
+
+from scival.validate_data import stats
+from scival.validate_data.stats import DiffStats, QuantileSketch
+
+
+@pytest.fixture
+def diffs():
+    rng = np.random.RandomState(42)
+
+    arr = rng.normal(0, 50, (300, 200)).astype(np.int32)
+
+    # pixels that do not differ are left out of the stats
+    arr[rng.rand(*arr.shape) < 0.3] = 0
+
+    return arr
+
+
+def test_split_merge_matches_numpy(diffs):
+    whole = DiffStats()
+    whole.update(diffs)
+
+    # rows in uneven blocks, merged in two halves as from two processes
+    first, second = DiffStats(), DiffStats()
+
+    for start, stop in ((0, 7), (7, 120), (120, 121)):
+        block = DiffStats()
+        block.update(diffs[start:stop])
+        first.merge(block)
+
+    second.update(diffs[121:])
+    first.merge(second)
+
+    vals = diffs[diffs != 0].astype(np.float64)
+
+    for acc in (whole, first):
+        assert acc.count == vals.size
+        assert acc.mean == pytest.approx(vals.mean(), rel=1e-12)
+        assert acc.std == pytest.approx(vals.std(), rel=1e-12)
+        assert acc.min == vals.min()
+        assert acc.max == vals.max()
+
+
+def test_merge_empty():
+    acc = DiffStats()
+    acc.merge(DiffStats())
+    acc.update(np.zeros((4, 4)))
+
+    assert acc.count == 0
+    assert np.isnan(acc.std)
+    assert np.isnan(acc.percentile(50))
+
+
+def test_masked_values_are_left_out():
+    diff = np.ma.masked_array([1, 2, 100, 3], mask=[False, False, True, False])
+
+    acc = DiffStats()
+    acc.update(diff)
+
+    assert acc.count == 3
+    assert acc.max == 3
+
+
+@pytest.mark.parametrize('alpha', [0.01, 0.005])
+def test_sketch_quantile_within_alpha(alpha):
+    rng = np.random.RandomState(7)
+
+    vals = np.concatenate([rng.lognormal(0, 2, 20000), -rng.lognormal(1, 1, 5000), np.zeros(100)])
+
+    # built from two halves, as from two processes
+    sketch, other = QuantileSketch(alpha), QuantileSketch(alpha)
+    sketch.update(vals[:12345])
+    other.update(vals[12345:])
+    sketch.merge(other)
+
+    ordered = np.sort(vals)
+
+    for q in (0.01, 0.25, 0.5, 0.75, 0.99):
+        true = ordered[int(np.floor(q * (vals.size - 1)))]
+
+        assert abs(sketch.quantile(q) - true) <= alpha * abs(true) + 1e-12
+
+
+def test_sketch_merge_needs_same_alpha():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_exact_until_limit_then_sketch(monkeypatch):
+    monkeypatch.setattr(stats, 'EXACT_LIMIT', 1000)
+
+    rng = np.random.RandomState(3)
+
+    first = rng.randint(1, 500, 600)
+    second = rng.randint(1, 500, 600)
+
+    acc = DiffStats()
+    acc.update(first)
+
+    # exact, as np.percentile, while there are at most EXACT_LIMIT values
+    assert acc.values is not None
+
+    for p in (1, 25, 50, 75, 99):
+        assert acc.percentile(p) == np.percentile(first, p)
+
+    acc.update(second)
+
+    # past the limit, integer estimates snapped to integers and clipped to the range
+    assert acc.values is None
+
+    both = np.concatenate([first, second])
+
+    for p in (1, 25, 50, 75, 99):
+        estimate = acc.percentile(p)
+
+        assert estimate == round(estimate)
+        assert both.min() <= estimate <= both.max()
+        assert abs(estimate - np.percentile(both, p)) <= 0.005 * np.percentile(both, p) + 1
+
+
+def test_merge_past_limit_drops_values(monkeypatch):
+    monkeypatch.setattr(stats, 'EXACT_LIMIT', 10)
+
+    acc, other = DiffStats(), DiffStats()
+    acc.update(np.arange(1, 8))
+    other.update(np.arange(1, 8))
+
+    acc.merge(other)
+
+    assert acc.values is None
+    assert acc.count == 14
+
+
+def test_row_columns(diffs):
+    acc = DiffStats()
+    acc.update(diffs)
+
+    assert len(acc.row()) == len(stats.HEADER) - 3